@@ -0,0 +1,303 @@
+"""
+Multi-tier LRU cache of LoRA adapter weights for the generation worker.
+
+Loading an adapter from the volume means a network-backed read and a
+deserialization on every model switch, even for the handful of models that
+serve most requests. AdapterCache keeps recently used adapters in three
+tiers, each with its own byte limit and LRU eviction:
+
+- device: state dicts already on the GPU, ready to load into the UNet,
+- host: state dicts in pinned host RAM (fast asynchronous copy to the GPU),
+- disk: copies of the adapter files on the container's local disk.
+
+A lookup that misses every tier copies the file from the volume to the disk
+tier, hashing it on the way. Entries are validated against the volume file's
+mtime and size on each lookup; when those change the file is fetched and
+hashed again, and the memory tiers are only dropped if the hash changed too.
+"""
+
+import os
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+ADAPTER_CACHE_DIR = "/tmp/adapter-cache"
+DEVICE_CACHE_BYTES = 512 * 1024 ** 2
+HOST_CACHE_BYTES = 4 * 1024 ** 3
+DISK_CACHE_BYTES = 20 * 1024 ** 3
+COPY_CHUNK_SIZE = 4 * 1024 ** 2
+
+# Weight files looked up (in order) when an adapter path is a directory
+ADAPTER_WEIGHT_NAMES = (
+    "pytorch_lora_weights.safetensors",
+    "adapter_model.safetensors",
+    "pytorch_lora_weights.bin",
+    "adapter_model.bin",
+)
+
+TIERS = ("device", "host", "disk")
+
+
+class _LRUTier:
+    """Byte-bounded LRU map; evicted values are passed to on_evict"""
+
+    def __init__(self, limit_bytes: int, on_evict=None):
+        self.limit_bytes = limit_bytes
+        self.on_evict = on_evict
+        self.entries: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key][0]
+
+    def touch(self, key: str):
+        """Mark an entry as recently used without counting a hit"""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+
+    def put(self, key: str, value: Any, nbytes: int) -> bool:
+        self.pop(key)
+        if nbytes > self.limit_bytes:
+            return False
+        while self.entries and self.bytes + nbytes > self.limit_bytes:
+            oldest = next(iter(self.entries))
+            self.pop(oldest)
+            self.evictions += 1
+        self.entries[key] = (value, nbytes)
+        self.bytes += nbytes
+        return True
+
+    def pop(self, key: str):
+        if key not in self.entries:
+            return
+        value, nbytes = self.entries.pop(key)
+        self.bytes -= nbytes
+        if self.on_evict:
+            self.on_evict(value)
+
+
+def resolve_weight_file(adapter_path: str) -> str:
+    """Weight file of an adapter given as a file or as a directory"""
+    if not os.path.isdir(adapter_path):
+        return adapter_path
+    for name in ADAPTER_WEIGHT_NAMES:
+        candidate = os.path.join(adapter_path, name)
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(f"No adapter weights found in {adapter_path}")
+
+
+def state_dict_bytes(state_dict: Dict[str, Any]) -> int:
+    return sum(tensor.numel() * tensor.element_size() for tensor in state_dict.values())
+
+
+def load_weight_file(path: str) -> Dict[str, Any]:
+    """Deserialize a safetensors or torch weight file onto the CPU"""
+    if path.endswith(".safetensors"):
+        from safetensors.torch import load_file
+        return load_file(path, device="cpu")
+
+    import torch
+    return torch.load(path, map_location="cpu", weights_only=True)
+
+
+class AdapterCache:
+    """
+    Device / pinned host / local disk LRU cache of adapter state dicts
+
+    Args:
+        device: Device the device tier lives on (and get() returns tensors on)
+        cache_dir: Local directory for the disk tier
+        device_bytes: Byte limit of the device tier
+        host_bytes: Byte limit of the host tier
+        disk_bytes: Byte limit of the disk tier
+    """
+
+    def __init__(
+        self,
+        device: str = "cuda",
+        cache_dir: str = ADAPTER_CACHE_DIR,
+        device_bytes: int = DEVICE_CACHE_BYTES,
+        host_bytes: int = HOST_CACHE_BYTES,
+        disk_bytes: int = DISK_CACHE_BYTES
+    ):
+        import torch
+
+        self.device = device
+        self.cache_dir = cache_dir
+        # Pinned memory needs a CUDA runtime; plain host memory is used otherwise
+        self._pin = torch.cuda.is_available() and str(device).startswith("cuda")
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._tiers = {
+            "device": _LRUTier(device_bytes),
+            "host": _LRUTier(host_bytes),
+            "disk": _LRUTier(disk_bytes, on_evict=_remove_file),
+        }
+        # Weight file -> (mtime_ns, size) and sha256 of the cached version
+        self._versions: Dict[str, Tuple[Tuple[int, int], str]] = {}
+        self._lock = threading.RLock()
+        self._stats = {"lookups": 0, "misses": 0, "revalidations": 0, "invalidations": 0}
+
+    def get(self, adapter_path: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        State dict of an adapter on the cache device
+
+        The returned tensors are shared with the cache and must not be modified.
+
+        Args:
+            adapter_path: Adapter weight file or directory on the volume
+
+        Returns:
+            The state dict and lookup info: serving tier ("device", "host",
+            "disk" or "volume"), sha256, size in bytes and seconds taken
+        """
+        start_time = time.time()
+        weight_file = resolve_weight_file(adapter_path)
+        stat = os.stat(weight_file)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            self._stats["lookups"] += 1
+            # A fresh local copy when the file was new or changed on the volume
+            local_path = self._refresh(weight_file, signature)
+            try:
+                # Lower tiers keep the recency of the tier that serves the lookup
+                self._tiers["host"].touch(weight_file)
+                self._tiers["disk"].touch(weight_file)
+
+                tier = "device"
+                state_dict = self._tiers["device"].get(weight_file)
+                if state_dict is None:
+                    tier = "host"
+                    host_dict = self._tiers["host"].get(weight_file)
+                    if host_dict is None:
+                        tier = "disk"
+                        if local_path is None:
+                            local_path = self._tiers["disk"].get(weight_file)
+                        else:
+                            tier = "volume"
+                        if local_path is None:
+                            tier = "volume"
+                            local_path, _ = self._fetch(weight_file)
+                        if tier == "volume":
+                            self._stats["misses"] += 1
+
+                        host_dict = load_weight_file(local_path)
+                        if self._pin:
+                            host_dict = {key: tensor.pin_memory() for key, tensor in host_dict.items()}
+                        self._tiers["host"].put(weight_file, host_dict, state_dict_bytes(host_dict))
+
+                    state_dict = {
+                        key: tensor.to(self.device, non_blocking=self._pin) for key, tensor in host_dict.items()
+                    }
+                    self._tiers["device"].put(weight_file, state_dict, state_dict_bytes(state_dict))
+
+                info = {
+                    "tier": tier,
+                    "sha256": self._versions[weight_file][1],
+                    "bytes": signature[1],
+                    "seconds": round(time.time() - start_time, 4),
+                }
+            finally:
+                self._discard_copy(weight_file, local_path)
+        return state_dict, info
+
+    def digest(self, adapter_path: str) -> str:
+        """sha256 of an adapter's weights, read from the volume only when new or changed"""
+        weight_file = resolve_weight_file(adapter_path)
+        stat = os.stat(weight_file)
+        with self._lock:
+            self._discard_copy(weight_file, self._refresh(weight_file, (stat.st_mtime_ns, stat.st_size)))
+            return self._versions[weight_file][1]
+
+    def invalidate(self, adapter_path: str):
+        """Drop an adapter from every tier"""
+        weight_file = resolve_weight_file(adapter_path)
+        with self._lock:
+            for tier in self._tiers.values():
+                tier.pop(weight_file)
+            self._versions.pop(weight_file, None)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Lookup counters and per-tier hit rates, entries and bytes"""
+        with self._lock:
+            lookups = self._stats["lookups"]
+            metrics = dict(self._stats)
+            metrics["miss_rate"] = round(self._stats["misses"] / lookups, 3) if lookups else None
+            for name in TIERS:
+                tier = self._tiers[name]
+                metrics[name] = {
+                    "hits": tier.hits,
+                    "hit_rate": round(tier.hits / lookups, 3) if lookups else None,
+                    "entries": len(tier.entries),
+                    "bytes": tier.bytes,
+                    "limit_bytes": tier.limit_bytes,
+                    "evictions": tier.evictions,
+                }
+        return metrics
+
+    def _refresh(self, weight_file: str, signature: Tuple[int, int]) -> Optional[str]:
+        """
+        Fetch and hash a weight file that is new or whose mtime/size changed (lock held)
+
+        Returns:
+            The fresh local copy (left to the caller to discard if the disk
+            tier did not take it), or None when the known version is current
+        """
+        version = self._versions.get(weight_file)
+        if version is not None and version[0] == signature:
+            return None
+
+        if version is not None:
+            # The file was touched or rewritten; only a new hash invalidates the memory tiers
+            self._stats["revalidations"] += 1
+            self._tiers["disk"].pop(weight_file)
+        local_path, digest = self._fetch(weight_file)
+        if version is not None and digest != version[1]:
+            print(f"Adapter {weight_file} changed on the volume, invalidating cached copies")
+            self._stats["invalidations"] += 1
+            self._tiers["device"].pop(weight_file)
+            self._tiers["host"].pop(weight_file)
+        self._versions[weight_file] = (signature, digest)
+        return local_path
+
+    def _discard_copy(self, weight_file: str, local_path: Optional[str]):
+        """Delete a fetched copy the disk tier did not accept, e.g. one over its limit (lock held)"""
+        entry = self._tiers["disk"].entries.get(weight_file)
+        if local_path is not None and (entry is None or entry[0] != local_path):
+            _remove_file(local_path)
+
+    def _fetch(self, weight_file: str) -> Tuple[str, str]:
+        """Copy a weight file from the volume into the disk tier, hashing it on the way"""
+        digest = hashlib.sha256()
+        ext = os.path.splitext(weight_file)[1]
+        local_path = os.path.join(self.cache_dir, f"{uuid.uuid4().hex}{ext}")
+        with open(weight_file, "rb") as src, open(local_path, "wb") as dst:
+            while True:
+                chunk = src.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                dst.write(chunk)
+
+        nbytes = os.path.getsize(local_path)
+        if not self._tiers["disk"].put(weight_file, local_path, nbytes):
+            print(f"Adapter {weight_file} ({nbytes} bytes) exceeds the disk cache limit")
+        return local_path, digest.hexdigest()
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
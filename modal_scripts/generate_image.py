@@ -4,14 +4,17 @@ Image generation script for LoRA fine-tuned models.
 """
 
 import os
-import io
 import json
 import base64
 import time
 import argparse
 import sys
 import traceback
-from typing import Dict, Any, Optional, List
+import threading
+import queue
+import uuid
+from collections import deque
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 import modal
 from PIL import Image
 import torch
@@ -19,6 +22,16 @@ import torch
 from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
 from safetensors.torch import load_file
 
+from adapter_cache import AdapterCache
+from image_output import OUTPUT_FORMATS, OUTPUTS_DIRNAME, ImageOutput, resolve_output, save_binary_outputs
+from lora_fusion import LoRAFuser
+from multi_lora import MULTI_LORA_SLOTS, MultiAdapterLoRA, adapter_scale
+from prompt_cache import PromptEmbeddingCache
+from request_batcher import BATCH_WINDOW_SECONDS, RequestBatcher
+from result_cache import RESULT_CACHE_DIRNAME, ResultCache, result_cache_key
+from unet_feature_cache import UNetFeatureCache, image_psnr
+from latent_preview import PREVIEW_EVERY_STEPS, denoised_latents, encode_preview, preview_images, project_latents
+
 # Set up Modal volume for persistent storage
 VOLUME_MOUNT_PATH = "/model-data"
 volume = modal.Volume.from_name("lora-models", create_if_missing=True)
@@ -29,7 +42,7 @@ BASE_MODEL = "runwayml/stable-diffusion-v1-5"
 
 # Define a custom image with required dependencies
 image = modal.Image.debian_slim().pip_install(
-    "diffusers>=0.25.0",  # Updated to newer version
+    "diffusers>=0.26.0",  # diffusers.models.unets layout (unet_feature_cache)
     "transformers>=4.30.0",
     "torch>=2.0.0",
     "accelerate>=0.20.0",
@@ -39,150 +52,1228 @@ image = modal.Image.debian_slim().pip_install(
     "numpy",
     "ftfy",
     "safetensors"
+).add_local_python_source(
+    # Sibling modules imported above; Modal no longer mounts local modules automatically
+    "adapter_cache",
+    "request_batcher",
+    "multi_lora",
+    "prompt_cache",
+    "result_cache",
+    "lora_fusion",
+    "unet_feature_cache",
+    "latent_preview",
+    "image_output",
 )
 
-@app.function(
-    gpu="T4", 
-    timeout=600, 
-    volumes={VOLUME_MOUNT_PATH: volume},
-    image=image  # Use the custom image with all dependencies
-)
-def generate_image(
-    model_id: str,
-    prompt: str,
-    num_inference_steps: int = 30,
-    guidance_scale: float = 7.5,
-    negative_prompt: str = "ugly, blurry, low quality, distorted",
-    seed: Optional[int] = None
-) -> Dict[str, Any]:
+# Idle seconds before a warm container (and its resident pipeline) is shut down
+CONTAINER_IDLE_SECONDS = 300
+DEFAULT_NEGATIVE_PROMPT = "ugly, blurry, low quality, distorted"
+
+# Batched generation
+MAX_BATCH_SIZE = 16  # Images denoised together in one UNet pass, at most
+MAX_BATCH_IMAGES = 32  # Images per generate_batch request
+BATCH_MEMORY_FRACTION = 0.8  # Share of free GPU memory a batch may use
+# Peak memory per UNet sample (an image with CFG counts twice) at 512x512 in fp16,
+# used until a batch has been measured on this GPU
+ESTIMATED_SAMPLE_BYTES = 384 * 1024 ** 2
+DEFAULT_RESOLUTION = 512
+
+# Dynamic batching server mode
+MAX_CONCURRENT_INPUTS = 32  # Inputs a GenerationServer container accepts at once
+
+# Fused adapters: the LoRA deltas are merged into the UNet weights when a model
+# sees sustained traffic, so its denoising steps cost the same as the base model's
+FUSE_MIN_QUEUED = 4  # Requests queued for a model (batching workers) before it is fused
+FUSE_MIN_STREAK = 3  # Consecutive requests for a model (Generator) before it is fused
+
+# Latency tiers: a draft for quick feedback, then standard / final renders of
+# the images the user keeps. cfg_fraction is the share of the steps that run
+# classifier-free guidance; the last steps only refine detail, so a draft runs
+# them on the conditional half alone.
+GENERATION_TIERS = {
+    "draft": {"num_inference_steps": 12, "guidance_scale": 7.5, "cfg_fraction": 0.6, "resolution": 384},
+    "standard": {"num_inference_steps": 30, "guidance_scale": 7.5, "cfg_fraction": 1.0, "resolution": 512},
+    "final": {"num_inference_steps": 50, "guidance_scale": 7.5, "cfg_fraction": 1.0, "resolution": 512},
+}
+
+# UNet feature caching report (Generator.feature_cache_report)
+FEATURE_CACHE_REPORT_INTERVALS = [2, 3, 5]
+FEATURE_CACHE_REPORT_PROMPTS = [
+    "a portrait photo, soft window light",
+    "standing on a beach at sunset",
+    "in a busy city street, detailed background",
+    "a pencil sketch, close-up",
+]
+
+
+def load_base_pipeline() -> StableDiffusionPipeline:
+    """Load the base model with the DPMSolver scheduler onto the GPU"""
+    print(f"Loading base model: {BASE_MODEL}")
+    pipe = StableDiffusionPipeline.from_pretrained(
+        BASE_MODEL,
+        torch_dtype=torch.float16,
+        safety_checker=None  # Disable safety checker for custom models
+    )
+
+    # Use DPMSolver for faster inference with better quality
+    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+
+    # Decode batches one image at a time, so the VAE does not bound the batch size
+    pipe.vae.enable_slicing()
+
+    # Move to GPU
+    pipe.to("cuda")
+    return pipe
+
+
+def prepare_prompt(prompt: str, instance_prompt: Optional[str]) -> str:
+    """Prepare final prompt (replace 'sks' token if present)"""
+    final_prompt = prompt
+    if instance_prompt and "sks" in instance_prompt:
+        if "sks" in prompt:
+            final_prompt = prompt.replace("sks", "")
+    return final_prompt
+
+
+def read_instance_prompt(model_dir: str) -> Optional[str]:
+    """Instance prompt the model was trained with, from its model_info.json"""
+    model_info_path = os.path.join(model_dir, "model_info.json")
+    if not os.path.exists(model_info_path):
+        return None
+    with open(model_info_path, "r") as f:
+        return json.load(f).get("instancePrompt")
+
+
+def resolve_tier(
+    tier: Optional[str],
+    num_inference_steps: int,
+    guidance_scale: float,
+    height: int = DEFAULT_RESOLUTION,
+    width: int = DEFAULT_RESOLUTION
+) -> Tuple[int, float, float, int, int]:
     """
-    Generate an image using a LoRA fine-tuned model
-    
-    Args:
-        model_id: ID of the LoRA model to use
-        prompt: Text prompt for image generation
-        num_inference_steps: Number of diffusion steps (default 30)
-        guidance_scale: Classifier-free guidance scale (default 7.5)
-        negative_prompt: Text describing what to avoid in the image
-        seed: Random seed for reproducibility
-        
+    Sampler settings of a request: the tier's preset, or the caller's own settings without one
+
     Returns:
-        Dictionary with generation results and image data
+        (num_inference_steps, guidance_scale, cfg_fraction, height, width)
     """
-    
-    try:
-        print(f"Starting image generation for model {model_id}")
-        # Create seed if none provided
-        if seed is None:
-            seed = int(time.time()) % 1000000
-            print(f"No seed provided, using random seed: {seed}")
-        
-        # Set the random seed for reproducibility
-        generator = torch.Generator("cuda").manual_seed(seed)
-        
-        # Ensure model directory exists
+    if tier is None:
+        return num_inference_steps, guidance_scale, 1.0, height, width
+    if tier not in GENERATION_TIERS:
+        raise ValueError(f"Unknown tier '{tier}', expected one of: {', '.join(GENERATION_TIERS)}")
+    preset = GENERATION_TIERS[tier]
+    return (
+        preset["num_inference_steps"],
+        preset["guidance_scale"],
+        preset["cfg_fraction"],
+        preset["resolution"],
+        preset["resolution"],
+    )
+
+
+def guidance_cutoff_callback(cfg_steps: int) -> Callable:
+    """Step-end callback that turns classifier-free guidance off after cfg_steps steps"""
+    def callback(pipe, step, timestep, callback_kwargs):
+        if step == cfg_steps - 1:
+            # The pipeline checks the guidance scale on every step; dropping the
+            # unconditional embeddings halves the UNet batch from here on
+            pipe._guidance_scale = 0.0
+            callback_kwargs["prompt_embeds"] = callback_kwargs["prompt_embeds"].chunk(2)[-1]
+        return callback_kwargs
+    return callback
+
+
+def latency_summary(latencies: List[float]) -> Optional[Dict[str, float]]:
+    """Mean and percentiles (seconds) of a list of request latencies"""
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": round(ordered[len(ordered) // 2], 3),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+class GenerationWorker:
+    """
+    Warm generation worker
+
+    The base pipeline is loaded once when the container starts and stays on
+    the GPU; requests only swap the LoRA adapter, and only when the model
+    (or its files on the volume) changed since the previous request.
+    Subclasses are the Modal classes and call _load from their enter hook.
+    """
+
+    def _load(self):
+        start_time = time.time()
+        self.pipe = load_base_pipeline()
+        self.pipeline_load_seconds = time.time() - start_time
+        print(f"Base pipeline loaded in {self.pipeline_load_seconds:.2f} seconds")
+
+        self.adapter_cache = AdapterCache(device="cuda")
+        self.prompt_cache = PromptEmbeddingCache(self.pipe.tokenizer, self.pipe.text_encoder)
+        self.prompt_cache.precompute([DEFAULT_NEGATIVE_PROMPT])
+        # Seeded requests are deterministic; their images are kept on the volume
+        self.result_cache = ResultCache(
+            os.path.join(VOLUME_MOUNT_PATH, RESULT_CACHE_DIRNAME),
+            commit=volume.commit,
+            reload=volume.reload
+        )
+        self.adapter_key = None  # (adapter path, sha256) of the loaded adapter
+        self.adapter_fused = False  # Whether that adapter is merged into the UNet weights
+        self.lora_fuser = LoRAFuser(self.pipe.unet)
+        self.feature_cache = UNetFeatureCache(self.pipe.unet)
+        self.image_output = ImageOutput(os.path.join(VOLUME_MOUNT_PATH, OUTPUTS_DIRNAME), commit=volume.commit)
+        self.instance_prompt = None
+        self.requests_served = 0
+        self.first_request_seconds = None
+        self.steady_state_seconds = deque(maxlen=1000)
+        self.sample_bytes = None  # Measured peak bytes per UNet sample at 512x512
+        self.multi_lora = None  # Per-sample adapters (mixed-adapter batches only)
+        self._stats_lock = threading.Lock()
+
+    def _model_paths(self, model_id: str) -> Tuple[str, str]:
+        """Model directory and adapter path of a model on the volume"""
         model_dir = os.path.join(VOLUME_MOUNT_PATH, model_id)
         if not os.path.exists(model_dir):
-            return {
-                "status": "error",
-                "error": f"Model directory not found for ID: {model_id}",
-                "model_id": model_id
-            }
-        
-        # Check for the adapter model
+            # Models trained after this container started are only visible after a reload
+            volume.reload()
+        if not os.path.exists(model_dir):
+            raise FileNotFoundError(f"Model directory not found for ID: {model_id}")
+
         adapter_model_path = os.path.join(model_dir, "trained_model")
-        adapter_config_path = os.path.join(model_dir, "adapter_config.json")
-        
         if not os.path.exists(adapter_model_path):
+            raise FileNotFoundError(f"Adapter model not found at {adapter_model_path}")
+        return model_dir, adapter_model_path
+
+    def _activate_adapter(self, model_id: str, fused: bool = False) -> Dict[str, Any]:
+        """
+        Make model_id's adapter the active one, loading it only if it changed
+
+        Args:
+            model_id: ID of the LoRA model to use
+            fused: Merge the adapter into the UNet weights instead of loading it
+                as attention processors (an adapter that is already fused stays so)
+        """
+        model_dir, adapter_model_path = self._model_paths(model_id)
+
+        # Served from the device / host / disk cache unless it changed on the volume
+        state_dict, cache_info = self.adapter_cache.get(adapter_model_path)
+        timings = {"adapter_tier": cache_info["tier"], "adapter_cache_seconds": cache_info["seconds"]}
+        key = (adapter_model_path, cache_info["sha256"])
+        if key == self.adapter_key and (self.adapter_fused or not fused):
             return {
-                "status": "error",
-                "error": f"Adapter model not found at {adapter_model_path}",
-                "model_id": model_id
+                "adapter_swapped": False,
+                "adapter_mode": "fused" if self.adapter_fused else "unfused",
+                **timings,
+                "adapter_seconds": cache_info["seconds"],
             }
-        
-        # Load adapter config if available
-        adapter_config = None
-        if os.path.exists(adapter_config_path):
-            with open(adapter_config_path, "r") as f:
-                adapter_config = json.load(f)
-            print("Loaded adapter configuration")
-        
-        # Load the base model
-        print(f"Loading base model: {BASE_MODEL}")
-        pipe = StableDiffusionPipeline.from_pretrained(
-            BASE_MODEL, 
-            torch_dtype=torch.float16,
-            safety_checker=None  # Disable safety checker for custom models
-        )
 
-        # Use DPMSolver for faster inference with better quality
-        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
-        
-        # Move to GPU
-        pipe.to("cuda")
-        
-        # Load the adapter weights
-        print(f"Loading LoRA weights from {adapter_model_path}")
-        pipe.unet.load_attn_procs(adapter_model_path)
-        
-        # Generate the image
-        print(f"Generating image with prompt: {prompt}")
         start_time = time.time()
-        
-        # Adjust prompts based on instance_prompt if needed
-        model_info_path = os.path.join(model_dir, "model_info.json")
-        instance_prompt = None
-        if os.path.exists(model_info_path):
-            with open(model_info_path, "r") as f:
-                model_info = json.load(f)
-                instance_prompt = model_info.get("instancePrompt")
-        
-        # Prepare final prompt (replace 'sks' token if present)
-        final_prompt = prompt
-        if instance_prompt and "sks" in instance_prompt:
-            concept_token = instance_prompt.split()[instance_prompt.split().index("sks") + 1]
-            if "sks" in prompt:
-                final_prompt = prompt.replace("sks", "")
-                
-        # Generate the image
-        with torch.autocast("cuda"):
-            image = pipe(
-                final_prompt,
-                negative_prompt=negative_prompt,
-                num_inference_steps=num_inference_steps,
-                guidance_scale=guidance_scale,
-                generator=generator
-            ).images[0]
-        
-        generation_time = time.time() - start_time
-        print(f"Image generated in {generation_time:.2f} seconds")
-        
-        # Convert to base64 for API response
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-        
-        # Return results
+        if self.adapter_key is not None:
+            # Restore the base weights / attention layers before loading the next adapter
+            if self.adapter_fused:
+                self.lora_fuser.unfuse()
+            else:
+                self.pipe.unload_lora_weights()
+            self.adapter_key = None
+
+        print(f"Loading LoRA weights for model {model_id} ({cache_info['tier']}, {'fused' if fused else 'unfused'})")
+        if fused:
+            self.lora_fuser.fuse(cache_info["sha256"], state_dict, scale=adapter_scale(adapter_model_path))
+        else:
+            self.pipe.unet.load_attn_procs(state_dict)
+
+        self.instance_prompt = read_instance_prompt(model_dir)
+        self.adapter_key = key
+        self.adapter_fused = fused
         return {
-            "status": "success",
-            "image_base64": img_str,
-            "prompt": prompt,
-            "final_prompt": final_prompt,
-            "seed": seed,
-            "steps": num_inference_steps,
-            "guidance_scale": guidance_scale,
-            "generation_time": f"{generation_time:.2f}s"
+            "adapter_swapped": True,
+            "adapter_mode": "fused" if fused else "unfused",
+            **timings,
+            "adapter_seconds": round(time.time() - start_time + cache_info["seconds"], 3),
         }
-        
-    except Exception as e:
-        error_message = str(e)
-        print(f"Error during image generation: {error_message}")
+
+    def _record_latency(self, seconds: float) -> bool:
+        """Record a request latency; returns whether it was the container's first request"""
+        with self._stats_lock:
+            self.requests_served += 1
+            if self.first_request_seconds is None:
+                self.first_request_seconds = seconds
+                return True
+            self.steady_state_seconds.append(seconds)
+            return False
+
+    def max_batch_size(
+        self,
+        guidance_scale: float,
+        height: int = DEFAULT_RESOLUTION,
+        width: int = DEFAULT_RESOLUTION
+    ) -> int:
+        """Largest batch that fits the GPU memory currently free, up to MAX_BATCH_SIZE"""
+        free_bytes, _ = torch.cuda.mem_get_info()
+        # Memory cached by PyTorch's allocator is free for our purposes too
+        free_bytes += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+
+        sample_bytes = (self.sample_bytes or ESTIMATED_SAMPLE_BYTES) * (height * width) / (512 * 512)
+        unet_samples_per_image = 2 if guidance_scale > 1 else 1
+        fit = int(free_bytes * BATCH_MEMORY_FRACTION // (sample_bytes * unet_samples_per_image))
+        return max(1, min(MAX_BATCH_SIZE, fit))
+
+    def _denoise(
+        self,
+        final_prompts: List[str],
+        seeds: List[int],
+        negative_prompts: List[str],
+        num_inference_steps: int,
+        guidance_scale: float,
+        height: int = DEFAULT_RESOLUTION,
+        width: int = DEFAULT_RESOLUTION,
+        cfg_fraction: float = 1.0,
+        feature_cache_interval: int = 1,
+        adapter_slots: Optional[List[int]] = None,
+        step_callback: Optional[Callable[[int, torch.Tensor], None]] = None
+    ) -> Tuple[List[Image.Image], List[int]]:
+        """
+        Generate one image per prompt/seed pair, in batches that fit the GPU
+
+        cfg_fraction below 1 runs classifier-free guidance on that share of
+        the steps only (see GENERATION_TIERS). feature_cache_interval above 1
+        runs the full UNet on every interval-th step only (see
+        unet_feature_cache). adapter_slots gives each image its own adapter
+        (see multi_lora) in mixed-adapter batches. step_callback is called
+        with the step index and latents at the end of every denoising step.
+
+        Returns:
+            The images in input order and the size of each batch that ran
+        """
+        batch_size = self.max_batch_size(guidance_scale, height, width)
+        cfg_steps = max(1, round(num_inference_steps * cfg_fraction))
+        guidance_cutoff = guidance_cutoff_callback(cfg_steps) if cfg_steps < num_inference_steps else None
+
+        def callback(pipe, step, timestep, callback_kwargs):
+            if guidance_cutoff is not None:
+                callback_kwargs = guidance_cutoff(pipe, step, timestep, callback_kwargs)
+            if step_callback is not None:
+                step_callback(step, callback_kwargs["latents"])
+            return callback_kwargs
+
+        images = []
+        batch_sizes = []
+        for start in range(0, len(final_prompts), batch_size):
+            prompts = final_prompts[start:start + batch_size]
+            # One generator per image, so each seed gives the same image as a single request
+            generators = [torch.Generator("cuda").manual_seed(seed) for seed in seeds[start:start + batch_size]]
+
+            if adapter_slots is not None:
+                self.multi_lora.set_batch(adapter_slots[start:start + batch_size])
+
+            # Cached text encoder outputs instead of encoding both prompts on every call
+            prompt_embeds = self.prompt_cache.encode(prompts)
+            negative_prompt_embeds = self.prompt_cache.encode(negative_prompts[start:start + batch_size])
+
+            torch.cuda.reset_peak_memory_stats()
+            baseline_bytes = torch.cuda.memory_allocated()
+            with torch.autocast("cuda"), self.feature_cache.enabled(feature_cache_interval):
+                images.extend(self.pipe(
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    num_inference_steps=num_inference_steps,
+                    guidance_scale=guidance_scale,
+                    height=height,
+                    width=width,
+                    generator=generators,
+                    callback_on_step_end=callback if guidance_cutoff or step_callback else None,
+                    callback_on_step_end_tensor_inputs=["latents", "prompt_embeds"]
+                ).images)
+            batch_sizes.append(len(prompts))
+
+            # Calibrate the batch size estimate with what this batch actually used
+            unet_samples = len(prompts) * (2 if guidance_scale > 1 else 1)
+            measured = (torch.cuda.max_memory_allocated() - baseline_bytes) / unet_samples
+            measured *= (512 * 512) / (height * width)
+            self.sample_bytes = max(self.sample_bytes or 0, measured)
+
+        if adapter_slots is not None:
+            self.multi_lora.set_batch(None)
+        return images, batch_sizes
+
+    def _cached_generation(
+        self,
+        model_id: str,
+        prompt: str,
+        negative_prompt: str,
+        num_inference_steps: int,
+        guidance_scale: float,
+        seed: Optional[int],
+        height: int,
+        width: int,
+        compute: Callable[[], Tuple[bytes, Dict[str, Any]]],
+        cfg_fraction: float = 1.0,
+        feature_cache_interval: int = 1,
+        output: Optional[Dict[str, Any]] = None
+    ) -> Tuple[bytes, Dict[str, Any], str]:
+        """
+        Run compute through the result cache when the request is deterministic
+
+        Args:
+            seed: The caller's seed; requests without one bypass the cache
+            compute: Generates the image, returning its encoded bytes and metadata
+            output: Output options resolved by resolve_output (the image
+                format and quality are part of the cache key)
+
+        Returns:
+            The encoded image, metadata and cache status ("hit", "coalesced",
+            "miss" or "bypass")
+        """
+        output = output or resolve_output(None)
+        if seed is None:
+            data, meta = compute()
+            return data, meta, "bypass"
+
+        _, adapter_model_path = self._model_paths(model_id)
+        key = result_cache_key(
+            model_id=model_id,
+            adapter_sha256=self.adapter_cache.digest(adapter_model_path),
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            cfg_fraction=cfg_fraction,
+            feature_cache_interval=feature_cache_interval,
+            scheduler=type(self.pipe.scheduler).__name__,
+            seed=seed,
+            height=height,
+            width=width,
+            image_format=output["format"],
+            image_quality=output["quality"]
+        )
+        return self.result_cache.get_or_compute(key, compute, extension=OUTPUT_FORMATS[output["format"]][2])
+
+    def _worker_stats(self) -> Dict[str, Any]:
+        """First-request and steady-state latency and cache hit rates of this container"""
+        with self._stats_lock:
+            first_request_seconds = self.first_request_seconds
+            steady_state_seconds = list(self.steady_state_seconds)
+            requests_served = self.requests_served
         return {
-            "status": "error",
-            "error": error_message,
-            "traceback": traceback.format_exc() if 'traceback' in sys.modules else None
+            "pipeline_load_seconds": round(self.pipeline_load_seconds, 3),
+            "requests_served": requests_served,
+            "first_request_seconds": (
+                round(first_request_seconds, 3) if first_request_seconds is not None else None
+            ),
+            "steady_state_seconds": latency_summary(steady_state_seconds),
+            "max_batch_size": self.max_batch_size(7.5),
+            "adapter_cache": self.adapter_cache.metrics(),
+            "lora_fusion": self.lora_fuser.metrics(),
+            "prompt_cache": self.prompt_cache.metrics(),
+            "result_cache": self.result_cache.metrics(),
+            "feature_cache": self.feature_cache.metrics(),
+            "image_output": self.image_output.metrics(),
         }
 
+
+@app.cls(
+    gpu="T4",
+    timeout=600,
+    volumes={VOLUME_MOUNT_PATH: volume},
+    image=image,
+    scaledown_window=CONTAINER_IDLE_SECONDS
+)
+class Generator(GenerationWorker):
+    """Generation worker serving one request at a time (single images or explicit batches)"""
+
+    @modal.enter()
+    def load_pipeline(self):
+        self._load()
+        self.model_streak = (None, 0)  # Model of the latest requests and how many in a row
+
+    def _fuse_for(self, model_id: str, images: int = 1) -> bool:
+        """
+        Whether to fuse model_id's adapter for this request
+
+        This worker has no queue to look at, so sustained traffic is a streak
+        of consecutive requests (or one large batch) for the same model.
+        """
+        streak_model, streak = self.model_streak
+        streak = streak + images if streak_model == model_id else images
+        self.model_streak = (model_id, streak)
+        return streak >= FUSE_MIN_STREAK
+
+    @modal.method()
+    def generate(
+        self,
+        model_id: str,
+        prompt: str,
+        num_inference_steps: int = 30,
+        guidance_scale: float = 7.5,
+        negative_prompt: str = DEFAULT_NEGATIVE_PROMPT,
+        seed: Optional[int] = None,
+        tier: Optional[str] = None,
+        feature_cache_interval: int = 1,
+        output: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Generate an image using a LoRA fine-tuned model
+
+        Args:
+            model_id: ID of the LoRA model to use
+            prompt: Text prompt for image generation
+            num_inference_steps: Number of diffusion steps (default 30)
+            guidance_scale: Classifier-free guidance scale (default 7.5)
+            negative_prompt: Text describing what to avoid in the image
+            seed: Random seed for reproducibility
+            tier: Latency tier from GENERATION_TIERS ("draft", "standard" or
+                "final"); replaces the steps, guidance and resolution
+            feature_cache_interval: Run the full UNet every this many steps and
+                reuse its deep features in between (1 = off, see unet_feature_cache)
+            output: Image format, quality, destination and thumbnail (see
+                image_output); a base64 PNG in image_base64 by default
+
+        Returns:
+            Dictionary with generation results, image data and timings
+        """
+        return self._generate(
+            model_id,
+            prompt,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            negative_prompt=negative_prompt,
+            seed=seed,
+            tier=tier,
+            feature_cache_interval=feature_cache_interval,
+            output=output
+        )
+
+    @modal.method()
+    def generate_stream(
+        self,
+        model_id: str,
+        prompt: str,
+        num_inference_steps: int = 30,
+        guidance_scale: float = 7.5,
+        negative_prompt: str = DEFAULT_NEGATIVE_PROMPT,
+        seed: Optional[int] = None,
+        tier: Optional[str] = None,
+        feature_cache_interval: int = 1,
+        output: Optional[Dict[str, Any]] = None,
+        preview_every: int = PREVIEW_EVERY_STEPS
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Generate an image, yielding a cheap preview every few steps
+
+        Takes the same arguments as generate (call with remote_gen). Previews
+        are linear latent->RGB projections (see latent_preview), not VAE
+        decodes, so they add next to nothing to the denoising time.
+
+        Args:
+            preview_every: Denoising steps between two previews
+
+        Yields:
+            {"type": "preview", "step", "total_steps", "image_base64" (JPEG),
+            "elapsed_seconds"} dicts, then the result of generate with
+            "type": "final" (the only item for cached results and errors)
+        """
+        request_start = time.time()
+        total_steps = GENERATION_TIERS.get(tier, {}).get("num_inference_steps", num_inference_steps)
+        previews = queue.Queue()
+
+        def on_step(step: int, latents: torch.Tensor):
+            step += 1
+            if step % preview_every == 0 and step < total_steps:
+                # Projected on the GPU thread; upscaling and encoding happen in this one
+                previews.put((step, project_latents(denoised_latents(self.pipe.scheduler, latents))))
+
+        results = []
+        worker = threading.Thread(
+            target=lambda: results.append(self._generate(
+                model_id,
+                prompt,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                negative_prompt=negative_prompt,
+                seed=seed,
+                tier=tier,
+                feature_cache_interval=feature_cache_interval,
+                output=output,
+                step_callback=on_step
+            )),
+            name="generate-stream",
+            daemon=True
+        )
+        worker.start()
+
+        while worker.is_alive() or not previews.empty():
+            try:
+                step, rgb = previews.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            yield {
+                "type": "preview",
+                "step": step,
+                "total_steps": total_steps,
+                "image_base64": encode_preview(preview_images(rgb)[0]),
+                "elapsed_seconds": round(time.time() - request_start, 3),
+            }
+
+        yield {"type": "final", **results[0]}
+
+    def _generate(
+        self,
+        model_id: str,
+        prompt: str,
+        num_inference_steps: int = 30,
+        guidance_scale: float = 7.5,
+        negative_prompt: str = DEFAULT_NEGATIVE_PROMPT,
+        seed: Optional[int] = None,
+        tier: Optional[str] = None,
+        feature_cache_interval: int = 1,
+        output: Optional[Dict[str, Any]] = None,
+        step_callback: Optional[Callable[[int, torch.Tensor], None]] = None
+    ) -> Dict[str, Any]:
+        """generate, with step_callback passed on to _denoise"""
+        request_start = time.time()
+        try:
+            print(f"Starting image generation for model {model_id}")
+            num_inference_steps, guidance_scale, cfg_fraction, height, width = resolve_tier(
+                tier, num_inference_steps, guidance_scale
+            )
+            output = resolve_output(output)
+            requested_seed = seed
+            # Create seed if none provided
+            if seed is None:
+                seed = int(time.time()) % 1000000
+                print(f"No seed provided, using random seed: {seed}")
+
+            run_timings = {}
+
+            def compute() -> Tuple[bytes, Dict[str, Any]]:
+                adapter_timings = self._activate_adapter(model_id, fused=self._fuse_for(model_id))
+                final_prompt = prepare_prompt(prompt, self.instance_prompt)
+
+                print(f"Generating image with prompt: {prompt}")
+                start_time = time.time()
+                images, _ = self._denoise(
+                    [final_prompt], [seed], [negative_prompt], num_inference_steps, guidance_scale,
+                    height, width, cfg_fraction, feature_cache_interval, step_callback=step_callback
+                )
+                generation_time = time.time() - start_time
+                print(f"Image generated in {generation_time:.2f} seconds")
+
+                run_timings.update(adapter_timings, denoise_seconds=round(generation_time, 3))
+                data, image_info = self.image_output.encode(images[0], output)
+                return data, {"final_prompt": final_prompt, "image": image_info}
+
+            try:
+                data, meta, cache_status = self._cached_generation(
+                    model_id, prompt, negative_prompt, num_inference_steps, guidance_scale,
+                    requested_seed, height, width, compute,
+                    cfg_fraction=cfg_fraction, feature_cache_interval=feature_cache_interval, output=output
+                )
+            except FileNotFoundError as e:
+                return {
+                    "status": "error",
+                    "error": str(e),
+                    "model_id": model_id
+                }
+
+            image_fields = self.image_output.deliver(
+                data, meta["image"], output, name=f"{model_id}/{uuid.uuid4().hex}"
+            )
+
+            request_seconds = time.time() - request_start
+            first_request = self._record_latency(request_seconds)
+
+            return {
+                "status": "success",
+                **image_fields,
+                "prompt": prompt,
+                "final_prompt": meta["final_prompt"],
+                "seed": seed,
+                "tier": tier,
+                "steps": num_inference_steps,
+                "guidance_scale": guidance_scale,
+                "width": width,
+                "height": height,
+                "feature_cache_interval": feature_cache_interval,
+                "generation_time": f"{run_timings.get('denoise_seconds', 0.0):.2f}s",
+                "timings": {
+                    "first_request": first_request,
+                    "pipeline_load_seconds": round(self.pipeline_load_seconds, 3) if first_request else 0.0,
+                    "result_cache": cache_status,
+                    **run_timings,
+                    "request_seconds": round(request_seconds, 3),
+                }
+            }
+
+        except Exception as e:
+            error_message = str(e)
+            print(f"Error during image generation: {error_message}")
+            return {
+                "status": "error",
+                "error": error_message,
+                "traceback": traceback.format_exc() if 'traceback' in sys.modules else None
+            }
+
+    @modal.method()
+    def generate_batch(
+        self,
+        model_id: str,
+        prompts: List[str],
+        seeds: Optional[List[Optional[int]]] = None,
+        num_inference_steps: int = 30,
+        guidance_scale: float = 7.5,
+        negative_prompt: str = DEFAULT_NEGATIVE_PROMPT,
+        tier: Optional[str] = None,
+        feature_cache_interval: int = 1,
+        output: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Generate several images with one model, denoised together in batches
+
+        Args:
+            model_id: ID of the LoRA model to use
+            prompts: Text prompts; a single prompt is repeated for every seed
+            seeds: Random seed per image (None entries, or no list, pick one)
+            num_inference_steps: Number of diffusion steps (default 30)
+            guidance_scale: Classifier-free guidance scale (default 7.5)
+            negative_prompt: Text describing what to avoid, shared by all images
+            tier: Latency tier from GENERATION_TIERS, as in generate
+            feature_cache_interval: UNet feature cache refresh interval, as in generate
+            output: Output options for every image, as in generate
+
+        Returns:
+            Dictionary with one result per image (in input order), the batch
+            sizes used and timings
+        """
+        request_start = time.time()
+        try:
+            num_inference_steps, guidance_scale, cfg_fraction, height, width = resolve_tier(
+                tier, num_inference_steps, guidance_scale
+            )
+            if seeds and len(prompts) == 1:
+                prompts = prompts * len(seeds)
+            seeds = list(seeds) if seeds else [None] * len(prompts)
+            if not prompts or len(seeds) != len(prompts):
+                return {
+                    "status": "error",
+                    "error": f"Got {len(prompts)} prompts and {len(seeds)} seeds",
+                    "model_id": model_id
+                }
+            if len(prompts) > MAX_BATCH_IMAGES:
+                return {
+                    "status": "error",
+                    "error": f"At most {MAX_BATCH_IMAGES} images per request, got {len(prompts)}",
+                    "model_id": model_id
+                }
+
+            output = resolve_output(output)
+            base_seed = int(time.time()) % 1000000
+            seeds = [seed if seed is not None else (base_seed + i) % 1000000 for i, seed in enumerate(seeds)]
+            print(f"Starting batch generation of {len(prompts)} images for model {model_id}")
+
+            try:
+                adapter_timings = self._activate_adapter(model_id, fused=self._fuse_for(model_id, len(prompts)))
+            except FileNotFoundError as e:
+                return {
+                    "status": "error",
+                    "error": str(e),
+                    "model_id": model_id
+                }
+
+            final_prompts = [prepare_prompt(prompt, self.instance_prompt) for prompt in prompts]
+
+            start_time = time.time()
+            images, batch_sizes = self._denoise(
+                final_prompts, seeds, [negative_prompt] * len(final_prompts),
+                num_inference_steps, guidance_scale, height, width, cfg_fraction, feature_cache_interval
+            )
+            generation_time = time.time() - start_time
+            print(f"{len(images)} images generated in {generation_time:.2f} seconds (batches: {batch_sizes})")
+
+            results = []
+            for image, prompt, final_prompt, seed in zip(images, prompts, final_prompts, seeds):
+                data, image_info = self.image_output.encode(image, output)
+                results.append({
+                    **self.image_output.deliver(data, image_info, output, name=f"{model_id}/{uuid.uuid4().hex}"),
+                    "prompt": prompt,
+                    "final_prompt": final_prompt,
+                    "seed": seed,
+                })
+
+            request_seconds = time.time() - request_start
+            first_request = self._record_latency(request_seconds)
+
+            return {
+                "status": "success",
+                "images": results,
+                "tier": tier,
+                "steps": num_inference_steps,
+                "guidance_scale": guidance_scale,
+                "width": width,
+                "height": height,
+                "feature_cache_interval": feature_cache_interval,
+                "batch_sizes": batch_sizes,
+                "generation_time": f"{generation_time:.2f}s",
+                "timings": {
+                    "first_request": first_request,
+                    "pipeline_load_seconds": round(self.pipeline_load_seconds, 3) if first_request else 0.0,
+                    **adapter_timings,
+                    "denoise_seconds": round(generation_time, 3),
+                    "seconds_per_image": round(generation_time / len(images), 3),
+                    "request_seconds": round(request_seconds, 3),
+                }
+            }
+
+        except Exception as e:
+            error_message = str(e)
+            print(f"Error during batch generation: {error_message}")
+            return {
+                "status": "error",
+                "error": error_message,
+                "traceback": traceback.format_exc() if 'traceback' in sys.modules else None
+            }
+
+    @modal.method()
+    def feature_cache_report(
+        self,
+        model_id: str,
+        prompts: Optional[List[str]] = None,
+        seeds: Optional[List[int]] = None,
+        intervals: Optional[List[int]] = None,
+        num_inference_steps: int = 30,
+        guidance_scale: float = 7.5
+    ) -> Dict[str, Any]:
+        """
+        Quality and latency of UNet feature caching against the plain UNet
+
+        Every setting generates the same prompts with the same fixed seeds, so
+        the images differ only by the steps that reused cached features.
+
+        Args:
+            model_id: ID of the LoRA model to use
+            prompts: Prompts to generate (FEATURE_CACHE_REPORT_PROMPTS by default)
+            seeds: Seed per prompt (0, 1, ... by default)
+            intervals: Refresh intervals to compare (FEATURE_CACHE_REPORT_INTERVALS by default)
+            num_inference_steps: Number of diffusion steps (default 30)
+            guidance_scale: Classifier-free guidance scale (default 7.5)
+
+        Returns:
+            Seconds per image of the baseline, and per interval the seconds
+            per image, speedup and PSNR of its images against the baseline's
+        """
+        try:
+            prompts = prompts or FEATURE_CACHE_REPORT_PROMPTS
+            seeds = seeds or list(range(len(prompts)))
+            intervals = intervals or FEATURE_CACHE_REPORT_INTERVALS
+            if len(seeds) != len(prompts):
+                return {"status": "error", "error": f"Got {len(prompts)} prompts and {len(seeds)} seeds"}
+
+            try:
+                self._activate_adapter(model_id)
+            except FileNotFoundError as e:
+                return {
+                    "status": "error",
+                    "error": str(e),
+                    "model_id": model_id
+                }
+            final_prompts = [prepare_prompt(prompt, self.instance_prompt) for prompt in prompts]
+            negative_prompts = [DEFAULT_NEGATIVE_PROMPT] * len(prompts)
+
+            def run(interval: int) -> Tuple[List[Image.Image], float]:
+                start_time = time.time()
+                images, _ = self._denoise(
+                    final_prompts, seeds, negative_prompts, num_inference_steps, guidance_scale,
+                    feature_cache_interval=interval
+                )
+                return images, (time.time() - start_time) / len(images)
+
+            # Warm-up, so the baseline does not pay for kernel selection
+            run(1)
+            baseline_images, baseline_seconds = run(1)
+            print(f"Feature cache baseline: {baseline_seconds:.3f} seconds per image")
+
+            results = []
+            for interval in intervals:
+                images, seconds = run(interval)
+                psnr = [image_psnr(reference, image) for reference, image in zip(baseline_images, images)]
+                results.append({
+                    "interval": interval,
+                    "seconds_per_image": round(seconds, 3),
+                    "speedup": round(baseline_seconds / seconds, 2),
+                    "psnr_db_mean": round(sum(psnr) / len(psnr), 2),
+                    "psnr_db_min": round(min(psnr), 2),
+                })
+                print(f"Feature cache interval {interval}: {seconds:.3f} seconds per image, "
+                      f"{results[-1]['speedup']}x, PSNR {results[-1]['psnr_db_mean']} dB")
+
+            return {
+                "status": "success",
+                "model_id": model_id,
+                "images": len(prompts),
+                "seeds": seeds,
+                "steps": num_inference_steps,
+                "guidance_scale": guidance_scale,
+                "baseline_seconds_per_image": round(baseline_seconds, 3),
+                "intervals": results,
+            }
+
+        except Exception as e:
+            error_message = str(e)
+            print(f"Error during feature cache report: {error_message}")
+            return {
+                "status": "error",
+                "error": error_message,
+                "traceback": traceback.format_exc() if 'traceback' in sys.modules else None
+            }
+
+    @modal.method()
+    def stats(self) -> Dict[str, Any]:
+        """First-request and steady-state latency and adapter cache hit rates of this container"""
+        return self._worker_stats()
+
+
+class BatchingWorker(GenerationWorker):
+    """
+    Generation worker that batches concurrent requests
+
+    The container accepts several inputs at once. Requests with the same
+    batch key that arrive within a short window are denoised as one batch
+    by a single GPU thread, and each caller gets back its own image.
+    """
+
+    @modal.exit()
+    def stop_batcher(self):
+        self.batcher.close()
+
+    def _start_batcher(self):
+        self.batcher = RequestBatcher(
+            self._run_batch,
+            max_batch_size=lambda key: self.max_batch_size(key[2], key[3], key[4]),
+            window_seconds=BATCH_WINDOW_SECONDS
+        )
+
+    def _batch_key(
+        self,
+        model_id: str,
+        num_inference_steps: int,
+        guidance_scale: float,
+        height: int,
+        width: int,
+        cfg_fraction: float,
+        feature_cache_interval: int
+    ) -> Tuple:
+        """Requests with equal keys can share a batch"""
+        return (model_id, num_inference_steps, guidance_scale, height, width, cfg_fraction, feature_cache_interval)
+
+    def _run_batch(self, key: Tuple, payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Generate the images of a batch of compatible requests (runs on the batcher thread)"""
+        model_id, num_inference_steps, guidance_scale, height, width, cfg_fraction, feature_cache_interval = key
+        batch_start = time.time()
+        # Fuse the adapter when this batch and the requests queued behind it keep the model busy
+        queued = sum(depth for other, depth in self.batcher.queue_depths().items() if other[0] == model_id)
+        adapter_timings = self._activate_adapter(model_id, fused=len(payloads) + queued >= FUSE_MIN_QUEUED)
+
+        final_prompts = [prepare_prompt(payload["prompt"], self.instance_prompt) for payload in payloads]
+        start_time = time.time()
+        images, _ = self._denoise(
+            final_prompts,
+            [payload["seed"] for payload in payloads],
+            [payload["negative_prompt"] for payload in payloads],
+            num_inference_steps,
+            guidance_scale,
+            height,
+            width,
+            cfg_fraction,
+            feature_cache_interval
+        )
+        denoise_seconds = time.time() - start_time
+        print(f"Batch of {len(images)} images for model {model_id} generated in {denoise_seconds:.2f} seconds")
+
+        return [
+            {
+                "image": image,
+                "final_prompt": final_prompt,
+                "batch_start": batch_start,
+                "batch_size": len(images),
+                "denoise_seconds": denoise_seconds,
+                "adapter_timings": adapter_timings,
+            }
+            for image, final_prompt in zip(images, final_prompts)
+        ]
+
+    @modal.method()
+    def generate(
+        self,
+        model_id: str,
+        prompt: str,
+        num_inference_steps: int = 30,
+        guidance_scale: float = 7.5,
+        negative_prompt: str = DEFAULT_NEGATIVE_PROMPT,
+        seed: Optional[int] = None,
+        height: int = DEFAULT_RESOLUTION,
+        width: int = DEFAULT_RESOLUTION,
+        tier: Optional[str] = None,
+        feature_cache_interval: int = 1,
+        output: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Generate an image, batched with concurrent compatible requests
+
+        Takes the same arguments as Generator.generate plus the resolution
+        (which a tier replaces), and returns the same result with the batch
+        size and queueing delay in its timings (seeded requests are served
+        from the result cache when possible).
+        """
+        request_start = time.time()
+        try:
+            num_inference_steps, guidance_scale, cfg_fraction, height, width = resolve_tier(
+                tier, num_inference_steps, guidance_scale, height, width
+            )
+            output = resolve_output(output)
+            requested_seed = seed
+            if seed is None:
+                seed = int(time.time()) % 1000000
+                print(f"No seed provided, using random seed: {seed}")
+
+            run_timings = {}
+
+            def compute() -> Tuple[bytes, Dict[str, Any]]:
+                key = self._batch_key(
+                    model_id, num_inference_steps, guidance_scale, height, width, cfg_fraction, feature_cache_interval
+                )
+                batch_output = self.batcher.submit(key, {
+                    "model_id": model_id,
+                    "prompt": prompt,
+                    "negative_prompt": negative_prompt,
+                    "seed": seed,
+                })
+                run_timings.update(
+                    batch_output["adapter_timings"],
+                    queue_seconds=round(batch_output["batch_start"] - request_start, 3),
+                    batch_size=batch_output["batch_size"],
+                    denoise_seconds=round(batch_output["denoise_seconds"], 3)
+                )
+                # Encoding runs in the caller's thread, off the GPU thread
+                data, image_info = self.image_output.encode(batch_output["image"], output)
+                return data, {"final_prompt": batch_output["final_prompt"], "image": image_info}
+
+            try:
+                data, meta, cache_status = self._cached_generation(
+                    model_id, prompt, negative_prompt, num_inference_steps, guidance_scale,
+                    requested_seed, height, width, compute,
+                    cfg_fraction=cfg_fraction, feature_cache_interval=feature_cache_interval, output=output
+                )
+            except FileNotFoundError as e:
+                return {
+                    "status": "error",
+                    "error": str(e),
+                    "model_id": model_id
+                }
+
+            image_fields = self.image_output.deliver(
+                data, meta["image"], output, name=f"{model_id}/{uuid.uuid4().hex}"
+            )
+
+            request_seconds = time.time() - request_start
+            first_request = self._record_latency(request_seconds)
+
+            return {
+                "status": "success",
+                **image_fields,
+                "prompt": prompt,
+                "final_prompt": meta["final_prompt"],
+                "seed": seed,
+                "tier": tier,
+                "steps": num_inference_steps,
+                "guidance_scale": guidance_scale,
+                "width": width,
+                "height": height,
+                "feature_cache_interval": feature_cache_interval,
+                "generation_time": f"{run_timings.get('denoise_seconds', 0.0):.2f}s",
+                "timings": {
+                    "first_request": first_request,
+                    "pipeline_load_seconds": round(self.pipeline_load_seconds, 3) if first_request else 0.0,
+                    "result_cache": cache_status,
+                    **run_timings,
+                    "request_seconds": round(request_seconds, 3),
+                }
+            }
+
+        except Exception as e:
+            error_message = str(e)
+            print(f"Error during image generation: {error_message}")
+            return {
+                "status": "error",
+                "error": error_message,
+                "traceback": traceback.format_exc() if 'traceback' in sys.modules else None
+            }
+
+    @modal.method()
+    def stats(self) -> Dict[str, Any]:
+        """Worker stats plus queueing delay, batch-size histogram and latency percentiles"""
+        return {**self._worker_stats(), "batching": self.batcher.metrics()}
+
+
+@app.cls(
+    gpu="T4",
+    timeout=600,
+    volumes={VOLUME_MOUNT_PATH: volume},
+    image=image,
+    scaledown_window=CONTAINER_IDLE_SECONDS
+)
+@modal.concurrent(max_inputs=MAX_CONCURRENT_INPUTS)
+class GenerationServer(BatchingWorker):
+    """Batching server; requests share a batch when model, steps, guidance and resolution match"""
+
+    @modal.enter()
+    def load_pipeline(self):
+        self._load()
+        self._start_batcher()
+
+
+@app.cls(
+    gpu="T4",
+    timeout=600,
+    volumes={VOLUME_MOUNT_PATH: volume},
+    image=image,
+    scaledown_window=CONTAINER_IDLE_SECONDS
+)
+@modal.concurrent(max_inputs=MAX_CONCURRENT_INPUTS)
+class MixedAdapterServer(BatchingWorker):
+    """
+    Batching server whose batches can mix models
+
+    Requests only need matching steps, guidance and resolution to share a
+    batch. Adapters stay resident in per-sample slots (multi_lora) instead
+    of being loaded into the UNet, so the long tail of rarely used models
+    can be batched together.
+    """
+
+    @modal.enter()
+    def load_pipeline(self):
+        self._load()
+        self.multi_lora = MultiAdapterLoRA(self.pipe.unet, max_adapters=MULTI_LORA_SLOTS)
+        self._start_batcher()
+
+    def _batch_key(
+        self,
+        model_id: str,
+        num_inference_steps: int,
+        guidance_scale: float,
+        height: int,
+        width: int,
+        cfg_fraction: float,
+        feature_cache_interval: int
+    ) -> Tuple:
+        return (None, num_inference_steps, guidance_scale, height, width, cfg_fraction, feature_cache_interval)
+
+    def _run_batch(self, key: Tuple, payloads: List[Dict[str, Any]]) -> List[Any]:
+        """Generate a batch whose samples may each use a different adapter"""
+        _, num_inference_steps, guidance_scale, height, width, cfg_fraction, feature_cache_interval = key
+        batch_start = time.time()
+
+        # Resolve every model of the batch once; a missing model only fails its own requests
+        models = {}
+        for model_id in dict.fromkeys(payload["model_id"] for payload in payloads):
+            start_time = time.time()
+            try:
+                model_dir, adapter_model_path = self._model_paths(model_id)
+                state_dict, cache_info = self.adapter_cache.get(adapter_model_path)
+                slot = self.multi_lora.load(
+                    cache_info["sha256"],
+                    state_dict,
+                    scale=adapter_scale(adapter_model_path),
+                    protected=[model["slot"] for model in models.values() if "slot" in model]
+                )
+                models[model_id] = {
+                    "slot": slot,
+                    "instance_prompt": read_instance_prompt(model_dir),
+                    "adapter_timings": {
+                        "adapter_swapped": False,
+                        "adapter_tier": cache_info["tier"],
+                        "adapter_seconds": round(time.time() - start_time, 3),
+                    },
+                }
+            except Exception as e:
+                models[model_id] = {"error": e}
+
+        runnable = [i for i, payload in enumerate(payloads) if "error" not in models[payload["model_id"]]]
+        results: List[Any] = [models[payload["model_id"]].get("error") for payload in payloads]
+        if not runnable:
+            return results
+
+        final_prompts = [
+            prepare_prompt(payloads[i]["prompt"], models[payloads[i]["model_id"]]["instance_prompt"])
+            for i in runnable
+        ]
+        start_time = time.time()
+        images, _ = self._denoise(
+            final_prompts,
+            [payloads[i]["seed"] for i in runnable],
+            [payloads[i]["negative_prompt"] for i in runnable],
+            num_inference_steps,
+            guidance_scale,
+            height,
+            width,
+            cfg_fraction,
+            feature_cache_interval,
+            adapter_slots=[models[payloads[i]["model_id"]]["slot"] for i in runnable]
+        )
+        denoise_seconds = time.time() - start_time
+        print(f"Mixed batch of {len(images)} images for {len(models)} models "
+              f"generated in {denoise_seconds:.2f} seconds")
+
+        for i, image, final_prompt in zip(runnable, images, final_prompts):
+            results[i] = {
+                "image": image,
+                "final_prompt": final_prompt,
+                "batch_start": batch_start,
+                "batch_size": len(images),
+                "denoise_seconds": denoise_seconds,
+                "adapter_timings": models[payloads[i]["model_id"]]["adapter_timings"],
+            }
+        return results
+
+    @modal.method()
+    def stats(self) -> Dict[str, Any]:
+        """Batching server stats plus resident adapter slots"""
+        return {**self._worker_stats(), "batching": self.batcher.metrics(), "multi_lora": self.multi_lora.metrics()}
+
+
+@app.function(image=image, timeout=600)
+def generate_image(
+    model_id: str,
+    prompt: str,
+    num_inference_steps: int = 30,
+    guidance_scale: float = 7.5,
+    negative_prompt: str = DEFAULT_NEGATIVE_PROMPT,
+    seed: Optional[int] = None,
+    tier: Optional[str] = None,
+    feature_cache_interval: int = 1,
+    output: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Generate an image using a LoRA fine-tuned model
+
+    Kept for callers that look the function up by name; the work runs on a
+    warm Generator container.
+    """
+    return Generator().generate.remote(
+        model_id,
+        prompt,
+        num_inference_steps=num_inference_steps,
+        guidance_scale=guidance_scale,
+        negative_prompt=negative_prompt,
+        seed=seed,
+        tier=tier,
+        feature_cache_interval=feature_cache_interval,
+        output=output
+    )
+
 @app.local_entrypoint()
 def main(input: str = None):
     """
@@ -212,25 +1303,89 @@ def main(input: str = None):
         prompt = generation_data.get('prompt', '')
         num_inference_steps = generation_data.get('numInferenceSteps', 30)
         guidance_scale = generation_data.get('guidanceScale', 7.5)
-        negative_prompt = generation_data.get('negativePrompt', 'ugly, blurry, low quality, distorted')
+        negative_prompt = generation_data.get('negativePrompt', DEFAULT_NEGATIVE_PROMPT)
         seed = generation_data.get('seed')
+        tier = generation_data.get('tier')  # draft / standard / final
+        feature_cache_interval = generation_data.get('featureCacheInterval', 1)
+        # Image format / quality / destination / thumbnail, see image_output (base64 PNG by default)
+        output = generation_data.get('output')
         output_path = generation_data.get('outputPath')
         
         print(f"Starting image generation for model: {model_id}")
         print(f"Prompt: {prompt}")
         
-        # Generate the image
-        result = generate_image.remote(
-            model_id,
-            prompt,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            negative_prompt=negative_prompt,
-            seed=seed
-        )
+        if generation_data.get('featureCacheReport'):
+            # Feature caching quality / latency against the plain UNet, with fixed seeds
+            result = Generator().feature_cache_report.remote(
+                model_id,
+                prompts=generation_data.get('prompts'),
+                seeds=generation_data.get('seeds'),
+                intervals=generation_data.get('featureCacheIntervals'),
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale
+            )
+        elif generation_data.get('stream'):
+            # Previews every few steps, then the final image
+            preview_path = generation_data.get('previewPath')
+            for event in Generator().generate_stream.remote_gen(
+                model_id,
+                prompt,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                negative_prompt=negative_prompt,
+                seed=seed,
+                tier=tier,
+                feature_cache_interval=feature_cache_interval,
+                output=output,
+                preview_every=generation_data.get('previewEvery', PREVIEW_EVERY_STEPS)
+            ):
+                if event["type"] == "final":
+                    result = event
+                    break
+                print(f"Preview at step {event['step']}/{event['total_steps']} ({event['elapsed_seconds']:.2f}s)")
+                if preview_path:
+                    # Replaced atomically so readers never see a partial file
+                    temp_path = f"{preview_path}.tmp"
+                    with open(temp_path, 'wb') as f:
+                        f.write(base64.b64decode(event["image_base64"]))
+                    os.replace(temp_path, preview_path)
+        elif generation_data.get('prompts'):
+            # Several images with one model, denoised together in batches
+            result = Generator().generate_batch.remote(
+                model_id,
+                generation_data['prompts'],
+                seeds=generation_data.get('seeds'),
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                negative_prompt=negative_prompt,
+                tier=tier,
+                feature_cache_interval=feature_cache_interval,
+                output=output
+            )
+        else:
+            # Generate the image, batched with other concurrent requests when asked to
+            if generation_data.get('batching') == 'mixed':
+                generator = MixedAdapterServer()
+            elif generation_data.get('batching'):
+                generator = GenerationServer()
+            else:
+                generator = Generator()
+            result = generator.generate.remote(
+                model_id,
+                prompt,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                negative_prompt=negative_prompt,
+                seed=seed,
+                tier=tier,
+                feature_cache_interval=feature_cache_interval,
+                output=output
+            )
         
         # Write output to file if specified
         if output_path:
+            # Raw image bytes go to files next to the JSON, which references them by path
+            result = save_binary_outputs(result, os.path.splitext(output_path)[0])
             with open(output_path, 'w') as f:
                 json.dump(result, f, indent=2)
         
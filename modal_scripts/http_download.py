@@ -0,0 +1,158 @@
+"""
+Concurrent image downloads for imageUrl inputs.
+
+Jobs that source their images from storage URLs spend most of their
+preprocessing time waiting on round-trips when the images are fetched one at
+a time. download_images fetches them in a bounded thread pool over a single
+pooled requests.Session, with connect/read timeouts and retries with
+exponential backoff. Each body is streamed into one buffer, which is handed
+to a callback in the same worker thread without being copied, so decoding
+overlaps the remaining downloads.
+"""
+
+import io
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+DOWNLOAD_WORKERS = 8
+CONNECT_TIMEOUT = 5.0  # Seconds
+READ_TIMEOUT = 30.0  # Seconds between received bytes, not for the whole body
+MAX_ATTEMPTS = 4
+BACKOFF_SECONDS = 0.5  # Doubled after every failed attempt
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+CHUNK_SIZE = 256 * 1024
+
+
+class _RetryableStatus(Exception):
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(f"HTTP {status_code}")
+        self.retry_after = retry_after
+
+
+def create_session(pool_size: int = DOWNLOAD_WORKERS):
+    """requests.Session whose connection pool can serve pool_size threads at once"""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    # Retries are handled in fetch_bytes so failures while reading the body are retried too
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_bytes(
+    session,
+    url: str,
+    timeout: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+    max_attempts: int = MAX_ATTEMPTS
+) -> Tuple[io.BytesIO, int]:
+    """
+    Download a URL, retrying connection errors, timeouts and transient HTTP statuses
+
+    Returns:
+        The response body, rewound to its start, and the number of attempts it took
+    """
+    import requests
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            with session.get(url, stream=True, timeout=timeout) as response:
+                if response.status_code in RETRY_STATUSES and attempt < max_attempts:
+                    retry_after = response.headers.get("Retry-After", "")
+                    raise _RetryableStatus(
+                        response.status_code,
+                        float(retry_after) if retry_after.isdigit() else None
+                    )
+                response.raise_for_status()
+
+                body = io.BytesIO()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    body.write(chunk)
+                body.seek(0)
+                return body, attempt
+
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError, _RetryableStatus) as e:
+            if attempt == max_attempts:
+                raise
+            delay = BACKOFF_SECONDS * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            if isinstance(e, _RetryableStatus) and e.retry_after is not None:
+                delay = max(delay, e.retry_after)
+            print(f"Download of {url} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def download_images(
+    urls: Dict[int, str],
+    on_image: Callable[[int, io.BytesIO], Any],
+    max_workers: int = DOWNLOAD_WORKERS,
+    session=None
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Download images concurrently and pass each body to on_image as it arrives
+
+    Args:
+        urls: Image index to URL
+        on_image: Called with (index, body) in the downloading thread, body
+            being the BytesIO the response was read into; its return value
+            is kept in the record
+        max_workers: Maximum number of concurrent downloads
+        session: Session to use (a pooled one is created and closed if omitted)
+
+    Returns:
+        One record per index with its status ("downloaded" or "failed"),
+        on_image result, error, size in bytes, attempts and timings
+    """
+    if not urls:
+        return {}
+
+    workers = max(1, min(max_workers, len(urls)))
+    own_session = session is None
+    session = session or create_session(workers)
+
+    def run(idx: int, url: str) -> Dict[str, Any]:
+        start_time = time.time()
+        record = {
+            "index": idx,
+            "url": url,
+            "status": "failed",
+            "result": None,
+            "error": None,
+            "bytes": 0,
+            "attempts": 0,
+        }
+        try:
+            body, record["attempts"] = fetch_bytes(session, url)
+            record["bytes"] = body.getbuffer().nbytes
+            record["download_seconds"] = round(time.time() - start_time, 3)
+        except Exception as e:
+            print(f"Failed to download image {idx} from {url}: {e}")
+            record["error"] = str(e)
+            record["seconds"] = round(time.time() - start_time, 3)
+            return record
+
+        try:
+            record["result"] = on_image(idx, body)
+            record["status"] = "downloaded"
+        except Exception as e:
+            print(f"Error processing image {idx}: {e}")
+            record["error"] = str(e)
+        record["seconds"] = round(time.time() - start_time, 3)
+        return record
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run, idx, url) for idx, url in urls.items()]
+            records = {}
+            for future in futures:
+                record = future.result()
+                records[record["index"]] = record
+    finally:
+        if own_session:
+            session.close()
+
+    return records
@@ -0,0 +1,222 @@
+"""
+Compact image output for generation and training results.
+
+Results used to carry every image as a base64 PNG string, which the local
+entrypoints then wrote into JSON files for the Node routes: a third larger
+than the image itself, after a slow lossless PNG encode. The output options
+of a request choose instead:
+
+- format: "png", "webp" or "jpeg", with a quality for WebP and JPEG,
+- destination: "base64" (the image_base64 field, as before), "bytes" (raw
+  bytes, which Modal transfers without base64; the entrypoints write them to
+  a file next to the JSON result) or "volume" (written to the volume, the
+  result only carries its path),
+- thumbnail: also return a small base64 JPEG, e.g. for list views.
+
+Without options, results are unchanged (base64 PNG). Every result also
+carries a small reference dict: format, content type, size, dimensions,
+encode seconds and where the image went. ImageOutput keeps encode time and
+size totals per format.
+
+PIL is only imported where an image is decoded, so the local entrypoints can
+import this module without Pillow installed.
+"""
+
+import io
+import os
+import time
+import uuid
+import base64
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# format -> (PIL format, content type, file extension)
+OUTPUT_FORMATS = {
+    "png": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+OUTPUT_DESTINATIONS = ("base64", "bytes", "volume")
+DEFAULT_OUTPUT = {"format": "png", "quality": None, "destination": "base64", "thumbnail": False}
+DEFAULT_QUALITY = {"webp": 85, "jpeg": 90}
+OUTPUTS_DIRNAME = "outputs"  # Volume folder of "volume" outputs
+THUMBNAIL_SIZE = 128
+THUMBNAIL_QUALITY = 75
+
+
+def resolve_output(options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Output options of a request with the defaults filled in"""
+    resolved = dict(DEFAULT_OUTPUT, **(options or {}))
+    image_format = str(resolved["format"]).lower()
+    image_format = "jpeg" if image_format == "jpg" else image_format
+    if image_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{resolved['format']}', expected one of: {', '.join(OUTPUT_FORMATS)}")
+    if resolved["destination"] not in OUTPUT_DESTINATIONS:
+        raise ValueError(
+            f"Unknown output destination '{resolved['destination']}', "
+            f"expected one of: {', '.join(OUTPUT_DESTINATIONS)}"
+        )
+    resolved["format"] = image_format
+    if image_format == "png":
+        resolved["quality"] = None
+    elif resolved["quality"] is None:
+        resolved["quality"] = DEFAULT_QUALITY[image_format]
+    return resolved
+
+
+def encode_image(image: "Image.Image", image_format: str = "png", quality: Optional[int] = None) -> bytes:
+    """Encode an image in one of OUTPUT_FORMATS"""
+    buffered = io.BytesIO()
+    if image_format == "png":
+        image.save(buffered, format="PNG")
+    elif image_format == "webp":
+        image.save(buffered, format="WEBP", quality=quality)
+    else:
+        image.convert("RGB").save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+def make_thumbnail(image: "Image.Image", size: int = THUMBNAIL_SIZE) -> str:
+    """Base64 JPEG of an image scaled to fit size x size"""
+    thumbnail = image.convert("RGB")
+    thumbnail.thumbnail((size, size))
+    return base64.b64encode(encode_image(thumbnail, "jpeg", THUMBNAIL_QUALITY)).decode()
+
+
+def save_binary_outputs(result: Any, base_path: str) -> Any:
+    """
+    Write the raw bytes of "bytes" outputs in a result to files next to base_path
+
+    Each reference's data is replaced by the path of its file
+    (<base_path>.<n>.<extension>), so the result can be written as JSON.
+    """
+    count = 0
+
+    def visit(value: Any) -> Any:
+        nonlocal count
+        if isinstance(value, dict):
+            if isinstance(value.get("data"), bytes) and value.get("format") in OUTPUT_FORMATS:
+                path = f"{base_path}.{count}.{OUTPUT_FORMATS[value['format']][2]}"
+                count += 1
+                with open(path, "wb") as f:
+                    f.write(value["data"])
+                value = {k: v for k, v in value.items() if k != "data"}
+                value["local_path"] = path
+                return value
+            return {k: visit(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [visit(v) for v in value]
+        return value
+
+    return visit(result)
+
+
+class ImageOutput:
+    """
+    Encodes result images and delivers them as their request asked
+
+    Args:
+        volume_root: Directory that "volume" outputs are written under
+        commit: Called after writing an output to the volume (e.g. the
+            volume's commit method), so other containers can read it
+    """
+
+    def __init__(self, volume_root: Optional[str] = None, commit: Optional[Callable[[], Any]] = None):
+        self.volume_root = volume_root
+        self.commit = commit
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def encode(self, image: "Image.Image", options: Dict[str, Any]) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        Encode an image as resolved by resolve_output
+
+        Returns:
+            The encoded bytes and their reference info (format, content type,
+            bytes, width, height, encode seconds)
+        """
+        image_format = options["format"]
+        start_time = time.time()
+        data = encode_image(image, image_format, options["quality"])
+        encode_seconds = time.time() - start_time
+
+        with self._lock:
+            stats = self._stats.setdefault(image_format, {"images": 0, "bytes": 0, "encode_seconds": 0.0})
+            stats["images"] += 1
+            stats["bytes"] += len(data)
+            stats["encode_seconds"] += encode_seconds
+
+        return data, {
+            "format": image_format,
+            "content_type": OUTPUT_FORMATS[image_format][1],
+            "quality": options["quality"],
+            "bytes": len(data),
+            "width": image.width,
+            "height": image.height,
+            "encode_seconds": round(encode_seconds, 4),
+        }
+
+    def deliver(
+        self,
+        data: bytes,
+        info: Dict[str, Any],
+        options: Dict[str, Any],
+        field: str = "image",
+        name: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Result fields of an encoded image
+
+        Args:
+            data: Bytes returned by encode
+            info: Reference info returned by encode
+            options: Output options resolved by resolve_output
+            field: Name of the reference field; the base64 image and the
+                thumbnail go in <field>_base64 and <field>_thumbnail_base64
+            name: Path of a "volume" output under volume_root, without
+                extension (a random name by default)
+
+        Returns:
+            {field: reference} plus the base64 image and thumbnail when asked for
+        """
+        destination = options["destination"]
+        reference = dict(info, destination=destination)
+        fields: Dict[str, Any] = {field: reference}
+
+        if destination == "base64":
+            fields[f"{field}_base64"] = base64.b64encode(data).decode()
+        elif destination == "bytes":
+            reference["data"] = data
+        else:
+            if self.volume_root is None:
+                raise ValueError("No volume directory configured for volume outputs")
+            path = os.path.join(self.volume_root, f"{name or uuid.uuid4().hex}.{OUTPUT_FORMATS[info['format']][2]}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            if self.commit is not None:
+                self.commit()
+            reference["path"] = path
+
+        if options.get("thumbnail"):
+            from PIL import Image
+
+            fields[f"{field}_thumbnail_base64"] = make_thumbnail(Image.open(io.BytesIO(data)))
+        return fields
+
+    def metrics(self) -> Dict[str, Any]:
+        """Images, mean size and mean encode seconds per format"""
+        with self._lock:
+            return {
+                image_format: {
+                    "images": int(stats["images"]),
+                    "mean_bytes": round(stats["bytes"] / stats["images"]),
+                    "mean_encode_seconds": round(stats["encode_seconds"] / stats["images"], 4),
+                }
+                for image_format, stats in self._stats.items()
+            }
@@ -0,0 +1,486 @@
+"""
+Per-image preprocessing for LoRA training uploads.
+
+The work for each image (decode, crop, resize, blur, autocontrast, save) is
+independent, so it runs in a process pool sized to the CPUs the
+container is allowed to use. PIL and numpy are imported inside the worker so
+this module stays importable from the local entrypoint. Each worker also
+returns a small grayscale thumbnail for the batch screening in
+image_screening.py.
+
+Processed outputs can be kept in a content-addressed cache shared across jobs:
+the key is a hash of the raw upload bytes plus the preprocessing parameters,
+so retraining with the same photos only hard links the cached file into the
+new training directory.
+
+decode_to_target is the shared decode path for every trainer: JPEGs are
+decoded at a reduced scale close to the target size and the center crop and
+resize are done in a single resample, so a 4000x3000 phone photo is never
+materialised at full resolution.
+"""
+
+import os
+import io
+import time
+import json
+import uuid
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Any, Iterable, Optional, Tuple, Union
+
+from input_stream import read_image_bytes
+from image_screening import SCREEN_SIZE, screen_images
+
+# Preprocessing parameters (standard Stable Diffusion resolution)
+TARGET_SIZE = 512
+BLUR_RADIUS = 0.5
+AUTOCONTRAST_CUTOFF = 0.5
+
+# Bump when the processing steps change so stale cache entries are not reused
+CACHE_VERSION = 3
+PREPROCESS_CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+
+def available_cpus() -> int:
+    """Number of CPUs this container may use, honouring cgroup quotas"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+
+    # Containers are usually limited by a CFS quota rather than CPU affinity
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpus = min(cpus, max(1, quota // period))
+        except (OSError, ValueError):
+            pass
+
+    return max(1, cpus)
+
+
+def _reset_peak_rss():
+    """Reset this process's peak RSS counter so the next reading covers one image (Linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except (OSError, ValueError):
+        pass
+
+    import resource
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def decode_to_target(img_bytes: Union[bytes, io.BytesIO], size: int = TARGET_SIZE) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Decode an upload directly to a size x size RGB center crop
+
+    JPEGs are decoded with draft mode, which lets libjpeg scale by 1/2, 1/4 or
+    1/8 during decoding while staying at or above the target size. Other
+    formats are reduced by resize's reducing_gap. The center crop is passed as
+    the resize box, so cropping and resizing take a single resample. Inputs
+    that already are size x size RGB are returned untouched.
+
+    Args:
+        img_bytes: Raw bytes of the upload, or a buffer holding them (read in
+            place, without a copy)
+        size: Side of the square output
+
+    Returns:
+        The decoded PIL image and decode statistics: original and decoded
+        size, whether the input already matched ("passthrough"), decode time
+        and the peak RSS of the process while decoding
+    """
+    from PIL import Image
+
+    _reset_peak_rss()
+    start_time = time.time()
+
+    img = Image.open(img_bytes if isinstance(img_bytes, io.BytesIO) else io.BytesIO(img_bytes))
+    original_size = img.size
+    passthrough = img.size == (size, size) and img.mode == "RGB"
+
+    if not passthrough:
+        if img.format == "JPEG":
+            img.draft("RGB", (size, size))
+        decoded_size = img.size
+
+        if img.mode != "RGB":
+            print(f"Converting image from {img.mode} to RGB")
+            img = img.convert("RGB")
+
+        # Center crop to a square and resize in one resample
+        side = min(img.width, img.height)
+        left = (img.width - side) / 2
+        top = (img.height - side) / 2
+        img = img.resize(
+            (size, size),
+            Image.LANCZOS,
+            box=(left, top, left + side, top + side),
+            reducing_gap=3.0
+        )
+    else:
+        img.load()
+        decoded_size = img.size
+
+    stats = {
+        "original_size": list(original_size),
+        "decoded_size": list(decoded_size),
+        "passthrough": passthrough,
+        "decode_seconds": round(time.time() - start_time, 4),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+    return img, stats
+
+
+def save_training_image(img, img_bytes: Union[bytes, io.BytesIO], output_path: str, format: str = "JPEG") -> bool:
+    """
+    Write a decoded training image, reusing the upload bytes when possible
+
+    An upload that decode_to_target passed through unchanged and that is
+    already in the requested format is copied byte for byte instead of being
+    re-encoded.
+
+    Returns:
+        Whether the image was re-encoded
+    """
+    if getattr(img, "format", None) == format:
+        with open(output_path, "wb") as f:
+            f.write(img_bytes.getbuffer() if isinstance(img_bytes, io.BytesIO) else img_bytes)
+        return False
+
+    img.save(output_path, format)
+    return True
+
+
+def cache_key(img_bytes: bytes) -> str:
+    """Content address of a processed image: raw upload bytes plus preprocessing parameters"""
+    params = json.dumps({
+        "version": CACHE_VERSION,
+        "target_size": TARGET_SIZE,
+        "blur_radius": BLUR_RADIUS,
+        "autocontrast_cutoff": AUTOCONTRAST_CUTOFF,
+    }, sort_keys=True)
+    digest = hashlib.sha256(img_bytes)
+    digest.update(params.encode())
+    return digest.hexdigest()
+
+
+def _cache_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key[:2], f"{key}.png")
+
+
+def _thumbnail_path(cached_path: str) -> str:
+    return f"{os.path.splitext(cached_path)[0]}.thumb.png"
+
+
+def _link(source: str, destination: str):
+    """
+    Hard link source to destination, copying when the filesystem has no hard links
+
+    Unlike a symlink, the job's file stays readable after evict_cache deletes
+    the cache entry, and relative cache paths need no resolving.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def evict_cache(cache_dir: str, max_bytes: int = PREPROCESS_CACHE_MAX_BYTES) -> int:
+    """
+    Delete least recently used cache entries until the cache fits in max_bytes
+
+    Entries are touched on every hit, so mtime order is LRU order. Training
+    directories hold hard links or copies of the entries they use (see _link),
+    so evicting an entry never breaks a job that is still running.
+
+    Returns:
+        Number of evicted entries
+    """
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            evicted += 1
+        except OSError:
+            pass
+
+    return evicted
+
+
+def process_image(
+    idx: int,
+    img_data: Dict[str, Any],
+    training_dir: str,
+    cache_dir: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Preprocess a single uploaded image and save it to the training directory
+
+    Never raises: failures are reported in the returned record so one bad
+    upload cannot take down the whole batch.
+
+    Args:
+        idx: Position of the image in the upload
+        img_data: Dictionary with the image (base64Data, or imagePath of a staged upload) and metadata
+        training_dir: Directory to write the processed image to
+        cache_dir: Shared cache of processed images; when set, outputs are stored
+            there and referenced from training_dir
+
+    Returns:
+        Record with the image index, status ("processed" or "failed"), output
+        path, failure reason, cache outcome ("hit", "miss" or None), screening
+        thumbnail, decode statistics (None on cache hits, see decode_to_target)
+        and processing time
+    """
+    start_time = time.time()
+    record = {
+        "index": idx,
+        "name": img_data.get("name"),
+        "status": "failed",
+        "path": None,
+        "error": None,
+        "cache": None,
+        "thumbnail": None,
+        "decode": None,
+    }
+
+    try:
+        # Decode the upload (read lazily so only images in flight are held in memory)
+        img_bytes = read_image_bytes(img_data)
+        img_path = f"{training_dir}/image_{idx}.png"
+
+        cached_path = None
+        if cache_dir:
+            cached_path = _cache_path(cache_dir, cache_key(img_bytes))
+            if os.path.exists(cached_path):
+                # Cache hit: refresh its LRU position and reference it
+                os.utime(cached_path)
+                _link(cached_path, img_path)
+                record["cache"] = "hit"
+                record["thumbnail"] = _load_thumbnail(cached_path)
+            else:
+                record["cache"] = "miss"
+
+        if record["cache"] != "hit":
+            record["thumbnail"], record["decode"] = _process_to_file(idx, img_bytes, cached_path or img_path)
+            if cached_path:
+                # Keep the thumbnail with the cache entry so hits can be screened too
+                from PIL import Image
+
+                thumbnail_path = _thumbnail_path(cached_path)
+                temp_path = f"{thumbnail_path}.{uuid.uuid4().hex}.tmp"
+                Image.fromarray(record["thumbnail"]).save(temp_path, format="PNG")
+                os.replace(temp_path, thumbnail_path)
+                _link(cached_path, img_path)
+
+        # Store a per-image caption next to the image when one was provided,
+        # and drop any caption left behind by an earlier upload
+        caption_path = f"{training_dir}/image_{idx}.txt"
+        caption = (img_data.get('caption') or '').strip()
+        if caption:
+            with open(caption_path, 'w') as f:
+                f.write(caption)
+        elif os.path.exists(caption_path):
+            os.remove(caption_path)
+
+        # Verify the file was saved
+        if os.path.exists(img_path):
+            print(f"Successfully saved and verified image: {img_path}")
+            record["status"] = "processed"
+            record["path"] = img_path
+        else:
+            print(f"ERROR: Failed to save image to {img_path}")
+            record["error"] = f"Failed to save image to {img_path}"
+
+    except Exception as e:
+        print(f"Error processing image {idx}: {str(e)}")
+        record["error"] = str(e)
+    finally:
+        record["seconds"] = round(time.time() - start_time, 3)
+
+    return record
+
+
+def _load_thumbnail(cached_path: str):
+    """Screening thumbnail stored with a cache entry (rebuilt from the output if it was evicted)"""
+    from PIL import Image
+    import numpy as np
+
+    thumbnail_path = _thumbnail_path(cached_path)
+    source = thumbnail_path if os.path.exists(thumbnail_path) else cached_path
+    with Image.open(source) as img:
+        return np.asarray(img.convert("L").resize((SCREEN_SIZE, SCREEN_SIZE), Image.BOX))
+
+
+def _process_to_file(idx: int, img_bytes: bytes, output_path: str):
+    """
+    Run the preprocessing steps on one decoded upload and write the result
+
+    Returns:
+        Grayscale SCREEN_SIZE x SCREEN_SIZE thumbnail (uint8 array) of the
+        cropped image, taken before blur and autocontrast so screening sees
+        the original sharpness and exposure, and the decode statistics
+    """
+    from PIL import Image, ImageOps, ImageFilter
+    import numpy as np
+
+    # Decode straight to a 512x512 (standard for Stable Diffusion) center crop
+    img, decode_stats = decode_to_target(img_bytes)
+
+    width, height = decode_stats["original_size"]
+    if width < 256 or height < 256:
+        print(f"Warning: Image {idx} is too small ({width}x{height}), might give poor results")
+
+    # Thumbnail for the batch quality screening
+    thumbnail = img.convert("L").resize((SCREEN_SIZE, SCREEN_SIZE), Image.BOX)
+
+    # Apply slight blur to reduce noise and improve stability
+    img = img.filter(ImageFilter.GaussianBlur(radius=BLUR_RADIUS))
+
+    # Normalize image contrast for better stability
+    img = ImageOps.autocontrast(img, cutoff=AUTOCONTRAST_CUTOFF)
+
+    # Save processed image (via a temp file so concurrent jobs never see a partial write)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    temp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    img.save(temp_path, format="PNG")
+    os.replace(temp_path, output_path)
+
+    return np.asarray(thumbnail), decode_stats
+
+
+def process_images(
+    image_data_list: Iterable[Dict[str, Any]],
+    training_dir: str,
+    parallel: bool = True,
+    max_workers: Optional[int] = None,
+    cache_dir: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """
+    Preprocess a batch of uploaded images, optionally fanning them out to a process pool
+
+    Images are submitted lazily with a bounded number in flight, so the input
+    can be a generator. Records are always returned in input order.
+
+    Args:
+        image_data_list: Dictionaries with the images (see process_image) and metadata
+        training_dir: Directory to write the processed images to
+        parallel: Whether to use a process pool
+        max_workers: Pool size (defaults to the CPUs available to the container)
+        cache_dir: Shared cache of processed images (see process_image)
+
+    Returns:
+        One record per input image (see process_image), in input order
+    """
+    workers = max_workers or available_cpus()
+    if not parallel or workers <= 1:
+        return [
+            process_image(idx, img_data, training_dir, cache_dir)
+            for idx, img_data in enumerate(image_data_list)
+        ]
+
+    records = []
+    pending = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for idx, img_data in enumerate(image_data_list):
+            pending.append((idx, executor.submit(process_image, idx, img_data, training_dir, cache_dir)))
+            # Keep at most two images per worker in flight
+            if len(pending) >= workers * 2:
+                records.append(_collect(*pending.pop(0)))
+        records.extend(_collect(idx, future) for idx, future in pending)
+
+    return records
+
+
+def _collect(idx: int, future) -> Dict[str, Any]:
+    """Wait for a pool result, turning worker crashes into a failed record"""
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"Error processing image {idx}: {str(e)}")
+        return {
+            "index": idx,
+            "name": None,
+            "status": "failed",
+            "path": None,
+            "error": str(e),
+            "cache": None,
+            "thumbnail": None,
+            "decode": None,
+            "seconds": None,
+        }
+
+
+def screen_records(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Run the batch quality screening over the processed images of an upload
+
+    Rejected images are marked "skipped" with the reason, and their files are
+    removed from the training directory. Thumbnails are dropped from the
+    records and replaced by the screening metrics.
+
+    Returns:
+        The same records, updated in place
+    """
+    processed = [record for record in records if record["status"] == "processed"]
+    decisions = screen_images([record["thumbnail"] for record in processed])
+
+    for record, decision in zip(processed, decisions):
+        record["screening"] = {
+            key: decision[key] for key in ("sharpness", "brightness", "contrast", "clipped_fraction")
+        }
+        if decision["keep"]:
+            continue
+
+        print(f"Dropping image {record['index']}: {decision['reason']}")
+        record["status"] = "skipped"
+        record["error"] = decision["reason"]
+        if decision["duplicate_of"] is not None:
+            record["duplicate_of"] = processed[decision["duplicate_of"]]["index"]
+
+        caption_path = f"{os.path.splitext(record['path'])[0]}.txt"
+        for path in (record["path"], caption_path):
+            if os.path.lexists(path):
+                os.remove(path)
+        record["path"] = None
+
+    for record in records:
+        record.pop("thumbnail", None)
+
+    return records
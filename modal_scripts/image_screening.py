@@ -0,0 +1,144 @@
+"""
+Batch quality screening for training uploads.
+
+Runs once over the whole upload on small grayscale thumbnails (produced by
+the preprocessing workers). All metrics are vectorised with numpy across the
+batch:
+
+- perceptual hash (DCT of a 32x32 downscale) to find near-duplicates,
+- Laplacian variance as a sharpness/blur score,
+- brightness, contrast and clipped-pixel fractions as exposure statistics.
+
+Near-duplicates and hopeless images are dropped before they reach the GPU.
+"""
+
+from typing import Dict, List, Any, Optional
+
+# Side of the square grayscale thumbnail the metrics are computed on
+SCREEN_SIZE = 128
+HASH_SIZE = 8  # Perceptual hash is HASH_SIZE x HASH_SIZE bits
+
+# Screening thresholds (calibrated on 512px crops downscaled to SCREEN_SIZE)
+DUPLICATE_MAX_DISTANCE = 10  # Hamming distance between hashes, out of 64 bits
+MIN_SHARPNESS = 25.0  # Laplacian variance; sharp photos score in the hundreds
+MIN_CONTRAST = 12.0  # Grayscale standard deviation
+MIN_BRIGHTNESS = 25.0
+MAX_BRIGHTNESS = 230.0
+MAX_CLIPPED_FRACTION = 0.6  # Share of pixels crushed to black or blown to white
+
+
+def _dct_matrix(size: int):
+    import numpy as np
+
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    return np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+
+
+def perceptual_hashes(thumbnails):
+    """
+    64-bit DCT perceptual hashes for a (N, SCREEN_SIZE, SCREEN_SIZE) batch
+
+    Returns:
+        (N, HASH_SIZE * HASH_SIZE) boolean array
+    """
+    import numpy as np
+
+    count = thumbnails.shape[0]
+    factor = SCREEN_SIZE // 32
+    small = thumbnails.reshape(count, 32, factor, 32, factor).mean(axis=(2, 4))
+
+    dct = _dct_matrix(32)
+    coefficients = dct @ small @ dct.T
+    low = coefficients[:, :HASH_SIZE, :HASH_SIZE].reshape(count, -1)
+
+    # Compare against the median, leaving out the DC term
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    return low > median
+
+
+def hamming_distances(hashes):
+    """Pairwise Hamming distances between boolean hashes, as an (N, N) array"""
+    import numpy as np
+
+    bits = hashes.astype(np.int32)
+    return bits @ (1 - bits).T + (1 - bits) @ bits.T
+
+
+def sharpness_scores(thumbnails):
+    """Variance of the 4-neighbour Laplacian per thumbnail (low means blurry)"""
+    laplacian = (
+        thumbnails[:, :-2, 1:-1] + thumbnails[:, 2:, 1:-1]
+        + thumbnails[:, 1:-1, :-2] + thumbnails[:, 1:-1, 2:]
+        - 4 * thumbnails[:, 1:-1, 1:-1]
+    )
+    return laplacian.var(axis=(1, 2))
+
+
+def screen_images(thumbnails: List[Any]) -> List[Dict[str, Any]]:
+    """
+    Score a batch of thumbnails and decide which images to keep
+
+    Hopeless images (too blurry, flat or badly exposed) are rejected first.
+    Among the rest, near-duplicates are grouped and only the sharpest copy of
+    each group is kept.
+
+    Args:
+        thumbnails: Grayscale uint8 arrays of shape (SCREEN_SIZE, SCREEN_SIZE)
+
+    Returns:
+        One decision per thumbnail, in input order, with "keep", "reason",
+        "duplicate_of" (index into thumbnails) and the computed metrics
+    """
+    import numpy as np
+
+    if not thumbnails:
+        return []
+
+    batch = np.stack(thumbnails).astype(np.float32)
+    brightness = batch.mean(axis=(1, 2))
+    contrast = batch.std(axis=(1, 2))
+    clipped = ((batch <= 8) | (batch >= 247)).mean(axis=(1, 2))
+    sharpness = sharpness_scores(batch)
+    distances = hamming_distances(perceptual_hashes(batch))
+
+    decisions = []
+    for i in range(len(thumbnails)):
+        reason = None
+        if brightness[i] < MIN_BRIGHTNESS:
+            reason = f"Image is too dark (brightness {brightness[i]:.1f})"
+        elif brightness[i] > MAX_BRIGHTNESS:
+            reason = f"Image is overexposed (brightness {brightness[i]:.1f})"
+        elif clipped[i] > MAX_CLIPPED_FRACTION:
+            reason = f"{clipped[i]:.0%} of pixels are clipped to black or white"
+        elif contrast[i] < MIN_CONTRAST:
+            reason = f"Image is nearly uniform (contrast {contrast[i]:.1f})"
+        elif sharpness[i] < MIN_SHARPNESS:
+            reason = f"Image is too blurry (sharpness {sharpness[i]:.1f})"
+
+        decisions.append({
+            "keep": reason is None,
+            "reason": reason,
+            "duplicate_of": None,
+            "sharpness": round(float(sharpness[i]), 1),
+            "brightness": round(float(brightness[i]), 1),
+            "contrast": round(float(contrast[i]), 1),
+            "clipped_fraction": round(float(clipped[i]), 3),
+        })
+
+    # Keep the sharpest image of each group of near-duplicates
+    kept: List[int] = []
+    for i in sorted(range(len(thumbnails)), key=lambda i: -sharpness[i]):
+        if not decisions[i]["keep"]:
+            continue
+        duplicate_of: Optional[int] = next(
+            (j for j in kept if distances[i, j] <= DUPLICATE_MAX_DISTANCE), None
+        )
+        if duplicate_of is None:
+            kept.append(i)
+        else:
+            decisions[i]["keep"] = False
+            decisions[i]["duplicate_of"] = duplicate_of
+            decisions[i]["reason"] = f"Near-duplicate (hash distance {int(distances[i, duplicate_of])})"
+
+    return decisions
@@ -0,0 +1,333 @@
+"""
+Streaming reader for training input files.
+
+Training input files hold every upload as a base64 string inside
+"imageDataList", so loading them with json.load (and then pickling the whole
+list into a remote call) costs several times the upload size in memory. The
+helpers here walk the file with a small pull parser instead: images are
+yielded one at a time, their base64 text is decoded chunk by chunk into a
+single reusable buffer, and stage_image_entries copies each one onto a Modal
+volume so remote preprocessing only receives small metadata dictionaries.
+"""
+
+import os
+import re
+import json
+import base64
+import binascii
+import tempfile
+from typing import Dict, List, Any, Iterator, Optional
+
+# Characters read from the input file per refill
+CHUNK_SIZE = 1 << 20
+
+_NON_WHITESPACE = re.compile(r"\S")
+_STRING_SPECIAL = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r"[\s,\]}]")
+
+
+class _JsonStream:
+    """Minimal JSON pull parser that only ever buffers a chunk of the file"""
+
+    def __init__(self, f, chunk_size: int = CHUNK_SIZE):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buf = ""
+        self._pos = 0
+
+    def _fill(self) -> bool:
+        data = self._f.read(self._chunk_size)
+        if not data:
+            return False
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _ensure(self, count: int):
+        while len(self._buf) - self._pos < count:
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON input")
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it ('' at end of input)"""
+        while True:
+            match = _NON_WHITESPACE.search(self._buf, self._pos)
+            if match:
+                self._pos = match.start()
+                return self._buf[self._pos]
+            self._pos = len(self._buf)
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected '{char}' in JSON input, found '{found or 'end of input'}'")
+        self._pos += 1
+
+    def iter_string_chunks(self) -> Iterator[str]:
+        """Yield the raw contents of the next string value in pieces (escape sequences are yielded whole)"""
+        self.expect('"')
+        while True:
+            match = _STRING_SPECIAL.search(self._buf, self._pos)
+            if match is None:
+                if self._pos < len(self._buf):
+                    yield self._buf[self._pos:]
+                self._pos = len(self._buf)
+                if not self._fill():
+                    raise ValueError("Unterminated string in JSON input")
+                continue
+
+            start = match.start()
+            if start > self._pos:
+                yield self._buf[self._pos:start]
+            self._pos = start
+
+            if self._buf[start] == '"':
+                self._pos += 1
+                return
+
+            # Escape sequence: make sure all of it is buffered before yielding it
+            self._ensure(2)
+            length = 6 if self._buf[self._pos + 1] == "u" else 2
+            self._ensure(length)
+            yield self._buf[self._pos:self._pos + length]
+            self._pos += length
+
+    def read_string(self) -> str:
+        return json.loads('"' + "".join(self.iter_string_chunks()) + '"')
+
+    def _read_scalar(self) -> Any:
+        self.peek()
+        while True:
+            match = _SCALAR_END.search(self._buf, self._pos)
+            if match or not self._fill():
+                break
+        end = match.start() if match else len(self._buf)
+        token = self._buf[self._pos:end]
+        self._pos = end
+        return json.loads(token)
+
+    def iter_object(self) -> Iterator[str]:
+        """Yield the keys of the next object; the caller must consume each value before resuming"""
+        self.expect("{")
+        if self.peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.read_string()
+            self.expect(":")
+            yield key
+            char = self.peek()
+            self._pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or '}}' in JSON object, found '{char or 'end of input'}'")
+
+    def iter_array(self) -> Iterator[int]:
+        """Yield the index of each element of the next array; the caller must consume each element"""
+        self.expect("[")
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            char = self.peek()
+            self._pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, found '{char or 'end of input'}'")
+
+    def read_value(self) -> Any:
+        char = self.peek()
+        if char == '"':
+            return self.read_string()
+        if char == "{":
+            return {key: self.read_value() for key in self.iter_object()}
+        if char == "[":
+            return [self.read_value() for _ in self.iter_array()]
+        return self._read_scalar()
+
+    def skip_value(self):
+        char = self.peek()
+        if char == '"':
+            for _ in self.iter_string_chunks():
+                pass
+        elif char == "{":
+            for _ in self.iter_object():
+                self.skip_value()
+        elif char == "[":
+            for _ in self.iter_array():
+                self.skip_value()
+        else:
+            self._read_scalar()
+
+
+def _decode_base64_into(chunks: Iterator[str], buffer: bytearray) -> int:
+    """
+    Decode streamed base64 text into the start of buffer, growing it if needed
+
+    Accepts an optional data URL prefix ("data:image/png;base64,").
+
+    Returns:
+        Number of decoded bytes written to buffer
+    """
+    size = 0
+    pending = ""
+    prefix_checked = False
+
+    for chunk in chunks:
+        if chunk.startswith("\\"):
+            # Escaped characters ("\/", "\n", ...) - whitespace is not part of the data
+            chunk = json.loads('"' + chunk + '"').strip()
+        pending += chunk
+
+        if not prefix_checked:
+            if len(pending) < 5 and "data:".startswith(pending):
+                continue
+            if pending.startswith("data:"):
+                comma = pending.find(",")
+                if comma == -1:
+                    continue
+                pending = pending[comma + 1:]
+            prefix_checked = True
+
+        usable = len(pending) - len(pending) % 4
+        if usable:
+            decoded = binascii.a2b_base64(pending[:usable])
+            buffer[size:size + len(decoded)] = decoded
+            size += len(decoded)
+            pending = pending[usable:]
+
+    if pending:
+        decoded = binascii.a2b_base64(pending + "=" * (-len(pending) % 4))
+        buffer[size:size + len(decoded)] = decoded
+        size += len(decoded)
+
+    return size
+
+
+def load_input_params(input_file: str, list_key: str = "imageDataList") -> Dict[str, Any]:
+    """
+    Read the top-level fields of a training input file without loading the images
+
+    The image list is skipped over as it is read, so memory use does not depend
+    on the size of the uploads.
+    """
+    params = {}
+    with open(input_file, "r", encoding="utf-8") as f:
+        stream = _JsonStream(f)
+        for key in stream.iter_object():
+            if key == list_key:
+                stream.skip_value()
+            else:
+                params[key] = stream.read_value()
+    return params
+
+
+def iter_image_entries(
+    input_file: str,
+    list_key: str = "imageDataList",
+    buffer: Optional[bytearray] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the entries of a training input file's image list one at a time
+
+    The base64Data field of each entry is decoded incrementally into a reusable
+    buffer and exposed as "imageBytes" (a memoryview). The view is released when
+    the next entry is produced, so copy it if it has to outlive the iteration.
+
+    Args:
+        input_file: Path to the JSON input file
+        list_key: Top-level key of the image list
+        buffer: Buffer to decode into (one is allocated if omitted)
+    """
+    buffer = buffer if buffer is not None else bytearray()
+
+    with open(input_file, "r", encoding="utf-8") as f:
+        stream = _JsonStream(f)
+        for key in stream.iter_object():
+            if key != list_key:
+                stream.skip_value()
+                continue
+
+            for _ in stream.iter_array():
+                if stream.peek() != "{":
+                    stream.skip_value()
+                    continue
+
+                entry = {}
+                view = None
+                for field in stream.iter_object():
+                    if field == "base64Data" and stream.peek() == '"':
+                        size = _decode_base64_into(stream.iter_string_chunks(), buffer)
+                        view = memoryview(buffer)[:size]
+                        entry["imageBytes"] = view
+                    else:
+                        entry[field] = stream.read_value()
+
+                yield entry
+
+                # The buffer is reused for the next image
+                if view is not None:
+                    view.release()
+
+
+def read_image_bytes(img_data: Dict[str, Any]) -> bytes:
+    """Raw bytes of an upload given inline (base64Data / imageBytes) or staged on a volume (imagePath)"""
+    if img_data.get("imagePath"):
+        with open(img_data["imagePath"], "rb") as f:
+            return f.read()
+    if img_data.get("imageBytes") is not None:
+        return bytes(img_data["imageBytes"])
+
+    encoded = img_data["base64Data"]
+    if encoded.startswith("data:"):
+        encoded = encoded.split(",", 1)[1]
+    return base64.b64decode(encoded)
+
+
+def stage_image_entries(
+    input_file: str,
+    volume,
+    remote_dir: str,
+    mount_path: str,
+    list_key: str = "imageDataList"
+) -> List[Dict[str, Any]]:
+    """
+    Stream the images of a training input file onto a Modal volume
+
+    Each image is decoded into the same buffer, written to a local temp file and
+    queued for upload, so at most one decoded image is held in memory.
+
+    Args:
+        input_file: Path to the JSON input file
+        volume: Modal volume to upload to
+        remote_dir: Directory inside the volume for the staged images (e.g. "/uploads/abc")
+        mount_path: Where the volume is mounted in the containers
+
+    Returns:
+        The image entries with their image data replaced by an "imagePath"
+        pointing at the staged file inside the container
+    """
+    entries = []
+    buffer = bytearray()
+
+    with tempfile.TemporaryDirectory() as staging_dir:
+        with volume.batch_upload(force=True) as batch:
+            for idx, entry in enumerate(iter_image_entries(input_file, list_key, buffer)):
+                image_bytes = entry.pop("imageBytes", None)
+                if image_bytes is not None:
+                    local_path = os.path.join(staging_dir, f"{idx:05d}")
+                    with open(local_path, "wb") as f:
+                        f.write(image_bytes)
+                    remote_path = f"{remote_dir}/{idx:05d}"
+                    batch.put_file(local_path, remote_path)
+                    entry["imagePath"] = f"{mount_path}{remote_path}"
+                entries.append(entry)
+
+    return entries
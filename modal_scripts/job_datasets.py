@@ -0,0 +1,27 @@
+"""
+Per-job dataset directories on the training volume.
+
+Every training job preprocesses its uploads into its own directory,
+<volume>/datasets/<job_id>, so concurrent jobs never read, overwrite or
+clean up each other's images. All trainers build the path with
+job_dataset_dir so the layout stays the same across them.
+"""
+
+# Every training job gets its own dataset directory under this folder
+DATASETS_DIRNAME = "datasets"
+
+
+def job_dataset_dir(volume_root: str, job_id: str) -> str:
+    """
+    Dataset directory of a training job
+
+    Args:
+        volume_root: Mount path of the training volume
+        job_id: ID of the training job (letters, digits, "-" and "_")
+
+    Returns:
+        <volume_root>/datasets/<job_id>
+    """
+    if not job_id or not all(c.isalnum() or c in "-_" for c in job_id):
+        raise ValueError(f"Invalid job ID: {job_id!r}")
+    return f"{volume_root}/{DATASETS_DIRNAME}/{job_id}"
@@ -0,0 +1,92 @@
+"""
+Fused LoRA inference for sustained single-model traffic.
+
+An adapter loaded with load_attn_procs runs its low-rank matmuls next to the
+base projections on every denoising step. LoRAFuser instead merges the
+deltas into the base weights in place (W += scale * up @ down), so each step
+costs the same as the plain base model. The original weights of the touched
+layers are kept, so unfusing on a model switch is a copy back rather than a
+subtraction that would accumulate fp16 rounding over many switches.
+"""
+
+import time
+from typing import Any, Dict, Optional
+
+import torch
+from torch import nn
+
+from multi_lora import parse_lora_state_dict
+
+
+class LoRAFuser:
+    """
+    Merges one adapter at a time into a UNet's weights
+
+    Args:
+        unet: The UNet whose weights are modified in place
+    """
+
+    def __init__(self, unet: nn.Module):
+        self.unet = unet
+        self.key: Optional[str] = None
+        self._module_names = [name for name, _ in unet.named_modules()]
+        self._originals: Dict[str, torch.Tensor] = {}
+        self._stats = {"fuses": 0, "unfuses": 0, "fuse_seconds": 0.0, "unfuse_seconds": 0.0}
+
+    @property
+    def fused(self) -> bool:
+        return self.key is not None
+
+    @torch.no_grad()
+    def fuse(self, key: str, state_dict: Dict[str, torch.Tensor], scale: float = 1.0):
+        """
+        Merge an adapter into the weights, unfusing the current one first
+
+        Args:
+            key: Identifies the adapter version (e.g. its sha256)
+            state_dict: Adapter weights in any layout multi_lora understands
+            scale: Scale for modules without an alpha entry
+        """
+        if key == self.key:
+            return
+        self.unfuse()
+
+        start_time = time.time()
+        factors = parse_lora_state_dict(state_dict, self._module_names, default_scale=scale)
+        try:
+            for name, (down, up, module_scale) in factors.items():
+                weight = self.unet.get_submodule(name).weight
+                self._originals[name] = weight.detach().clone()
+                # Accumulate the delta in fp32 before rounding to the weight dtype once
+                delta = up.to(weight.device, torch.float32) @ down.to(weight.device, torch.float32)
+                weight.add_((delta * module_scale).reshape(weight.shape).to(weight.dtype))
+        except Exception:
+            self._restore()
+            raise
+
+        self.key = key
+        self._stats["fuses"] += 1
+        self._stats["fuse_seconds"] += time.time() - start_time
+
+    @torch.no_grad()
+    def unfuse(self):
+        """Restore the original weights of every fused layer"""
+        if self.key is None:
+            return
+        start_time = time.time()
+        self._restore()
+        self.key = None
+        self._stats["unfuses"] += 1
+        self._stats["unfuse_seconds"] += time.time() - start_time
+
+    def _restore(self):
+        for name, original in self._originals.items():
+            self.unet.get_submodule(name).weight.copy_(original)
+        self._originals = {}
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = dict(self._stats)
+        metrics["fuse_seconds"] = round(metrics["fuse_seconds"], 3)
+        metrics["unfuse_seconds"] = round(metrics["unfuse_seconds"], 3)
+        metrics["fused"] = self.fused
+        return metrics
@@ -0,0 +1,296 @@
+"""
+Per-sample LoRA for mixed-adapter batches.
+
+Loading an adapter into the UNet applies it to every sample of a batch, so
+requests for different models cannot share a denoising pass. MultiAdapterLoRA
+instead wraps the UNet layers that adapters target and keeps the low-rank
+factors of up to max_adapters adapters in stacked, rank-padded slot buffers
+next to the (shared, unmodified) base weights. Every sample of a batch
+carries a slot index; a layer gathers the factors of each sample's slot and
+adds the delta with two batched matmuls:
+
+    y = base(x) + bmm(bmm(x, down[ids]^T), up[ids]^T)
+
+Slot 0 is all zeros, for samples generated with the base model. Under
+classifier-free guidance the UNet sees the batch twice (unconditional and
+conditional halves), so the slot indices are repeated to match.
+
+Adapters are accepted in the diffusers, PEFT, legacy attention-processor and
+kohya state dict layouts; text encoder weights are ignored.
+"""
+
+import os
+import re
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+MULTI_LORA_SLOTS = 16  # Adapters resident at once (one per sample of a full batch)
+
+# (pattern, kind) for the last part of a LoRA key; the rest names the module
+_KEY_SUFFIXES = (
+    (re.compile(r"\.lora_A(\.[^.]+)?\.weight$"), "down"),
+    (re.compile(r"\.lora_B(\.[^.]+)?\.weight$"), "up"),
+    (re.compile(r"\.lora_down\.weight$"), "down"),
+    (re.compile(r"\.lora_up\.weight$"), "up"),
+    (re.compile(r"_lora\.down\.weight$"), "down"),
+    (re.compile(r"_lora\.up\.weight$"), "up"),
+    (re.compile(r"\.alpha$"), "alpha"),
+)
+_MODULE_PREFIXES = ("unet.", "base_model.model.", "lora_unet_")
+_TEXT_ENCODER_PREFIXES = ("text_encoder", "lora_te", "te_")
+
+
+def adapter_scale(adapter_path: str) -> float:
+    """lora_alpha / r from an adapter's adapter_config.json (1.0 when there is none)"""
+    config_dir = adapter_path if os.path.isdir(adapter_path) else os.path.dirname(adapter_path)
+    config_path = os.path.join(config_dir, "adapter_config.json")
+    if not os.path.exists(config_path):
+        return 1.0
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    rank = config.get("r") or config.get("rank")
+    alpha = config.get("lora_alpha")
+    return float(alpha) / float(rank) if rank and alpha else 1.0
+
+
+def parse_lora_state_dict(
+    state_dict: Dict[str, torch.Tensor],
+    module_names: Iterable[str],
+    default_scale: float = 1.0
+) -> Dict[str, Tuple[torch.Tensor, torch.Tensor, float]]:
+    """
+    Low-rank factors per UNet module of a LoRA state dict
+
+    Args:
+        state_dict: Adapter weights in any supported layout
+        module_names: Names of the UNet's modules (to resolve kohya-style names)
+        default_scale: Scale for modules without an alpha entry
+
+    Returns:
+        Module name -> (down [r, in], up [out, r], scale); 1x1 convolution
+        factors are flattened to the same shapes
+    """
+    underscored = {name.replace(".", "_"): name for name in module_names}
+    known = set(underscored.values())
+    factors: Dict[str, Dict[str, Any]] = {}
+
+    for key, value in state_dict.items():
+        if key.startswith(_TEXT_ENCODER_PREFIXES):
+            continue
+        for pattern, kind in _KEY_SUFFIXES:
+            match = pattern.search(key)
+            if match:
+                break
+        else:
+            continue
+
+        module = key[:match.start()]
+        for prefix in _MODULE_PREFIXES:
+            if module.startswith(prefix):
+                module = module[len(prefix):]
+        # Legacy attention processor layout: "attn1.processor.to_q_lora.down.weight"
+        module = module.replace(".processor.", ".")
+        if module.endswith(".to_out"):
+            module += ".0"
+        if module not in known:
+            module = underscored.get(module.replace(".", "_"), module)
+        if module not in known:
+            raise ValueError(f"LoRA weight {key} does not match any UNet module")
+
+        factors.setdefault(module, {})[kind] = value
+
+    parsed = {}
+    for module, entry in factors.items():
+        if "down" not in entry or "up" not in entry:
+            raise ValueError(f"Incomplete LoRA factors for {module}")
+        down = entry["down"].reshape(entry["down"].shape[0], -1)
+        up = entry["up"].reshape(entry["up"].shape[0], -1)
+        scale = float(entry["alpha"]) / down.shape[0] if "alpha" in entry else default_scale
+        parsed[module] = (down, up, scale)
+    return parsed
+
+
+class MultiLoRALayer(nn.Module):
+    """
+    Linear (or 1x1 convolution) layer with per-sample LoRA deltas
+
+    Args:
+        base: The wrapped layer, used unchanged
+        num_slots: Number of adapter slots, including the empty slot 0
+    """
+
+    def __init__(self, base: nn.Module, num_slots: int):
+        super().__init__()
+        if isinstance(base, nn.Conv2d):
+            if base.kernel_size != (1, 1):
+                raise ValueError("Only 1x1 convolutions support per-sample LoRA")
+            in_features, out_features = base.in_channels, base.out_channels
+        elif isinstance(base, nn.Linear):
+            in_features, out_features = base.in_features, base.out_features
+        else:
+            raise ValueError(f"Per-sample LoRA does not support {type(base).__name__} layers")
+
+        self.base = base
+        self.is_conv = isinstance(base, nn.Conv2d)
+        self.in_features = in_features
+        self.out_features = out_features
+        self.num_slots = num_slots
+        self.rank = 0
+        self.register_buffer("lora_down", None, persistent=False)
+        self.register_buffer("lora_up", None, persistent=False)
+        self.adapter_ids: Optional[torch.Tensor] = None
+
+    def _ensure_rank(self, rank: int):
+        if rank <= self.rank:
+            return
+        weight = self.base.weight
+        down = weight.new_zeros(self.num_slots, rank, self.in_features)
+        up = weight.new_zeros(self.num_slots, self.out_features, rank)
+        if self.rank:
+            down[:, :self.rank] = self.lora_down
+            up[:, :, :self.rank] = self.lora_up
+        self.lora_down, self.lora_up = down, up
+        self.rank = rank
+
+    def set_slot(self, slot: int, down: torch.Tensor, up: torch.Tensor, scale: float):
+        """Store an adapter's factors (down [r, in], up [out, r]) in a slot"""
+        rank = down.shape[0]
+        self._ensure_rank(rank)
+        self.lora_down[slot].zero_()
+        self.lora_up[slot].zero_()
+        self.lora_down[slot, :rank] = down.to(self.lora_down.dtype)
+        # The scale is folded into the up factor
+        self.lora_up[slot, :, :rank] = up.to(self.lora_up.dtype) * scale
+
+    def clear_slot(self, slot: int):
+        if self.rank:
+            self.lora_down[slot].zero_()
+            self.lora_up[slot].zero_()
+
+    def forward(self, x: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        out = self.base(x, *args, **kwargs)
+        ids = self.adapter_ids
+        if ids is None or not self.rank:
+            return out
+
+        batch = x.shape[0]
+        if batch != ids.shape[0]:
+            # Classifier-free guidance runs the batch once per guidance branch
+            ids = ids.repeat(batch // ids.shape[0])
+
+        if self.is_conv:
+            h = x.flatten(2).transpose(1, 2)
+        else:
+            h = x.reshape(batch, -1, self.in_features)
+
+        down = self.lora_down[ids]
+        up = self.lora_up[ids]
+        delta = torch.bmm(torch.bmm(h.to(down.dtype), down.transpose(1, 2)), up.transpose(1, 2))
+
+        if self.is_conv:
+            delta = delta.transpose(1, 2).reshape(out.shape)
+        else:
+            delta = delta.reshape(out.shape)
+        return out + delta.to(out.dtype)
+
+
+class MultiAdapterLoRA:
+    """
+    Resident adapters of a UNet for mixed-adapter batches
+
+    Args:
+        unet: The UNet to wrap (layers are wrapped on first use)
+        max_adapters: Adapter slots; the least recently used adapter not in
+            the current batch is replaced when they are all taken
+    """
+
+    def __init__(self, unet: nn.Module, max_adapters: int = MULTI_LORA_SLOTS):
+        self.unet = unet
+        self.num_slots = max_adapters + 1  # Slot 0 is the base model
+        self.layers: Dict[str, MultiLoRALayer] = {}
+        self._module_names = [name for name, _ in unet.named_modules()]
+        self._slots: "OrderedDict[str, int]" = OrderedDict()  # Adapter key -> slot
+        self._slot_layers: Dict[int, List[str]] = {}
+        self._lock = threading.Lock()
+        self._stats = {"loads": 0, "hits": 0, "evictions": 0}
+
+    def _wrap(self, name: str) -> MultiLoRALayer:
+        layer = self.layers.get(name)
+        if layer is None:
+            parent_name, _, child = name.rpartition(".")
+            parent = self.unet.get_submodule(parent_name) if parent_name else self.unet
+            layer = MultiLoRALayer(getattr(parent, child), self.num_slots)
+            setattr(parent, child, layer)
+            self.layers[name] = layer
+        return layer
+
+    def load(
+        self,
+        key: str,
+        state_dict: Dict[str, torch.Tensor],
+        scale: float = 1.0,
+        protected: Iterable[int] = ()
+    ) -> int:
+        """
+        Slot of an adapter, loading it into a free or evicted slot if needed
+
+        Args:
+            key: Identifies the adapter version (e.g. its sha256)
+            state_dict: Adapter weights, used when the adapter is not resident
+            scale: Scale for modules without an alpha entry
+            protected: Slots that must not be evicted (adapters of the batch being built)
+
+        Returns:
+            The slot index to pass to set_batch
+        """
+        with self._lock:
+            if key in self._slots:
+                self._slots.move_to_end(key)
+                self._stats["hits"] += 1
+                return self._slots[key]
+
+            used = set(self._slots.values())
+            free = [slot for slot in range(1, self.num_slots) if slot not in used]
+            if free:
+                slot = free[0]
+            else:
+                protected = set(protected)
+                victim = next((k for k, s in self._slots.items() if s not in protected), None)
+                if victim is None:
+                    raise RuntimeError(f"All {self.num_slots - 1} adapter slots are in use by this batch")
+                slot = self._slots.pop(victim)
+                for name in self._slot_layers.pop(slot, []):
+                    self.layers[name].clear_slot(slot)
+                self._stats["evictions"] += 1
+
+            factors = parse_lora_state_dict(state_dict, self._module_names, default_scale=scale)
+            for name, (down, up, module_scale) in factors.items():
+                self._wrap(name).set_slot(slot, down, up, module_scale)
+            self._slot_layers[slot] = list(factors)
+            self._slots[key] = slot
+            self._stats["loads"] += 1
+            return slot
+
+    def set_batch(self, slots: Optional[List[int]]):
+        """Adapter slot of every sample of the next UNet calls (None turns the deltas off)"""
+        ids = None
+        if slots is not None and self.layers:
+            device = next(iter(self.layers.values())).base.weight.device
+            ids = torch.tensor(slots, dtype=torch.long, device=device)
+        for layer in self.layers.values():
+            layer.adapter_ids = ids
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._stats,
+                "resident_adapters": len(self._slots),
+                "slots": self.num_slots - 1,
+                "wrapped_layers": len(self.layers),
+                "max_rank": max((layer.rank for layer in self.layers.values()), default=0),
+            }
@@ -0,0 +1,128 @@
+"""
+LRU cache of text encoder outputs for the generation worker.
+
+Every generation runs the CLIP text encoder on its prompt and on its
+negative prompt, which is nearly always the default one; storyboard and
+content-calendar requests repeat the same prompts too. PromptEmbeddingCache
+keeps the encoder's hidden states keyed by the tokenized prompt (so prompts
+that tokenize the same share an entry), encodes all misses of a batch in one
+encoder call, and returns embeddings the pipeline accepts as prompt_embeds /
+negative_prompt_embeds. Precomputed prompts (the default negative prompt)
+are pinned and never evicted.
+
+The worker only loads adapters into the UNet, so the text encoder (and
+therefore every cached embedding) is the same for all models.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Tuple
+
+import torch
+
+PROMPT_CACHE_ENTRIES = 512  # 77x768 fp16 states are ~118 KB each
+
+
+class PromptEmbeddingCache:
+    """
+    Text encoder outputs of a Stable Diffusion pipeline, cached per token sequence
+
+    Args:
+        tokenizer: The pipeline's CLIP tokenizer
+        text_encoder: The pipeline's CLIP text encoder
+        max_entries: Unpinned entries kept before the least recently used is evicted
+    """
+
+    def __init__(self, tokenizer, text_encoder, max_entries: int = PROMPT_CACHE_ENTRIES):
+        self.tokenizer = tokenizer
+        self.text_encoder = text_encoder
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[int, ...], torch.Tensor]" = OrderedDict()
+        self._pinned: Dict[Tuple[int, ...], torch.Tensor] = {}
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "hits": 0, "misses": 0, "evictions": 0, "encode_seconds": 0.0}
+
+    def _keys(self, prompts: List[str]) -> List[Tuple[int, ...]]:
+        input_ids = self.tokenizer(
+            prompts,
+            truncation=True,
+            max_length=self.tokenizer.model_max_length
+        ).input_ids
+        return [tuple(ids) for ids in input_ids]
+
+    @torch.no_grad()
+    def _encode(self, prompts: List[str]) -> torch.Tensor:
+        # Same inputs as the pipeline's own encode_prompt (no attention mask, last hidden state)
+        input_ids = self.tokenizer(
+            prompts,
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt"
+        ).input_ids
+        hidden_states = self.text_encoder(input_ids.to(self.text_encoder.device))[0]
+        return hidden_states.to(dtype=self.text_encoder.dtype)
+
+    def encode(self, prompts: List[str]) -> torch.Tensor:
+        """
+        Embeddings for a batch of prompts, encoding only the ones not cached
+
+        Returns:
+            (len(prompts), max_length, hidden_size) tensor in input order
+        """
+        keys = self._keys(prompts)
+        embeddings: List[Any] = [None] * len(prompts)
+        missing: Dict[Tuple[int, ...], List[int]] = {}
+
+        with self._lock:
+            self._stats["lookups"] += len(prompts)
+            for i, key in enumerate(keys):
+                cached = self._pinned.get(key)
+                if cached is None and key in self._entries:
+                    self._entries.move_to_end(key)
+                    cached = self._entries[key]
+                if cached is not None:
+                    self._stats["hits"] += 1
+                    embeddings[i] = cached
+                elif key in missing:
+                    # Repeated within the batch, encoded once
+                    self._stats["hits"] += 1
+                    missing[key].append(i)
+                else:
+                    self._stats["misses"] += 1
+                    missing.setdefault(key, []).append(i)
+
+        if missing:
+            start_time = time.time()
+            encoded = self._encode([prompts[indices[0]] for indices in missing.values()])
+            with self._lock:
+                self._stats["encode_seconds"] += time.time() - start_time
+                for (key, indices), embedding in zip(missing.items(), encoded):
+                    for i in indices:
+                        embeddings[i] = embedding
+                    self._entries[key] = embedding
+                    self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._stats["evictions"] += 1
+
+        return torch.stack(embeddings)
+
+    def precompute(self, prompts: Iterable[str]):
+        """Encode prompts now and keep them for the lifetime of the cache"""
+        prompts = list(prompts)
+        encoded = self._encode(prompts)
+        with self._lock:
+            for key, embedding in zip(self._keys(prompts), encoded):
+                self._pinned[key] = embedding
+
+    def metrics(self) -> Dict[str, Any]:
+        """Lookup counters, hit rate and entry counts"""
+        with self._lock:
+            metrics = dict(self._stats)
+            metrics["encode_seconds"] = round(metrics["encode_seconds"], 3)
+            metrics["hit_rate"] = round(metrics["hits"] / metrics["lookups"], 3) if metrics["lookups"] else None
+            metrics["entries"] = len(self._entries)
+            metrics["pinned"] = len(self._pinned)
+        return metrics
@@ -0,0 +1,213 @@
+"""
+Dynamic batching of concurrent requests.
+
+A generation container that accepts several inputs at once would otherwise
+run them one by one, each at batch size 1. RequestBatcher gathers requests
+with the same compatibility key (for generation: model, steps, guidance and
+resolution) that arrive within a short window and hands them to one
+run_batch call on a single worker thread, which owns the GPU. Each caller
+blocks in submit() until its own result (or the batch's error) is ready.
+
+The oldest waiting request is always served first, and a batch is
+dispatched as soon as it is full or its oldest request has waited for the
+window, so batching adds at most window_seconds of queueing while the GPU
+is idle; while it is busy, requests simply accumulate into the next batch.
+
+Queueing delay, batch sizes and per-request latency are exposed by
+metrics().
+"""
+
+import time
+import threading
+from collections import Counter, deque
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
+
+BATCH_WINDOW_SECONDS = 0.05
+DEFAULT_MAX_BATCH_SIZE = 8
+
+
+class _Request:
+    __slots__ = ("payload", "submitted", "started", "done", "result", "error")
+
+    def __init__(self, payload: Any):
+        self.payload = payload
+        self.submitted = time.time()
+        self.started = None
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _percentiles_ms(values: List[float]) -> Optional[Dict[str, float]]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "mean": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p50": round(ordered[len(ordered) // 2] * 1000, 1),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+        "p99": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 1),
+        "max": round(ordered[-1] * 1000, 1),
+    }
+
+
+class RequestBatcher:
+    """
+    Groups concurrent requests by key and runs them as batches on one thread
+
+    Args:
+        run_batch: Called with (key, payloads); must return one result per payload, in
+            order; an exception returned as a result fails only that request
+        max_batch_size: Batch size limit, or a callable returning the limit for a key
+        window_seconds: How long the oldest request of a key may wait for company
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Hashable, List[Any]], List[Any]],
+        max_batch_size: Union[int, Callable[[Hashable], int]] = DEFAULT_MAX_BATCH_SIZE,
+        window_seconds: float = BATCH_WINDOW_SECONDS
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.window_seconds = window_seconds
+
+        self._pending: Dict[Hashable, List[_Request]] = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._queue_delays = deque(maxlen=5000)
+        self._latencies = deque(maxlen=5000)
+        self._batch_sizes = Counter()
+        self._stats = {"requests": 0, "batches": 0, "failed_batches": 0, "timeouts": 0}
+
+        self._thread = threading.Thread(target=self._run, name="request-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, key: Hashable, payload: Any, timeout: Optional[float] = None) -> Any:
+        """
+        Queue a request and wait for its result
+
+        Raises:
+            The exception raised by run_batch for the request's batch, or
+            TimeoutError if no result arrived within timeout
+        """
+        request = _Request(payload)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("RequestBatcher is closed")
+            self._pending.setdefault(key, []).append(request)
+            self._stats["requests"] += 1
+            self._cond.notify()
+
+        if not request.done.wait(timeout):
+            with self._cond:
+                # Still queued: drop it so the GPU does not run a request nobody waits for
+                requests = self._pending.get(key, [])
+                if request in requests:
+                    requests.remove(request)
+                    if not requests:
+                        del self._pending[key]
+                self._stats["timeouts"] += 1
+            raise TimeoutError(f"No result within {timeout} seconds")
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self, timeout: Optional[float] = 30.0):
+        """Run the requests still queued and stop the worker thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Counters, batch-size histogram, queueing delay and latency percentiles (milliseconds)"""
+        with self._cond:
+            metrics = dict(self._stats)
+            metrics["pending"] = sum(len(requests) for requests in self._pending.values())
+            metrics["batch_size_histogram"] = dict(sorted(self._batch_sizes.items()))
+            queue_delays = list(self._queue_delays)
+            latencies = list(self._latencies)
+
+        batched = sum(size * count for size, count in metrics["batch_size_histogram"].items())
+        metrics["mean_batch_size"] = round(batched / metrics["batches"], 2) if metrics["batches"] else None
+        metrics["queue_delay_ms"] = _percentiles_ms(queue_delays)
+        metrics["latency_ms"] = _percentiles_ms(latencies)
+        return metrics
+
+    def queue_depths(self) -> Dict[Hashable, int]:
+        """Number of requests waiting per key"""
+        with self._cond:
+            return {key: len(requests) for key, requests in self._pending.items()}
+
+    def _limit(self, key: Hashable) -> int:
+        limit = self.max_batch_size(key) if callable(self.max_batch_size) else self.max_batch_size
+        return max(1, int(limit))
+
+    def _next_batch(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    if self._closed:
+                        return None, None
+                    self._cond.wait()
+
+                # Serve the key whose oldest request has waited longest
+                key = min(self._pending, key=lambda k: self._pending[k][0].submitted)
+
+            # max_batch_size may query the GPU, so submit() is not held up meanwhile
+            limit = self._limit(key)
+
+            with self._cond:
+                if key not in self._pending:
+                    continue  # Its requests timed out while the limit was computed
+                deadline = self._pending[key][0].submitted + self.window_seconds
+                while len(self._pending.get(key, ())) < limit and not self._closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                requests = self._pending.pop(key, None)
+                if not requests:
+                    continue
+                batch, rest = requests[:limit], requests[limit:]
+                if rest:
+                    self._pending[key] = rest
+                return key, batch
+
+    def _run(self):
+        while True:
+            key, batch = self._next_batch()
+            if batch is None:
+                return
+
+            start_time = time.time()
+            for request in batch:
+                request.started = start_time
+            try:
+                results = self.run_batch(key, [request.payload for request in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"run_batch returned {len(results)} results for {len(batch)} requests")
+                for request, result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        request.error = result
+                    else:
+                        request.result = result
+                failed = False
+            except Exception as e:
+                print(f"Batch of {len(batch)} requests for {key} failed: {str(e)}")
+                for request in batch:
+                    request.error = e
+                failed = True
+
+            end_time = time.time()
+            with self._cond:
+                self._stats["batches"] += 1
+                self._stats["failed_batches"] += int(failed)
+                self._batch_sizes[len(batch)] += 1
+                for request in batch:
+                    self._queue_delays.append(request.started - request.submitted)
+                    self._latencies.append(end_time - request.submitted)
+            for request in batch:
+                request.done.set()
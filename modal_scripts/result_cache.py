@@ -0,0 +1,294 @@
+"""
+Deterministic result cache for generation requests.
+
+With a fixed seed, a generation is fully determined by the model's adapter,
+the prompts, the sampler settings and the resolution, and the app re-sends
+identical requests on retries and page refreshes. ResultCache stores the
+encoded image of each seeded request on the volume under a key hashed from
+all of those inputs:
+
+- entries live in <root>/<key[:2]>/<key>.<extension> (png unless the request
+  asked for another image format), described by <root>/index.json (size,
+  extension, creation and last access time, result metadata per key),
+- entries older than ttl_seconds are dropped, and the least recently used
+  ones are evicted once the entries exceed max_bytes,
+- a request whose key is already being computed in this container waits for
+  that computation instead of running its own (in-flight coalescing).
+
+The index is rewritten atomically and merged with the copy on the volume, so
+containers sharing the volume keep each other's entries; new entries are
+committed to the volume in the background. On a local miss the volume is
+reloaded (at most every RELOAD_INTERVAL seconds) and the index entries other
+containers committed are merged in before computing, so a retry routed to a
+different container is still served from the cache.
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
+
+RESULT_CACHE_DIRNAME = "result-cache"
+RESULT_CACHE_TTL_SECONDS = 7 * 24 * 3600
+RESULT_CACHE_MAX_BYTES = 5 * 1024 ** 3
+RESULT_CACHE_INDEX_FILENAME = "index.json"
+COMMIT_INTERVAL = 5.0  # Seconds between two volume commits of new entries
+RELOAD_INTERVAL = 5.0  # Minimum seconds between two volume reloads on misses
+
+
+def result_cache_key(**params: Any) -> str:
+    """Hex key of a generation request (every parameter that affects the image)"""
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Encoded images of deterministic generation requests, on the volume
+
+    Args:
+        root: Cache directory on the volume
+        ttl_seconds: Age after which an entry is dropped
+        max_bytes: Size the entries are evicted down to (least recently used first)
+        commit: Called (from a background thread) to persist new entries,
+            e.g. the volume's commit method
+        reload: Called on a miss to see entries committed by other
+            containers, e.g. the volume's reload method
+        reload_interval: Minimum seconds between two reload calls
+    """
+
+    def __init__(
+        self,
+        root: str,
+        ttl_seconds: float = RESULT_CACHE_TTL_SECONDS,
+        max_bytes: int = RESULT_CACHE_MAX_BYTES,
+        commit: Optional[Callable[[], Any]] = None,
+        reload: Optional[Callable[[], Any]] = None,
+        reload_interval: float = RELOAD_INTERVAL
+    ):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, RESULT_CACHE_INDEX_FILENAME)
+        os.makedirs(root, exist_ok=True)
+
+        self._index: Dict[str, Dict[str, Any]] = self._read_index()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "lookups": 0, "hits": 0, "coalesced": 0, "misses": 0, "evictions": 0, "expired": 0, "reloads": 0
+        }
+
+        self._reload = reload
+        self.reload_interval = reload_interval
+        self._last_reload = 0.0
+
+        self._commit = commit
+        self._commit_wanted = threading.Event()
+        if commit is not None:
+            threading.Thread(target=self._commit_loop, name="result-cache-commit", daemon=True).start()
+
+    def _entry_path(self, key: str, extension: str = "png") -> str:
+        return os.path.join(self.root, key[:2], f"{key}.{extension}")
+
+    def _read_index(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f).get("entries", {})
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self):
+        """Merge with the index on the volume and replace it atomically (lock held)"""
+        for key, entry in self._read_index().items():
+            if key not in self._index and os.path.exists(self._entry_path(key, entry.get("extension", "png"))):
+                self._index[key] = entry
+
+        temp_path = f"{self.index_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"version": 1, "entries": self._index}, f)
+        os.replace(temp_path, self.index_path)
+
+    def _remove(self, key: str):
+        entry = self._index.pop(key, None) or {}
+        try:
+            os.remove(self._entry_path(key, entry.get("extension", "png")))
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Drop expired entries, then the least recently used ones above max_bytes (lock held)"""
+        now = time.time()
+        for key in [k for k, entry in self._index.items() if now - entry["created"] > self.ttl_seconds]:
+            self._remove(key)
+            self._stats["expired"] += 1
+
+        total = sum(entry["bytes"] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            total -= self._index[key]["bytes"]
+            self._remove(key)
+            self._stats["evictions"] += 1
+
+    def _lookup(self, key: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+        """Cached image and metadata of a key (lock held)"""
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["created"] > self.ttl_seconds:
+            self._remove(key)
+            self._stats["expired"] += 1
+            return None
+        try:
+            with open(self._entry_path(key, entry.get("extension", "png")), "rb") as f:
+                data = f.read()
+        except OSError:
+            # Evicted by another container
+            self._index.pop(key, None)
+            return None
+        entry["last_access"] = time.time()
+        return data, entry["meta"]
+
+    def _reload_index(self) -> bool:
+        """
+        Reload the volume and merge in the index entries other containers wrote
+
+        Returns:
+            Whether a reload ran (False when throttled, disabled or failed)
+        """
+        if self._reload is None:
+            return False
+        with self._lock:
+            now = time.time()
+            if now - self._last_reload < self.reload_interval:
+                return False
+            self._last_reload = now
+            self._stats["reloads"] += 1
+
+        try:
+            self._reload()
+        except Exception as e:
+            print(f"Failed to reload the result cache volume: {str(e)}")
+            return False
+
+        entries = self._read_index()
+        with self._lock:
+            for key, entry in entries.items():
+                self._index.setdefault(key, entry)
+        return True
+
+    def put(self, key: str, data: bytes, meta: Dict[str, Any], extension: str = "png"):
+        """Store the encoded image and metadata of a request"""
+        path = self._entry_path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        now = time.time()
+        with self._lock:
+            self._index[key] = {
+                "bytes": len(data),
+                "extension": extension,
+                "created": now,
+                "last_access": now,
+                "meta": meta,
+            }
+            self._evict()
+            self._write_index()
+        self._commit_wanted.set()
+
+    def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Tuple[bytes, Dict[str, Any]]],
+        extension: str = "png"
+    ) -> Tuple[bytes, Dict[str, Any], str]:
+        """
+        Cached result of a request, computing (and storing) it on a miss
+
+        Args:
+            key: Request key from result_cache_key (which must cover the image format)
+            compute: Returns the encoded image and JSON-serialisable metadata
+            extension: File extension of the encoded image
+
+        Returns:
+            The image, its metadata and how it was served: "hit", "coalesced"
+            (waited for an identical in-flight request) or "miss"
+        """
+        with self._lock:
+            self._stats["lookups"] += 1
+            cached = self._lookup(key)
+            if cached is not None:
+                self._stats["hits"] += 1
+                return cached[0], cached[1], "hit"
+
+            pending = self._inflight.get(key)
+            if pending is None:
+                future = self._inflight[key] = Future()
+            else:
+                self._stats["coalesced"] += 1
+
+        if pending is not None:
+            data, meta = pending.result()
+            return data, meta, "coalesced"
+
+        try:
+            # Another container may have stored the result since the last reload
+            reloaded = self._reload_index()
+            with self._lock:
+                cached = self._lookup(key) if reloaded else None
+                self._stats["hits" if cached is not None else "misses"] += 1
+                if cached is not None:
+                    self._inflight.pop(key, None)
+            if cached is not None:
+                future.set_result(cached)
+                return cached[0], cached[1], "hit"
+
+            data, meta = compute()
+        except BaseException as e:
+            future.set_exception(e)
+            with self._lock:
+                self._inflight.pop(key, None)
+            raise
+
+        # Waiters get the result right away, but the key stays in flight until
+        # the entry is stored, so an identical request always finds one of them
+        future.set_result((data, meta))
+        try:
+            self.put(key, data, meta, extension)
+        except Exception as e:
+            print(f"Failed to store result {key} in the cache: {str(e)}")
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return data, meta, "miss"
+
+    def metrics(self) -> Dict[str, Any]:
+        """Lookup counters, hit rate and the size of the index"""
+        with self._lock:
+            metrics = dict(self._stats)
+            metrics["hit_rate"] = (
+                round((metrics["hits"] + metrics["coalesced"]) / metrics["lookups"], 3)
+                if metrics["lookups"] else None
+            )
+            metrics["entries"] = len(self._index)
+            metrics["bytes"] = sum(entry["bytes"] for entry in self._index.values())
+            metrics["in_flight"] = len(self._inflight)
+        return metrics
+
+    def _commit_loop(self):
+        while True:
+            self._commit_wanted.wait()
+            self._commit_wanted.clear()
+            try:
+                self._commit()
+            except Exception as e:
+                print(f"Failed to commit the result cache: {str(e)}")
+            time.sleep(COMMIT_INTERVAL)
@@ -1,14 +1,20 @@
 import os
 import time
 import json
-import base64
 import sys
+import uuid
 from modal import Image, Volume, App, Mount
 
+from http_download import download_images
+from image_preprocessing import decode_to_target, save_training_image
+from input_stream import load_input_params, read_image_bytes, stage_image_entries
+from status_writer import get_status_writer
+
 # Initialize Modal app and volume
 app = App("lora-trainer")
 volume = Volume.from_name("lora-models", create_if_missing=True)
 VOLUME_MOUNT_PATH = "/model-data"
+UPLOADS_DIRNAME = "uploads"  # Inline (base64) uploads are staged here before processing
 
 # Define the base image with Python
 image = (
@@ -18,15 +24,20 @@ image = (
         "requests",
         "supabase"
     )
+    .add_local_python_source(
+        # Sibling modules imported above; Modal no longer mounts local modules automatically
+        "input_stream",
+        "image_preprocessing",
+        "image_screening",
+        "http_download",
+        "status_writer",
+    )
 )
 
 @app.function(image=image, volumes={VOLUME_MOUNT_PATH: volume})
 def process_images(model_id, image_data_list, instance_prompt, supabase_url=None, supabase_key=None):
     """Process image data for training"""
     import os
-    import requests
-    from PIL import Image
-    import io
     
     # Set Supabase credentials in this container
     if supabase_url:
@@ -45,12 +56,32 @@ def process_images(model_id, image_data_list, instance_prompt, supabase_url=None
     # Update status to processing
     update_status(model_id, "processing")
     
-    successful_images = 0
+    def save_image(i, img_data, img_bytes):
+        """Decode one image near 512x512, save it with its caption and return the decode stats"""
+        img, decode_stats = decode_to_target(img_bytes)
+        print(f"Decoded image {i} ({decode_stats['original_size'][0]}x{decode_stats['original_size'][1]}) "
+              f"in {decode_stats['decode_seconds']:.3f}s, peak RSS {decode_stats['peak_rss_mb']} MB")
+        
+        # Save the image (uploads that already are 512x512 RGB JPEGs are copied as is)
+        output_path = os.path.join(dataset_dir, f"image_{i:03d}.jpg")
+        save_training_image(img, img_bytes, output_path, "JPEG")
+        
+        # Save the caption
+        caption = img_data.get("caption", instance_prompt).strip()
+        caption_path = os.path.join(dataset_dir, f"image_{i:03d}.txt")
+        with open(caption_path, "w") as f:
+            f.write(caption)
+        
+        print(f"Processed image {i+1}/{len(image_data_list)} → {output_path}")
+        return decode_stats
+    
+    decoded = []
+    url_jobs = {}
     
     # Process each image in the image_data_list
     for i, img_data in enumerate(image_data_list):
         try:
-            img_path = img_data.get("imageUrl")
+            img_path = img_data.get("imageUrl") or img_data.get("imagePath")
             if not img_path:
                 print(f"Image {i} missing imageUrl field")
                 continue
@@ -58,35 +89,43 @@ def process_images(model_id, image_data_list, instance_prompt, supabase_url=None
             # For debugging
             print(f"Processing image {i+1}/{len(image_data_list)}: {img_path}")
                 
-            if img_path.startswith("http"):
-                # Download the image
-                response = requests.get(img_path, stream=True)
-                if response.status_code != 200:
-                    print(f"Failed to download image {i} from {img_path}: {response.status_code}")
-                    continue
-                img = Image.open(io.BytesIO(response.content))
+            if img_data.get("imagePath"):
+                # Upload staged on the volume by the local entrypoint
+                decoded.append(save_image(i, img_data, read_image_bytes(img_data)))
+            elif img_path.startswith("http"):
+                # Downloaded concurrently below
+                url_jobs[i] = img_path
             else:
                 # Local path - skip for Modal (paths won't exist in container)
                 print(f"Local path detected: {img_path} - this won't be accessible in Modal")
                 continue
             
-            # Save the image
-            output_path = os.path.join(dataset_dir, f"image_{i:03d}.jpg")
-            img.save(output_path)
-            
-            # Save the caption
-            caption = img_data.get("caption", instance_prompt).strip()
-            caption_path = os.path.join(dataset_dir, f"image_{i:03d}.txt")
-            with open(caption_path, "w") as f:
-                f.write(caption)
-                
-            successful_images += 1
-            print(f"Processed image {i+1}/{len(image_data_list)}: {img_path} → {output_path}")
-            
         except Exception as e:
             print(f"Error processing image {i}: {e}")
     
+    if url_jobs:
+        # Fetch over one pooled session, decoding each image as soon as it arrives
+        download_start = time.time()
+        downloads = download_images(
+            url_jobs,
+            lambda i, img_bytes: save_image(i, image_data_list[i], img_bytes)
+        )
+        decoded.extend(record["result"] for record in downloads.values() if record["status"] == "downloaded")
+        print(f"Downloaded {sum(record['bytes'] for record in downloads.values())} bytes for {len(url_jobs)} images "
+              f"in {time.time() - download_start:.2f}s "
+              f"({sum(max(record['attempts'] - 1, 0) for record in downloads.values())} retries)")
+    
+    successful_images = len(decoded)
     print(f"Successfully processed {successful_images} out of {len(image_data_list)} images")
+    print(f"Decoding took {sum(stats['decode_seconds'] for stats in decoded):.2f}s in total, "
+          f"peak RSS {max((stats['peak_rss_mb'] for stats in decoded), default=0.0)} MB")
+    
+    # Staged uploads are only needed until they have been processed
+    import shutil
+    uploads_root = f"{VOLUME_MOUNT_PATH}/{UPLOADS_DIRNAME}/"
+    for staged_dir in {os.path.dirname(d["imagePath"]) for d in image_data_list if d.get("imagePath")}:
+        if staged_dir.startswith(uploads_root):
+            shutil.rmtree(staged_dir, ignore_errors=True)
     
     if successful_images == 0:
         update_status(model_id, "failed", error="No images could be processed")
@@ -176,10 +215,9 @@ def train_model(model_id, instance_prompt, supabase_url=None, supabase_key=None)
     return {"success": True, "model_path": output_path}
 
 def update_status(model_id, status, progress=None, model_url=None, error=None):
-    """Update the model status in Supabase"""
+    """Update the model status in Supabase (through the shared background status writer)"""
     import os
     import json
-    import requests
     
     # URL and key should be passed via environment variables
     supabase_url = os.environ.get("SUPABASE_URL")
@@ -190,9 +228,6 @@ def update_status(model_id, status, progress=None, model_url=None, error=None):
         return False
     
     try:
-        from supabase import create_client
-        supabase = create_client(supabase_url, supabase_key)
-        
         # Prepare update data
         update_data = {"status": status}
         
@@ -213,11 +248,13 @@ def update_status(model_id, status, progress=None, model_url=None, error=None):
         # Log the update
         print(f"Updating status for model {model_id}: {json.dumps(update_data)}")
         
-        # Update the database
-        result = supabase.table("trained_models").update(update_data).eq("id", model_id).execute()
-        print(f"Update result: {result}")
-        
-        return True
+        # Merged with any pending update of this model and written in the next
+        # batch over a pooled connection; terminal statuses are written right away
+        writer = get_status_writer(supabase_url=supabase_url, supabase_key=supabase_key)
+        written = writer.update(model_id, update_data)
+        if status in ("completed", "failed"):
+            print(f"Status writes: {json.dumps(writer.metrics())}")
+        return written
     except Exception as e:
         print(f"Error updating status: {e}")
         return False
@@ -236,16 +273,23 @@ def main(input=None):
         # Load input data
         if os.path.exists(input):
             print(f"Reading input file: {input}")
-            with open(input, "r") as f:
-                data = json.load(f)
+            # Images are streamed separately so the file is never loaded whole
+            data = load_input_params(input)
+            image_data_list = None
         else:
             print("Input is not a file, parsing as JSON")
             data = json.loads(input)
+            image_data_list = data.get("imageDataList", [])
         
         # Extract parameters
         model_id = data.get("modelId")
         instance_prompt = data.get("instancePrompt", "")
-        image_data_list = data.get("imageDataList", [])
+        
+        if image_data_list is None:
+            # URL entries pass through untouched; inline base64 images are staged
+            # on the volume one at a time
+            upload_dir = f"/{UPLOADS_DIRNAME}/{uuid.uuid4().hex}"
+            image_data_list = stage_image_entries(input, volume, upload_dir, VOLUME_MOUNT_PATH)
         
         # Get Supabase credentials
         supabase_url = data.get("supabaseUrl", "")
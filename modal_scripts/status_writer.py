@@ -0,0 +1,283 @@
+"""
+Shared, coalescing status writer for the trainers.
+
+Every trainer reports model status to the app, either through a callback URL
+or by updating the trained_models row in Supabase. Opening a new client (or
+connection) per update adds latency and connection churn to every job, so
+StatusWriter keeps one pooled requests.Session per process and hands writes
+to a background thread:
+
+- update() merges the fields into the pending update of that model and
+  returns immediately; a newer value for a field replaces the older one,
+- pending updates are written in batches every interval seconds, to the
+  callback URL first and to Supabase's REST API (PostgREST) as a fallback,
+- terminal statuses ("completed", "failed") are flushed synchronously,
+- write latency, coalesced and dropped updates are exposed by metrics().
+
+get_status_writer() returns the process-wide writer for a configuration, so
+warm containers reuse their connections across calls.
+"""
+
+import time
+import atexit
+import threading
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+STATUS_WRITE_INTERVAL = 2.0  # Seconds between two batches of writes
+STATUS_TIMEOUT = 5.0  # Seconds per HTTP request
+STATUS_MAX_ATTEMPTS = 3
+STATUS_BACKOFF_SECONDS = 0.5  # Doubled after every failed attempt
+TERMINAL_STATUSES = ("completed", "failed")
+
+# Fields resent on their own when the callback rejects a payload with HTTP 400
+ESSENTIAL_FIELDS = ("status", "progress")
+
+_writers: Dict[Tuple, "StatusWriter"] = {}
+_writers_lock = threading.Lock()
+
+
+class StatusWriter:
+    """
+    Writes model status updates in the background over a pooled session
+
+    Args:
+        callback_url: App endpoint to POST updates to (tried first)
+        supabase_url: Supabase project URL, to PATCH the table row directly
+        supabase_key: Supabase API key
+        table: Table holding the model rows
+        callback_id_field: Payload field carrying the model ID for the callback
+        interval: Seconds between two batches of writes
+        timeout: Seconds per HTTP request
+        max_attempts: Attempts per batch entry before the update is dropped
+    """
+
+    def __init__(
+        self,
+        callback_url: Optional[str] = None,
+        supabase_url: Optional[str] = None,
+        supabase_key: Optional[str] = None,
+        table: str = "trained_models",
+        callback_id_field: str = "id",
+        interval: float = STATUS_WRITE_INTERVAL,
+        timeout: float = STATUS_TIMEOUT,
+        max_attempts: int = STATUS_MAX_ATTEMPTS
+    ):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        if not callback_url and not (supabase_url and supabase_key):
+            raise ValueError("StatusWriter needs a callback URL or Supabase credentials")
+
+        self.callback_url = callback_url
+        self.rest_url = f"{supabase_url.rstrip('/')}/rest/v1/{table}" if supabase_url and supabase_key else None
+        self.callback_id_field = callback_id_field
+        self.interval = interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_maxsize=4))
+        self._session.mount("https://", HTTPAdapter(pool_maxsize=4))
+        if self.rest_url:
+            self._rest_headers = {
+                "apikey": supabase_key,
+                "Authorization": f"Bearer {supabase_key}",
+                "Prefer": "return=minimal",
+            }
+
+        # model ID -> (merged fields, number of updates merged into them)
+        self._pending: Dict[Any, Tuple[Dict[str, Any], int]] = {}
+        self._last_ok: Dict[Any, bool] = {}
+        self._flush_waiters = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._latencies = deque(maxlen=1000)
+        self._stats = {
+            "updates": 0,
+            "writes": 0,
+            "coalesced": 0,
+            "failed_writes": 0,
+            "dropped": 0,
+            "retries": 0,
+        }
+
+        self._thread = threading.Thread(target=self._run, name="status-writer", daemon=True)
+        self._thread.start()
+
+    def update(self, model_id: Any, fields: Dict[str, Any], flush: Optional[bool] = None) -> bool:
+        """
+        Queue a status update for a model
+
+        Args:
+            model_id: Row / model the update is for
+            fields: Columns to set (merged with any update still pending for the model)
+            flush: Write now and wait for the result (defaults to True for terminal statuses)
+
+        Returns:
+            True once queued; for flushed updates, whether the write succeeded
+        """
+        fields = {key: value for key, value in fields.items() if value is not None}
+        with self._lock:
+            if self._closed:
+                self._stats["dropped"] += 1
+                return False
+            self._stats["updates"] += 1
+            if model_id in self._pending:
+                merged, count = self._pending[model_id]
+                self._pending[model_id] = ({**merged, **fields}, count + 1)
+                self._stats["coalesced"] += 1
+            else:
+                self._pending[model_id] = (fields, 1)
+
+        if flush is None:
+            flush = fields.get("status") in TERMINAL_STATUSES
+        if not flush:
+            return True
+        return self.flush() and self._last_ok.get(model_id, False)
+
+    def flush(self, timeout: Optional[float] = 30.0) -> bool:
+        """
+        Write every pending update now
+
+        Returns:
+            Whether the writes finished within timeout
+        """
+        done = threading.Event()
+        with self._lock:
+            self._flush_waiters.append(done)
+        self._wake.set()
+        return done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 30.0):
+        """Flush pending updates and stop the background thread"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wake.set()
+        self._thread.join(timeout)
+        self._session.close()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Update/write counters and write latency percentiles (milliseconds)"""
+        with self._lock:
+            metrics = dict(self._stats)
+            latencies = sorted(self._latencies)
+            metrics["pending"] = len(self._pending)
+
+        if latencies:
+            metrics["latency_ms"] = {
+                "mean": round(sum(latencies) / len(latencies) * 1000, 1),
+                "p50": round(latencies[len(latencies) // 2] * 1000, 1),
+                "p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1),
+                "max": round(latencies[-1] * 1000, 1),
+            }
+        else:
+            metrics["latency_ms"] = None
+        return metrics
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                waiters, self._flush_waiters = self._flush_waiters, []
+                closing = self._closed
+
+            for model_id, (fields, count) in batch.items():
+                ok = self._write(model_id, fields)
+                self._last_ok[model_id] = ok
+                if not ok:
+                    with self._lock:
+                        self._stats["dropped"] += count
+
+            for waiter in waiters:
+                waiter.set()
+            if closing:
+                return
+
+    def _write(self, model_id: Any, fields: Dict[str, Any]) -> bool:
+        start_time = time.time()
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                error = None
+                try:
+                    if self.callback_url and self._post_callback(model_id, fields):
+                        return True
+                    if self.rest_url and self._patch_row(model_id, fields):
+                        return True
+                except Exception as e:
+                    error = str(e)
+
+                with self._lock:
+                    self._stats["failed_writes"] += 1
+                if attempt == self.max_attempts:
+                    print(f"Failed to write status for model {model_id} after {attempt} attempts"
+                          f"{': ' + error if error else ''}")
+                    return False
+                with self._lock:
+                    self._stats["retries"] += 1
+                time.sleep(STATUS_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            return False
+        finally:
+            with self._lock:
+                self._stats["writes"] += 1
+                self._latencies.append(time.time() - start_time)
+
+    def _post_callback(self, model_id: Any, fields: Dict[str, Any]) -> bool:
+        payload = {self.callback_id_field: model_id, **fields}
+        response = self._session.post(self.callback_url, json=payload, timeout=self.timeout)
+        if response.status_code == 400:
+            # Retry with only the fields every version of the endpoint accepts
+            essential = {key: fields[key] for key in ESSENTIAL_FIELDS if key in fields}
+            print(f"Status callback rejected the payload (400), sending essential fields only")
+            response = self._session.post(
+                self.callback_url,
+                json={self.callback_id_field: model_id, **essential},
+                timeout=self.timeout
+            )
+        if response.status_code >= 400:
+            print(f"Status callback failed with status {response.status_code}: {response.text[:200]}")
+            return False
+        return True
+
+    def _patch_row(self, model_id: Any, fields: Dict[str, Any]) -> bool:
+        response = self._session.patch(
+            self.rest_url,
+            params={"id": f"eq.{model_id}"},
+            json=fields,
+            headers=self._rest_headers,
+            timeout=self.timeout
+        )
+        if response.status_code >= 300:
+            print(f"Supabase status update failed with status {response.status_code}: {response.text[:200]}")
+            return False
+        return True
+
+
+def get_status_writer(
+    callback_url: Optional[str] = None,
+    supabase_url: Optional[str] = None,
+    supabase_key: Optional[str] = None,
+    **kwargs
+) -> StatusWriter:
+    """Process-wide StatusWriter for a destination, created on first use and flushed at exit"""
+    key = (callback_url, supabase_url, supabase_key, tuple(sorted(kwargs.items())))
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None or writer._closed:
+            writer = StatusWriter(callback_url, supabase_url, supabase_key, **kwargs)
+            _writers[key] = writer
+        return writer
+
+
+@atexit.register
+def _close_writers():
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.close(timeout=10)
@@ -0,0 +1,13 @@
+"""
+Shared setup for the modal_scripts tests.
+
+The scripts import their helper modules as top-level modules (that is how
+they are added to the Modal images), so the tests put modal_scripts on the
+path the same way. Everything runs on CPU with tiny randomly initialised
+models; nothing here talks to Modal.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,75 @@
+"""
+AdapterCache tiers on CPU, with adapters larger and smaller than the disk tier
+"""
+
+import os
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from adapter_cache import AdapterCache
+
+ADAPTER_BYTES = 4 * 256 * 256 * 4
+
+
+def write_adapter(path, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_file({f"w{i}": torch.randn(256, 256, generator=generator) for i in range(4)}, path)
+
+
+@pytest.fixture
+def adapter_path(tmp_path):
+    path = str(tmp_path / "volume" / "m1" / "trained_model" / "pytorch_lora_weights.safetensors")
+    write_adapter(path)
+    return os.path.dirname(path)
+
+
+def make_cache(tmp_path, disk_bytes):
+    return AdapterCache(
+        device="cpu",
+        cache_dir=str(tmp_path / "cache"),
+        device_bytes=ADAPTER_BYTES,
+        host_bytes=ADAPTER_BYTES,
+        disk_bytes=disk_bytes,
+    )
+
+
+def test_tiers_serve_repeated_lookups(tmp_path, adapter_path):
+    cache = make_cache(tmp_path, disk_bytes=2 * ADAPTER_BYTES)
+
+    state_dict, info = cache.get(adapter_path)
+    assert info["tier"] == "volume"
+    assert cache.get(adapter_path)[1]["tier"] == "device"
+    assert cache.digest(adapter_path) == info["sha256"]
+    assert len(os.listdir(cache.cache_dir)) == 1
+
+    # A touched but unchanged file is hashed again and the memory tiers stay valid
+    os.utime(os.path.join(adapter_path, "pytorch_lora_weights.safetensors"))
+    assert cache.get(adapter_path)[1]["tier"] == "device"
+    assert cache.metrics()["invalidations"] == 0
+    assert len(os.listdir(cache.cache_dir)) == 1
+
+
+def test_copies_over_the_disk_limit_are_deleted(tmp_path, adapter_path):
+    cache = make_cache(tmp_path, disk_bytes=ADAPTER_BYTES // 2)
+    weight_file = os.path.join(adapter_path, "pytorch_lora_weights.safetensors")
+
+    digest = cache.digest(adapter_path)
+    assert os.listdir(cache.cache_dir) == []
+
+    state_dict, info = cache.get(adapter_path)
+    assert (info["tier"], info["sha256"]) == ("volume", digest)
+    assert os.listdir(cache.cache_dir) == []
+
+    # Memory tier hit after an mtime change: the revalidation copy is not used
+    os.utime(weight_file)
+    assert cache.get(adapter_path)[1]["tier"] == "device"
+    assert os.listdir(cache.cache_dir) == []
+
+    write_adapter(weight_file, seed=1)
+    assert cache.digest(adapter_path) != digest
+    state_dict, info = cache.get(adapter_path)
+    assert info["tier"] == "volume"
+    assert os.listdir(cache.cache_dir) == []
@@ -0,0 +1,77 @@
+"""
+write_shards and ShardReader round trip on small PNGs
+"""
+
+import io
+import os
+import tarfile
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from dataset_shards import ShardReader, write_shards
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(10):
+        path = str(tmp_path / "images" / f"image_{i:03d}.png")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.fromarray(rng.integers(0, 255, (64, 64, 3), dtype=np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def shards(tmp_path, images):
+    samples = [(f"image_{i:03d}", path, f"a photo {i}" if i % 3 else "") for i, path in enumerate(images)]
+    # Small shards, so the samples spread over several files
+    return write_shards(samples, str(tmp_path / "shards"), max_shard_bytes=40 * 1024)
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_every_sample_reads_back(shards, images):
+    assert shards["samples"] == len(images)
+    assert shards["shards"] > 1
+
+    with ShardReader(shards["index"], verify=True) as reader:
+        assert len(reader) == len(images)
+        for i, sample in enumerate(reader):
+            assert sample["key"] == f"image_{i:03d}"
+            assert sample["caption"] == (f"a photo {i}" if i % 3 else "")
+            assert bytes(sample["image"]) == read_file(images[i])
+            with Image.open(io.BytesIO(sample["image"])) as img:
+                assert img.size == (64, 64)
+
+    # The shards stay plain tar files
+    with tarfile.open(os.path.join(os.path.dirname(shards["index"]), "shard-00000.tar")) as tar:
+        assert tar.getnames()[:3] == ["image_000.png", "image_000.txt", "image_000.json"]
+        assert tar.extractfile("image_000.png").read() == read_file(images[0])
+
+
+def test_corrupted_payload_fails_its_hash_check(shards, images):
+    with ShardReader(shards["index"]) as reader:
+        sample = reader.samples[4]
+    shard_path = os.path.join(os.path.dirname(shards["index"]), f"shard-{sample['shard']:05d}.tar")
+    with open(shard_path, "r+b") as f:
+        f.seek(sample["offset"] + sample["size"] // 2)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    with ShardReader(shards["index"], verify=True) as reader:
+        with pytest.raises(ValueError, match="image_004"):
+            reader.image_bytes(4)
+        # Other samples, even in the same shard, are unaffected
+        assert all(bytes(reader.image_bytes(i)) == read_file(images[i]) for i in range(len(reader)) if i != 4)
+
+    # Without verification the corruption goes unnoticed
+    with ShardReader(shards["index"]) as reader:
+        assert bytes(reader.image_bytes(4)) != read_file(images[4])
@@ -0,0 +1,144 @@
+"""
+download_images against a local stand-in for the image storage
+
+The stand-in is a plain http.server: GET /img/<n> answers a JPEG after a
+delay, /busy answers 503 with Retry-After on its first request,
+/slow stalls its first response past the read timeout and /down always
+answers 503.
+"""
+
+import io
+import time
+import functools
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+import http_download
+from http_download import download_images
+from image_preprocessing import decode_to_target
+
+READ_TIMEOUT = 0.3
+RESPONSE_DELAY = 0.1
+
+
+def make_jpeg():
+    buffered = io.BytesIO()
+    Image.new("RGB", (1024, 768), (200, 120, 40)).save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+class ImageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ImageHandler)
+        self.body = make_jpeg()
+        self.hits = Counter()
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def handle_error(self, request, client_address):
+        pass  # The client gave up on a stalled response
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so connection reuse is visible
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body=b"", headers=None):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits[self.path] += 1
+            self.server.connections.add(self.client_address)
+            hits = self.server.hits[self.path]
+
+        if self.path == "/busy" and hits == 1:
+            self._reply(503, headers={"Retry-After": "1"})
+        elif self.path == "/slow" and hits == 1:
+            time.sleep(READ_TIMEOUT * 3)
+            self._reply(200, self.server.body)
+        elif self.path == "/down":
+            self._reply(503)
+        else:
+            time.sleep(RESPONSE_DELAY)
+            self._reply(200, self.server.body)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(http_download, "BACKOFF_SECONDS", 0.01)
+    monkeypatch.setattr(http_download, "fetch_bytes",
+                        functools.partial(http_download.fetch_bytes, timeout=(1.0, READ_TIMEOUT)))
+    server = ImageServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def decoded_size(idx, body):
+    assert isinstance(body, io.BytesIO) and body.tell() == 0
+    return decode_to_target(body)[0].size
+
+
+def test_transient_failures_are_retried(server):
+    start_time = time.time()
+    records = download_images({0: f"{server.url}/busy", 1: f"{server.url}/slow"}, decoded_size)
+
+    assert [records[i]["status"] for i in (0, 1)] == ["downloaded", "downloaded"]
+    assert [records[i]["attempts"] for i in (0, 1)] == [2, 2]
+    assert records[0]["result"] == (512, 512)
+    assert records[0]["bytes"] == len(server.body)
+    # The 503 asked for a one second pause, longer than the backoff
+    assert time.time() - start_time >= 1.0
+
+
+def test_final_failure_is_recorded(server):
+    records = download_images({0: f"{server.url}/down", 1: f"{server.url}/img/1"}, decoded_size)
+
+    assert records[0]["status"] == "failed"
+    assert "503" in records[0]["error"]
+    assert records[0]["result"] is None
+    assert server.hits["/down"] == http_download.MAX_ATTEMPTS
+    assert records[1]["status"] == "downloaded"
+
+
+def test_failed_callback_is_recorded(server):
+    def reject(idx, body):
+        raise ValueError("not an image")
+
+    records = download_images({0: f"{server.url}/img/0"}, reject)
+    assert (records[0]["status"], records[0]["error"]) == ("failed", "not an image")
+
+
+def test_concurrent_downloads_share_pooled_connections(server):
+    urls = {i: f"{server.url}/img/{i}" for i in range(24)}
+
+    start_time = time.time()
+    records = download_images(urls, lambda idx, body: body.getbuffer().nbytes, max_workers=4)
+    elapsed = time.time() - start_time
+
+    assert sorted(records) == list(urls)
+    assert all(record["result"] == len(server.body) for record in records.values())
+    assert sum(server.hits.values()) == len(urls)
+    # Four workers keep at most four connections open, each reused across images
+    assert len(server.connections) <= 4
+    assert elapsed < RESPONSE_DELAY * len(urls) / 2
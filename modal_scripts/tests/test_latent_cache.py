@@ -0,0 +1,145 @@
+"""
+VAE latent cache of train_lora_model (cache_latents / load_cached_latents)
+
+Checks that the cached mean/std survive the safetensors round trip and that a
+training step on cached latents beats the old loop, which ran vae.encode twice
+per step, with a tiny randomly initialised VAE and UNet on CPU.
+"""
+
+import os
+import time
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from diffusers import AutoencoderKL, DDPMScheduler, UNet2DConditionModel
+
+from train_model import LATENT_CACHE_DIRNAME, cache_latents, load_cached_latents
+
+IMAGE_SIZE = 128
+TIMED_STEPS = 10
+
+
+def image_transform(image):
+    pixels = np.asarray(image.resize((IMAGE_SIZE, IMAGE_SIZE)), dtype=np.float32) / 127.5 - 1
+    return torch.from_numpy(pixels).permute(2, 0, 1)
+
+
+@pytest.fixture(scope="module")
+def tiny_vae():
+    torch.manual_seed(0)
+    return AutoencoderKL(
+        block_out_channels=(32, 64, 64),
+        down_block_types=("DownEncoderBlock2D",) * 3,
+        up_block_types=("UpDecoderBlock2D",) * 3,
+        latent_channels=4,
+        sample_size=IMAGE_SIZE,
+    ).eval()
+
+
+@pytest.fixture(scope="module")
+def tiny_unet():
+    torch.manual_seed(0)
+    return UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=IMAGE_SIZE // 4,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=4,
+    )
+
+
+@pytest.fixture
+def image_paths(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(4):
+        path = str(tmp_path / f"image_{i}.png")
+        Image.fromarray((rng.random((IMAGE_SIZE, IMAGE_SIZE, 3)) * 255).astype(np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+
+class FailingVAE:
+    """Stands in for the VAE when every latent must come from the cache"""
+    dtype = torch.float32
+
+    def encode(self, pixel_values):
+        raise AssertionError("VAE called for a cached image")
+
+
+def test_cached_latents_round_trip(tiny_vae, image_paths):
+    latent_paths = cache_latents(tiny_vae, image_paths, image_transform, device="cpu")
+    assert sorted(latent_paths) == sorted(image_paths)
+    for image_path, latent_path in latent_paths.items():
+        assert os.path.dirname(latent_path) == os.path.join(os.path.dirname(image_path), LATENT_CACHE_DIRNAME)
+
+    latents = load_cached_latents(latent_paths)
+    with torch.no_grad():
+        for image_path in image_paths:
+            with Image.open(image_path) as img:
+                pixel_values = image_transform(img.convert("RGB")).unsqueeze(0)
+            latent_dist = tiny_vae.encode(pixel_values).latent_dist
+            assert torch.equal(latents[image_path]["mean"], latent_dist.mean[0])
+            assert torch.equal(latents[image_path]["std"], latent_dist.std[0])
+
+    # Unchanged images are served from the cache without touching the VAE
+    assert cache_latents(FailingVAE(), image_paths, image_transform, device="cpu") == latent_paths
+
+
+def test_changed_image_is_re_encoded(tiny_vae, image_paths):
+    latent_paths = cache_latents(tiny_vae, image_paths, image_transform, device="cpu")
+    Image.new("RGB", (IMAGE_SIZE, IMAGE_SIZE), "red").save(image_paths[0])
+    os.utime(image_paths[0], ns=(0, 0))
+
+    # The stale entry is not served (the failing encode leaves the image out)
+    assert cache_latents(FailingVAE(), image_paths[:1], image_transform, device="cpu") == {}
+    assert cache_latents(tiny_vae, image_paths, image_transform, device="cpu") == latent_paths
+
+
+def test_cached_step_faster_than_encoding_step(tiny_vae, tiny_unet, image_paths):
+    scheduler = DDPMScheduler()
+    optimizer = torch.optim.AdamW(tiny_unet.parameters())
+    encoder_hidden_states = torch.randn(1, 77, 32)
+
+    def train_step(latents, noise):
+        timesteps = torch.randint(0, scheduler.config.num_train_timesteps, (1,))
+        noisy_latents = scheduler.add_noise(latents, noise, timesteps)
+        loss = torch.nn.functional.mse_loss(tiny_unet(noisy_latents, timesteps, encoder_hidden_states).sample, noise)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    def encoding_step(pixel_values):
+        # The loop before the cache: one encode for the noise shape, one for the latents
+        with torch.no_grad():
+            noise = torch.randn_like(tiny_vae.encode(pixel_values).latent_dist.sample())
+            latents = tiny_vae.encode(pixel_values).latent_dist.sample()
+        train_step(latents, noise)
+
+    def cached_step(latent):
+        latents = (latent["mean"] + latent["std"] * torch.randn_like(latent["std"])).unsqueeze(0)
+        train_step(latents, torch.randn_like(latents))
+
+    def seconds_per_step(step, inputs):
+        step(inputs[0])  # Warm-up
+        start_time = time.perf_counter()
+        for i in range(TIMED_STEPS):
+            step(inputs[i % len(inputs)])
+        return (time.perf_counter() - start_time) / TIMED_STEPS
+
+    pixel_values = []
+    for image_path in image_paths:
+        with Image.open(image_path) as img:
+            pixel_values.append(image_transform(img.convert("RGB")).unsqueeze(0))
+    latents = list(load_cached_latents(cache_latents(tiny_vae, image_paths, image_transform, device="cpu")).values())
+
+    encoding_seconds = seconds_per_step(encoding_step, pixel_values)
+    cached_seconds = seconds_per_step(cached_step, latents)
+    print(f"per step: encoding {encoding_seconds * 1000:.1f}ms, cached {cached_seconds * 1000:.1f}ms")
+    assert cached_seconds < encoding_seconds
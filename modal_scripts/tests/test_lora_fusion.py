@@ -0,0 +1,105 @@
+"""
+LoRAFuser on a tiny randomly initialised UNet
+
+The unfused reference adds each adapter's low-rank product next to the base
+layer with forward hooks, the way a LoRA layer runs before fusing.
+"""
+
+import copy
+
+import pytest
+import torch
+from diffusers import UNet2DConditionModel
+from torch import nn
+from torch.nn import functional as F
+
+from lora_fusion import LoRAFuser
+from test_multi_lora import TARGETS, make_adapter
+
+
+@pytest.fixture(scope="module")
+def unet():
+    torch.manual_seed(0)
+    return UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=8,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+        norm_num_groups=32,
+    ).eval()
+
+
+def add_lora_hooks(unet, state_dict, scale):
+    """Run every adapted layer as base(x) + scale * up(down(x)) without touching its weights"""
+    for key, down in state_dict.items():
+        if ".lora_A." not in key:
+            continue
+        up = state_dict[key.replace(".lora_A.", ".lora_B.")]
+        module = unet.get_submodule(key[len("unet."):-len(".lora_A.weight")])
+
+        def hook(module, args, output, down=down, up=up):
+            if isinstance(module, nn.Conv2d):
+                return output + scale * F.conv2d(F.conv2d(args[0], down), up)
+            return output + scale * F.linear(F.linear(args[0], down), up)
+
+        module.register_forward_hook(hook)
+
+
+def unet_inputs():
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(2, 4, 8, 8, generator=generator), 500, torch.randn(2, 77, 32, generator=generator)
+
+
+@torch.no_grad()
+def test_fused_output_matches_unfused_lora(unet):
+    adapters = {
+        "a": (make_adapter(unet, TARGETS, rank=4, seed=1), 1.0),
+        "b": (make_adapter(unet, ("to_q", "proj_in"), rank=8, seed=2), 0.5),
+    }
+    fuser = LoRAFuser(copy.deepcopy(unet))
+
+    for key, (state_dict, scale) in adapters.items():
+        reference = copy.deepcopy(unet)
+        add_lora_hooks(reference, state_dict, scale)
+        # Switching from "a" to "b" unfuses "a" first
+        fuser.fuse(key, state_dict, scale)
+        assert fuser.key == key
+        torch.testing.assert_close(fuser.unet(*unet_inputs()).sample, reference(*unet_inputs()).sample,
+                                   atol=1e-4, rtol=1e-4)
+
+    fuser.unfuse()
+    assert torch.equal(fuser.unet(*unet_inputs()).sample, unet(*unet_inputs()).sample)
+    metrics = fuser.metrics()
+    assert (metrics["fuses"], metrics["unfuses"], metrics["fused"]) == (2, 2, False)
+
+
+def test_unfuse_restores_weights_exactly(unet):
+    half = copy.deepcopy(unet).half()
+    original = {name: tensor.clone() for name, tensor in half.state_dict().items()}
+    fuser = LoRAFuser(half)
+
+    # fp16 rounding would build up if switching subtracted the deltas back out
+    for seed in range(1, 6):
+        fuser.fuse(f"adapter{seed}", make_adapter(unet, TARGETS, rank=4, seed=seed))
+    fuser.unfuse()
+
+    assert not fuser.fused
+    assert all(torch.equal(original[name], tensor) for name, tensor in half.state_dict().items())
+
+
+def test_failed_fuse_leaves_weights_untouched(unet):
+    fuser = LoRAFuser(copy.deepcopy(unet))
+    original = {name: tensor.clone() for name, tensor in fuser.unet.state_dict().items()}
+    state_dict = make_adapter(unet, TARGETS, rank=4, seed=1)
+    # Rank mismatch in the last module, after the others were already merged
+    last_up = [key for key in state_dict if ".lora_B." in key][-1]
+    state_dict[last_up] = state_dict[last_up][:, :3]
+
+    with pytest.raises(RuntimeError):
+        fuser.fuse("broken", state_dict)
+
+    assert not fuser.fused
+    assert all(torch.equal(original[name], tensor) for name, tensor in fuser.unet.state_dict().items())
@@ -0,0 +1,157 @@
+"""
+MultiAdapterLoRA on single layers and a tiny randomly initialised UNet
+
+The reference for every sample is the base layer with that sample's adapter
+merged into its weight, i.e. what loading one adapter at a time produces.
+"""
+
+import copy
+
+import pytest
+import torch
+from diffusers import UNet2DConditionModel
+from torch import nn
+
+from multi_lora import MultiAdapterLoRA, MultiLoRALayer
+
+# Linear attention projections plus the transformers' 1x1 convolutions
+TARGETS = ("attn1.to_q", "attn1.to_v", "attn2.to_k", "attn1.to_out.0", "proj_in", "proj_out")
+
+
+@pytest.fixture(scope="module")
+def unet():
+    torch.manual_seed(0)
+    return UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=8,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+        norm_num_groups=32,
+    ).eval()
+
+
+def make_factors(layer, rank, generator):
+    if isinstance(layer, nn.Conv2d):
+        in_features, out_features = layer.in_channels, layer.out_channels
+    else:
+        in_features, out_features = layer.in_features, layer.out_features
+    down = torch.randn(rank, in_features, generator=generator) * 0.1
+    up = torch.randn(out_features, rank, generator=generator) * 0.1
+    return down, up
+
+
+def make_adapter(unet, targets, rank, seed):
+    """Diffusers-layout LoRA state dict for the UNet modules whose names end with one of targets"""
+    generator = torch.Generator().manual_seed(seed)
+    state_dict = {}
+    for name, module in unet.named_modules():
+        if isinstance(module, (nn.Linear, nn.Conv2d)) and name.endswith(targets):
+            down, up = make_factors(module, rank, generator)
+            if isinstance(module, nn.Conv2d):
+                down, up = down[:, :, None, None], up[:, :, None, None]
+            state_dict[f"unet.{name}.lora_A.weight"] = down
+            state_dict[f"unet.{name}.lora_B.weight"] = up
+    return state_dict
+
+
+def merge(layer, down, up, scale):
+    merged = copy.deepcopy(layer)
+    with torch.no_grad():
+        delta = (up.reshape(up.shape[0], -1) @ down.reshape(down.shape[0], -1)) * scale
+        merged.weight += delta.reshape(merged.weight.shape)
+    return merged
+
+
+def merged_unet(unet, state_dict, scale):
+    merged = copy.deepcopy(unet)
+    for key, down in state_dict.items():
+        if ".lora_A." in key:
+            name = key[len("unet."):-len(".lora_A.weight")]
+            parent_name, _, child = name.rpartition(".")
+            parent = merged.get_submodule(parent_name)
+            up = state_dict[key.replace(".lora_A.", ".lora_B.")]
+            setattr(parent, child, merge(getattr(parent, child), down, up, scale))
+    return merged
+
+
+@pytest.mark.parametrize("base, shape", [
+    (nn.Linear(16, 24), (3, 7, 16)),
+    (nn.Conv2d(16, 24, 1), (3, 16, 5, 5)),
+])
+@torch.no_grad()
+def test_layer_matches_per_sample_adapters(base, shape):
+    generator = torch.Generator().manual_seed(0)
+    adapters = {1: (*make_factors(base, 4, generator), 1.0), 2: (*make_factors(base, 8, generator), 0.5)}
+    layer = MultiLoRALayer(base, num_slots=3)
+    for slot, factors in adapters.items():
+        layer.set_slot(slot, *factors)
+
+    x = torch.randn(*shape, generator=generator)
+    slots = [1, 2, 0]
+    expected = torch.stack([
+        merge(base, *adapters[slot])(x[i:i + 1])[0] if slot else base(x[i:i + 1])[0]
+        for i, slot in enumerate(slots)
+    ])
+
+    layer.adapter_ids = torch.tensor(slots)
+    torch.testing.assert_close(layer(x), expected, atol=1e-5, rtol=1e-5)
+    # Classifier-free guidance: the same samples twice, ids given once
+    torch.testing.assert_close(layer(torch.cat([x, x])), torch.cat([expected, expected]), atol=1e-5, rtol=1e-5)
+
+    layer.adapter_ids = None
+    assert torch.equal(layer(x), base(x))
+
+
+@torch.no_grad()
+def test_mixed_batch_matches_one_adapter_at_a_time(unet):
+    adapters = [
+        (make_adapter(unet, TARGETS, rank=4, seed=1), 1.0),
+        (make_adapter(unet, ("to_q", "proj_in"), rank=8, seed=2), 0.5),
+    ]
+    references = [merged_unet(unet, state_dict, scale) for state_dict, scale in adapters] + [unet]
+
+    multi_lora = MultiAdapterLoRA(copy.deepcopy(unet), max_adapters=2)
+    slots = [multi_lora.load(f"a{i}", state_dict, scale) for i, (state_dict, scale) in enumerate(adapters)] + [0]
+    assert any(layer.is_conv for layer in multi_lora.layers.values())
+
+    generator = torch.Generator().manual_seed(0)
+    sample = torch.randn(3, 4, 8, 8, generator=generator)
+    uncond = torch.randn(3, 77, 32, generator=generator)
+    cond = torch.randn(3, 77, 32, generator=generator)
+
+    # The pipeline runs the unconditional and conditional halves as one doubled batch
+    multi_lora.set_batch(slots)
+    mixed = multi_lora.unet(torch.cat([sample, sample]), 500, torch.cat([uncond, cond])).sample
+
+    for i, reference in enumerate(references):
+        expected = reference(
+            torch.cat([sample[i:i + 1]] * 2), 500, torch.cat([uncond[i:i + 1], cond[i:i + 1]])
+        ).sample
+        torch.testing.assert_close(mixed[[i, i + 3]], expected, atol=1e-4, rtol=1e-4)
+
+    multi_lora.set_batch(None)
+    torch.testing.assert_close(multi_lora.unet(sample, 500, cond).sample, unet(sample, 500, cond).sample)
+
+
+def test_eviction_skips_protected_slots(unet):
+    multi_lora = MultiAdapterLoRA(copy.deepcopy(unet), max_adapters=2)
+    slot_a = multi_lora.load("a", make_adapter(unet, ("to_q",), rank=4, seed=1))
+    slot_b = multi_lora.load("b", make_adapter(unet, ("to_q", "proj_in"), rank=4, seed=2))
+
+    # "a" is least recently used, but the batch being built needs it
+    slot_c = multi_lora.load("c", make_adapter(unet, ("to_q",), rank=4, seed=3), protected=[slot_a])
+    assert slot_c == slot_b
+    assert multi_lora.load("a", {}) == slot_a
+
+    # The evicted adapter's factors are gone from layers the new one does not use
+    proj_in = [layer for name, layer in multi_lora.layers.items() if name.endswith("proj_in")]
+    assert proj_in and all(not layer.lora_up[slot_c].any() for layer in proj_in)
+
+    with pytest.raises(RuntimeError):
+        multi_lora.load("d", make_adapter(unet, ("to_q",), rank=4, seed=4), protected=[slot_a, slot_c])
+
+    metrics = multi_lora.metrics()
+    assert (metrics["loads"], metrics["hits"], metrics["evictions"], metrics["resident_adapters"]) == (3, 1, 1, 2)
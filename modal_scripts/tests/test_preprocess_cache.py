@@ -0,0 +1,53 @@
+"""
+Content-addressed preprocessing cache (process_images with cache_dir, evict_cache)
+"""
+
+import io
+import os
+import base64
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_preprocessing import evict_cache, process_images
+
+
+@pytest.fixture
+def uploads():
+    rng = np.random.default_rng(0)
+    entries = []
+    for _ in range(3):
+        buffered = io.BytesIO()
+        Image.fromarray((rng.random((600, 800, 3)) * 255).astype(np.uint8)).save(buffered, format="JPEG")
+        entries.append({"base64Data": base64.b64encode(buffered.getvalue()).decode()})
+    return entries
+
+
+def test_relative_cache_dir(uploads, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("job_a")
+    os.makedirs("job_b")
+
+    misses = process_images(uploads, "job_a", parallel=False, cache_dir="cache")
+    hits = process_images(uploads, "job_b", parallel=False, cache_dir="cache")
+
+    assert [(r["status"], r["cache"]) for r in misses] == [("processed", "miss")] * len(uploads)
+    assert [(r["status"], r["cache"]) for r in hits] == [("processed", "hit")] * len(uploads)
+    for record in misses + hits:
+        with Image.open(record["path"]) as img:
+            img.load()
+
+
+def test_eviction_keeps_job_files(uploads, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    training_dir = str(tmp_path / "job")
+    os.makedirs(training_dir)
+    records = process_images(uploads, training_dir, parallel=False, cache_dir=cache_dir)
+
+    # Another job's eviction empties the cache while this job is still training
+    assert evict_cache(cache_dir, max_bytes=0) > 0
+    assert not any(files for _, _, files in os.walk(cache_dir))
+    for record in records:
+        with Image.open(record["path"]) as img:
+            assert img.size == (512, 512)
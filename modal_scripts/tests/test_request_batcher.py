@@ -0,0 +1,144 @@
+"""
+RequestBatcher with a fake run_batch that doubles its payloads
+
+Negative payloads come back as per-request errors and a payload of None
+fails the whole batch; an optional gate holds the worker thread inside
+run_batch so requests pile up behind it.
+"""
+
+import time
+import threading
+
+import pytest
+
+from request_batcher import RequestBatcher
+
+
+class FakeRunBatch:
+    def __init__(self, gate=None):
+        self.calls = []
+        self.gate = gate
+        self.running = threading.Event()
+
+    def __call__(self, key, payloads):
+        self.calls.append((key, list(payloads)))
+        self.running.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        if None in payloads:
+            raise RuntimeError("out of memory")
+        return [ValueError(f"bad payload {p}") if p < 0 else p * 2 for p in payloads]
+
+
+@pytest.fixture
+def make_batcher():
+    batchers = []
+
+    def make(run_batch, **kwargs):
+        batcher = RequestBatcher(run_batch, **kwargs)
+        batchers.append(batcher)
+        return batcher
+
+    yield make
+    for batcher in batchers:
+        batcher.close(timeout=5)
+
+
+def submit_all(batcher, requests):
+    """Submit (key, payload) pairs from one thread each; returns results or exceptions by index"""
+    outcomes = {}
+
+    def submit(index, key, payload):
+        try:
+            outcomes[index] = batcher.submit(key, payload, timeout=5)
+        except Exception as e:
+            outcomes[index] = e
+
+    threads = [threading.Thread(target=submit, args=(i, *request)) for i, request in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [outcomes[i] for i in range(len(requests))]
+
+
+def test_compatible_requests_share_a_batch(make_batcher):
+    gate = threading.Event()
+    run_batch = FakeRunBatch(gate)
+    batcher = make_batcher(run_batch, max_batch_size=3, window_seconds=0.2)
+
+    # The first batch holds the worker, so the rest queue up behind it
+    first = threading.Thread(target=batcher.submit, args=("a", 0))
+    first.start()
+    run_batch.running.wait(5)
+    requests = [("a", 1), ("b", 10), ("a", 2), ("a", 3), ("a", 4)]
+    outcomes = []
+    waiting = threading.Thread(target=lambda: outcomes.extend(submit_all(batcher, requests)))
+    waiting.start()
+    while sum(batcher.queue_depths().values()) < len(requests):
+        time.sleep(0.01)
+    gate.set()
+    waiting.join()
+    first.join()
+
+    assert outcomes == [2, 20, 4, 6, 8]
+    keys = [key for key, _ in run_batch.calls]
+    sizes = [len(payloads) for _, payloads in run_batch.calls]
+    assert keys[0] == "a" and sorted(keys[1:]) == ["a", "a", "b"]
+    assert sorted(sizes) == [1, 1, 1, 3]
+    assert all(len(payloads) <= 3 for _, payloads in run_batch.calls)
+
+
+def test_errors_fail_only_their_requests(make_batcher):
+    run_batch = FakeRunBatch()
+    batcher = make_batcher(run_batch, max_batch_size=3, window_seconds=1.0)
+
+    outcomes = submit_all(batcher, [("a", 1), ("a", -1), ("a", 2)])
+    assert outcomes[0] == 2 and outcomes[2] == 4
+    assert isinstance(outcomes[1], ValueError)
+
+    # An exception from run_batch itself fails the whole batch
+    outcomes = submit_all(batcher, [("a", 1), ("a", None)])
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert batcher.submit("a", 5) == 10
+
+    metrics = batcher.metrics()
+    assert (metrics["requests"], metrics["batches"], metrics["failed_batches"], metrics["pending"]) == (6, 3, 1, 0)
+    assert metrics["batch_size_histogram"] == {1: 1, 2: 1, 3: 1}
+    assert metrics["mean_batch_size"] == 2.0
+    assert metrics["latency_ms"]["max"] >= metrics["queue_delay_ms"]["max"] >= 0
+
+
+def test_timed_out_request_is_not_run(make_batcher):
+    gate = threading.Event()
+    run_batch = FakeRunBatch(gate)
+    batcher = make_batcher(run_batch, max_batch_size=4, window_seconds=0.0)
+
+    first = threading.Thread(target=batcher.submit, args=("a", 1))
+    first.start()
+    run_batch.running.wait(5)
+    with pytest.raises(TimeoutError):
+        batcher.submit("a", 2, timeout=0.1)
+
+    assert batcher.queue_depths() == {}
+    gate.set()
+    first.join()
+    assert batcher.submit("a", 3) == 6
+    assert [payloads for _, payloads in run_batch.calls] == [[1], [3]]
+    assert batcher.metrics()["timeouts"] == 1
+
+
+def test_limit_is_computed_outside_the_lock(make_batcher):
+    unblocked = []
+
+    def max_batch_size(key):
+        # A memory query that takes a while; submit() and metrics() must not wait for it
+        probe = threading.Thread(target=batcher.queue_depths)
+        probe.start()
+        probe.join(1)
+        unblocked.append(not probe.is_alive())
+        return 2
+
+    batcher = make_batcher(FakeRunBatch(), max_batch_size=max_batch_size, window_seconds=0.0)
+    assert batcher.submit("a", 1) == 2
+    assert unblocked == [True]
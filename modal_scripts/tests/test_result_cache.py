@@ -0,0 +1,101 @@
+"""
+ResultCache on a shared directory standing in for the volume
+
+Two ResultCache instances on the same root play two containers; the reload
+callback is a no-op because both already see the same files.
+"""
+
+import threading
+
+import pytest
+
+from result_cache import ResultCache, result_cache_key
+
+
+def make_compute(calls, value=b"image"):
+    def compute():
+        calls.append(value)
+        return value, {"final_prompt": "a photo"}
+    return compute
+
+
+@pytest.fixture
+def key():
+    return result_cache_key(model_id="m1", prompt="a photo", seed=1)
+
+
+def test_hit_after_miss_and_coalescing(tmp_path, key):
+    cache = ResultCache(str(tmp_path))
+    calls = []
+    started, release = threading.Event(), threading.Event()
+
+    def slow_compute():
+        started.set()
+        release.wait(5)
+        return make_compute(calls)()
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.get_or_compute(key, slow_compute)))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=lambda: results.append(cache.get_or_compute(key, make_compute(calls))))
+    second.start()
+    release.set()
+    first.join()
+    second.join()
+
+    assert sorted(served for _, _, served in results) == ["coalesced", "miss"]
+    assert cache.get_or_compute(key, make_compute(calls))[2] == "hit"
+    assert calls == [b"image"]
+
+
+def test_request_during_store_is_not_recomputed(tmp_path, key, monkeypatch):
+    cache = ResultCache(str(tmp_path))
+    calls = []
+    storing, stored = threading.Event(), threading.Event()
+    put = cache.put
+
+    def slow_put(*args, **kwargs):
+        storing.set()
+        stored.wait(5)
+        put(*args, **kwargs)
+
+    monkeypatch.setattr(cache, "put", slow_put)
+    first = threading.Thread(target=cache.get_or_compute, args=(key, make_compute(calls)))
+    first.start()
+    storing.wait(5)
+
+    # The entry is not written yet, but the finished computation is still in flight
+    assert cache.get_or_compute(key, make_compute(calls))[2] == "coalesced"
+    stored.set()
+    first.join()
+    assert calls == [b"image"]
+
+
+def test_other_container_entries_after_reload(tmp_path, key):
+    reloads = []
+    container_a = ResultCache(str(tmp_path))
+    container_b = ResultCache(str(tmp_path), reload=lambda: reloads.append(1), reload_interval=60)
+    unsynced = ResultCache(str(tmp_path))
+    calls = []
+
+    # Container A serves the request; the retry lands on container B
+    assert container_a.get_or_compute(key, make_compute(calls))[2] == "miss"
+    data, meta, served = container_b.get_or_compute(key, make_compute(calls, b"other"))
+    assert (data, meta, served) == (b"image", {"final_prompt": "a photo"}, "hit")
+    assert calls == [b"image"]
+    assert len(reloads) == 1
+
+    # Without a reload callback the index is only read at startup
+    assert unsynced.get_or_compute(key, make_compute(calls, b"other"))[2] == "miss"
+
+
+def test_reloads_are_throttled(tmp_path):
+    reloads = []
+    cache = ResultCache(str(tmp_path), reload=lambda: reloads.append(1), reload_interval=60)
+    calls = []
+
+    for seed in range(3):
+        assert cache.get_or_compute(result_cache_key(seed=seed), make_compute(calls))[2] == "miss"
+    assert len(reloads) == 1
+    assert cache.metrics()["reloads"] == 1
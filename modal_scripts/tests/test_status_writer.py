@@ -0,0 +1,152 @@
+"""
+StatusWriter against a local stand-in for the status callback and PostgREST
+
+The stand-in is a plain http.server: PATCH /rest/v1/trained_models?id=eq.<id>
+updates an in-memory row, POST /callback does the same and answers 400 to
+payloads with fields beyond the essential ones when strict, and any other
+POST path answers 404.
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from status_writer import ESSENTIAL_FIELDS, StatusWriter
+
+
+class StatusServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StatusHandler)
+        self.requests = []
+        self.rows = {}
+        self.connections = set()
+        self.strict_callback = False
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so connection reuse is visible
+
+    def log_message(self, *args):
+        pass
+
+    def _read_json(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.connections.add(self.client_address)
+        self.server.requests.append((self.command, urlparse(self.path).path, body))
+        return body
+
+    def _reply(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_PATCH(self):
+        body = self._read_json()
+        model_id = parse_qs(urlparse(self.path).query)["id"][0].split("eq.", 1)[1]
+        self.server.rows.setdefault(model_id, {}).update(body)
+        self._reply(204)
+
+    def do_POST(self):
+        body = self._read_json()
+        if urlparse(self.path).path != "/callback":
+            self._reply(404)
+            return
+        if self.server.strict_callback and set(body) - {"id", *ESSENTIAL_FIELDS}:
+            self._reply(400)
+            return
+        self.server.rows.setdefault(str(body["id"]), {}).update(body)
+        self._reply(200)
+
+
+@pytest.fixture
+def server():
+    server = StatusServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_writer():
+    writers = []
+
+    def make(**kwargs):
+        # A long interval, so only explicit and terminal flushes write
+        writer = StatusWriter(**{"interval": 60, "max_attempts": 1, **kwargs})
+        writers.append(writer)
+        return writer
+
+    yield make
+    for writer in writers:
+        writer.close(timeout=5)
+
+
+def test_updates_coalesce_per_model(server, make_writer):
+    writer = make_writer(supabase_url=server.url, supabase_key="key")
+
+    for step in range(100):
+        assert writer.update("m1", {"status": "training", "progress": step})
+        assert writer.update("m2", {"status": "training", "progress": step * 2})
+    writer.update("m1", {"model_url": "https://example.com/m1"})
+    assert server.requests == []
+
+    assert writer.flush()
+    assert sorted(path for _, path, _ in server.requests) == ["/rest/v1/trained_models"] * 2
+    assert server.rows == {
+        "m1": {"status": "training", "progress": 99, "model_url": "https://example.com/m1"},
+        "m2": {"status": "training", "progress": 198},
+    }
+
+    writer.update("m1", {"progress": 100})
+    assert writer.flush()
+    assert len(server.requests) == 3
+    assert len(server.connections) == 1
+
+    metrics = writer.metrics()
+    assert (metrics["updates"], metrics["writes"], metrics["coalesced"], metrics["dropped"]) == (202, 3, 199, 0)
+
+
+def test_rejected_callback_resends_essential_fields(server, make_writer):
+    server.strict_callback = True
+    writer = make_writer(callback_url=f"{server.url}/callback")
+
+    writer.update("m1", {"status": "training", "progress": 40, "current_step": 200, "loss": 0.12})
+    assert writer.flush()
+
+    assert [(method, body) for method, _, body in server.requests] == [
+        ("POST", {"id": "m1", "status": "training", "progress": 40, "current_step": 200, "loss": 0.12}),
+        ("POST", {"id": "m1", "status": "training", "progress": 40}),
+    ]
+    assert writer.metrics()["dropped"] == 0
+
+
+def test_terminal_status_is_written_before_update_returns(server, make_writer):
+    writer = make_writer(callback_url=f"{server.url}/missing", supabase_url=server.url, supabase_key="key")
+
+    writer.update("m1", {"status": "training", "progress": 90})
+    assert writer.update("m1", {"status": "completed", "progress": 100, "model_url": "https://example.com/m1"})
+
+    # The callback failed, so the REST fallback got the merged update
+    assert server.rows["m1"]["status"] == "completed"
+    assert server.rows["m1"]["model_url"] == "https://example.com/m1"
+    assert server.requests[-1][0] == "PATCH"
+
+
+def test_failed_terminal_write_is_reported(make_writer):
+    # Nothing listens on the discard port
+    writer = make_writer(callback_url="http://127.0.0.1:9/callback", timeout=1)
+
+    assert not writer.update("m1", {"status": "failed", "error_message": "boom"})
+    metrics = writer.metrics()
+    assert (metrics["failed_writes"], metrics["dropped"]) == (1, 1)
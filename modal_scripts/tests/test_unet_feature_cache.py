@@ -0,0 +1,89 @@
+"""
+UNetFeatureCache on a tiny randomly initialised UNet with the SD 1.x block layout
+"""
+
+import pytest
+import torch
+from diffusers import UNet2DConditionModel
+
+from unet_feature_cache import UNetFeatureCache
+
+
+@pytest.fixture(scope="module")
+def unet():
+    torch.manual_seed(0)
+    return UNet2DConditionModel(
+        block_out_channels=(32, 64, 64, 64),
+        layers_per_block=2,
+        sample_size=16,
+        down_block_types=("CrossAttnDownBlock2D",) * 3 + ("DownBlock2D",),
+        up_block_types=("UpBlock2D",) + ("CrossAttnUpBlock2D",) * 3,
+        cross_attention_dim=32,
+        attention_head_dim=8,
+        norm_num_groups=32,
+    ).eval()
+
+
+def unet_inputs(batch_size, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    sample = torch.randn(batch_size, 4, 16, 16, generator=generator)
+    encoder_hidden_states = torch.randn(batch_size, 77, 32, generator=generator)
+    return sample, torch.tensor(500), encoder_hidden_states
+
+
+@torch.no_grad()
+def test_cached_step_matches_full_step(unet):
+    cache = UNetFeatureCache(unet)
+    inputs = unet_inputs(2)
+    plain = unet(*inputs).sample
+
+    with cache.enabled(3):
+        full = unet(*inputs).sample
+        # Same input as the step that filled the cache, so only the shallow path differs
+        cached = unet(*inputs).sample
+        cached_tuple = unet(*inputs, return_dict=False)
+
+    assert torch.equal(full, plain)
+    assert torch.equal(cached, plain)
+    assert isinstance(cached_tuple, tuple) and torch.equal(cached_tuple[0], plain)
+    assert cache.metrics() == {"full_steps": 1, "cached_steps": 2, "cached_share": 0.667}
+
+
+@torch.no_grad()
+def test_batch_size_change_refreshes(unet):
+    cache = UNetFeatureCache(unet)
+    conditioned = unet_inputs(2)
+    unconditioned = unet_inputs(1, seed=1)
+
+    with cache.enabled(10):
+        unet(*conditioned)
+        # Guidance turned off: the cached features are for two samples per image
+        output = unet(*unconditioned).sample
+        unet(*unconditioned)
+
+    assert torch.equal(output, unet(*unconditioned).sample)
+    assert cache.metrics()["full_steps"] == 2
+    assert cache.metrics()["cached_steps"] == 1
+
+
+@torch.no_grad()
+def test_forward_restored_on_exit(unet):
+    cache = UNetFeatureCache(unet)
+    inputs = unet_inputs(1)
+
+    with pytest.raises(RuntimeError):
+        with cache.enabled(3):
+            assert "forward" in unet.__dict__
+            unet(*inputs)
+            raise RuntimeError("generation failed")
+
+    assert "forward" not in unet.__dict__
+    assert unet.forward.__func__ is UNet2DConditionModel.forward
+    assert not unet.up_blocks[-2]._forward_hooks
+    assert cache._features is None
+
+    # Interval 1 leaves the UNet alone
+    with cache.enabled(1):
+        assert "forward" not in unet.__dict__
+        unet(*inputs)
+    assert cache.metrics()["full_steps"] == 1
@@ -20,6 +20,10 @@ from modal import Image, Secret, Volume, Mount
 from modal import web_endpoint, asgi_app
 from modal import App, Stub
 
+from http_download import download_images
+from image_preprocessing import decode_to_target, save_training_image
+from status_writer import get_status_writer
+
 # Constants
 VOLUME_MOUNT_PATH = "/model-data"
 
@@ -65,131 +69,77 @@ image = (
     .apt_install(["git", "wget", "build-essential", "libgl1"])
     .pip_install(["pillow", "numpy", "diffusers", "transformers", "huggingface-hub", "accelerate", "safetensors", "ftfy", "requests", "supabase"])
     .run_function(setup_kohya_dependencies)
+    .add_local_python_source(
+        # Sibling modules imported above; Modal no longer mounts local modules automatically
+        "image_preprocessing",
+        "input_stream",
+        "image_screening",
+        "http_download",
+        "status_writer",
+    )
 )
 
 # Function to update Supabase with training status
 def update_supabase_status(model_id, status, error=None, model_url=None, model_info=None, sample_image=None):
-    """Update the training status in Supabase using multiple fallback mechanisms"""
+    """
+    Update the training status through the shared status writer
+    
+    The callback URL is tried first and the Supabase REST API is the fallback.
+    Updates are merged per model and written in batches over a pooled
+    connection; terminal statuses are written right away.
+    """
     print(f"Updating Supabase status for model {model_id} to {status}")
     
-    success = False
+    callback_url = os.environ.get('CALLBACK_URL')
+    supabase_url = os.environ.get('SUPABASE_URL')
+    supabase_key = os.environ.get('SUPABASE_KEY')
+    if not callback_url and not (supabase_url and supabase_key):
+        print("No callback URL or Supabase credentials available for status update")
+        return False
     
-    # Method 1: Try using the callback URL if provided
     try:
-        callback_url = os.environ.get('CALLBACK_URL')
-        if callback_url:
-            print(f"Sending status update to callback URL: {callback_url}")
-            import requests
+        # Prepare the update data - only include fields that exist in the schema
+        update_data = {"status": status}
+        
+        # Only add these fields if they're not None
+        if error is not None:
+            update_data["error_message"] = error
             
-            # Prepare the payload for the callback
-            payload = {
-                "id": model_id,
-                "status": status
-            }
+        if model_url is not None:
+            update_data["model_url"] = model_url
             
-            # Only add these fields if they're not None/NaN
-            if error is not None:
-                payload["error_message"] = error
-                
-            if model_url is not None:
-                payload["model_url"] = model_url
-                
-            if model_info is not None:
-                # Convert any non-serializable values in model_info
-                sanitized_model_info = {}
-                for key, value in model_info.items():
-                    if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
-                        sanitized_model_info[key] = str(value)
-                    else:
-                        sanitized_model_info[key] = value
-                        
-                payload["model_info"] = sanitized_model_info
-                
-            if sample_image is not None:
-                payload["sample_image"] = sample_image
-                
-            # Check for NaN/None values throughout the payload
-            for key in list(payload.keys()):
-                if payload[key] is None:
-                    del payload[key]
-            
-            print(f"Callback payload: {json.dumps({k: str(v) if isinstance(v, dict) else v for k, v in payload.items()})}")
-                
-            headers = {"Content-Type": "application/json"}
-            response = requests.post(callback_url, json=payload, headers=headers)
-            print(f"Callback response: {response.status_code} - {response.text}")
+        if model_info is not None:
+            # Convert any non-serializable values in model_info
+            sanitized_model_info = {}
+            for key, value in model_info.items():
+                if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+                    sanitized_model_info[key] = str(value)
+                else:
+                    sanitized_model_info[key] = value
+                    
+            update_data["model_info"] = sanitized_model_info
             
-            if response.status_code == 200:
-                success = True
-            else:
-                print(f"Failed to update status via callback: {response.status_code} - {response.text}")
-        else:
-            print("No callback URL provided")
+        if sample_image is not None:
+            update_data["sample_image"] = sample_image
+        
+        writer = get_status_writer(
+            callback_url=callback_url,
+            supabase_url=supabase_url,
+            supabase_key=supabase_key
+        )
+        written = writer.update(model_id, update_data)
+        if status in ("completed", "failed"):
+            print(f"Status writes: {json.dumps(writer.metrics())}")
+        return written
     except Exception as e:
-        print(f"Error sending callback: {str(e)}")
-    
-    # Method 2: Try using the Supabase Python client if credentials are available
-    if not success:
-        try:
-            supabase_url = os.environ.get('SUPABASE_URL')
-            supabase_key = os.environ.get('SUPABASE_KEY')
-            
-            if supabase_url and supabase_key:
-                print("Using Supabase Python client as fallback")
-                from supabase import create_client
-                
-                # Connect to Supabase
-                supabase = create_client(supabase_url, supabase_key)
-                
-                # Prepare the update data - only include fields that exist in the schema
-                update_data = {"status": status}
-                
-                # Only add these fields if they're not None
-                if error is not None:
-                    update_data["error_message"] = error
-                    
-                if model_url is not None:
-                    update_data["model_url"] = model_url
-                    
-                if model_info is not None:
-                    # Sanitize model_info
-                    sanitized_model_info = {}
-                    for key, value in model_info.items():
-                        if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
-                            sanitized_model_info[key] = str(value)
-                        else:
-                            sanitized_model_info[key] = value
-                            
-                    update_data["model_info"] = sanitized_model_info
-                    
-                if sample_image is not None:
-                    update_data["sample_image"] = sample_image
-                
-                # Log the payload for debugging
-                print(f"Supabase Python client payload: {json.dumps(update_data)}")
-                
-                # Update the database
-                result = supabase.table('trained_models').update(update_data).eq('id', model_id).execute()
-                
-                # Log the response for debugging
-                print(f"Supabase Python client response: {result}")
-                
-                if result:
-                    print(f"Successfully updated Supabase status directly via client: {status}")
-                    success = True
-            else:
-                print("Supabase credentials not available for direct update")
-        except Exception as e:
-            print(f"Error updating Supabase directly: {str(e)}")
-    
-    return success
+        print(f"Error updating status: {str(e)}")
+        return False
 
 @app.function(volumes={VOLUME_MOUNT_PATH: volume})
 def preprocess_images(model_id, image_data_list, instance_prompt):
     """Preprocess images for training"""
     import os
     import base64
-    import requests
     from PIL import Image
     import io
     import json
@@ -203,9 +153,31 @@ def preprocess_images(model_id, image_data_list, instance_prompt):
     dataset_dir = os.path.join(model_dir, "train")
     os.makedirs(dataset_dir, exist_ok=True)
     
-    # Metadata for the dataset
-    metadata = []
-    processed_count = 0
+    # Metadata for the dataset, by image index
+    metadata = {}
+    decoded = []
+    url_jobs = {}
+    
+    def save_image(i, image_data, img_data):
+        """Decode one image near 512x512, save it, record its metadata and return the decode stats"""
+        img, decode_stats = decode_to_target(img_data)
+        print(f"Decoded image {i} ({decode_stats['original_size'][0]}x{decode_stats['original_size'][1]}) "
+              f"in {decode_stats['decode_seconds']:.3f}s, peak RSS {decode_stats['peak_rss_mb']} MB")
+        
+        # Save the image (uploads that already are 512x512 RGB JPEGs are copied as is)
+        img_filename = f"{i:05d}.jpg"
+        img_path = os.path.join(dataset_dir, img_filename)
+        save_training_image(img, img_data, img_path, "JPEG")
+        
+        # Get the caption, defaulting to the instance prompt if not provided
+        caption = image_data.get("caption", instance_prompt).strip()
+        
+        # Add to metadata
+        metadata[i] = {
+            "file_name": img_filename,
+            "text": caption
+        }
+        return decode_stats
     
     # Log volume contents for debugging
     print(f"Volume contents: {os.listdir(VOLUME_MOUNT_PATH)}")
@@ -222,18 +194,14 @@ def preprocess_images(model_id, image_data_list, instance_prompt):
                 except IndexError:
                     # Assume it's already base64 without data URL prefix
                     img_data = base64.b64decode(image_data["base64Data"])
-                img = Image.open(io.BytesIO(img_data))
             # Check if we have a URL or file path
             elif "imageUrl" in image_data and image_data["imageUrl"]:
                 image_url = image_data["imageUrl"]
                 # Check if this is a local file path
                 if image_url.startswith("http"):
-                    # Download the image
-                    response = requests.get(image_url, stream=True)
-                    if response.status_code != 200:
-                        print(f"Failed to download image {i} from {image_url}: {response.status_code}")
-                        continue
-                    img = Image.open(io.BytesIO(response.content))
+                    # Downloaded concurrently below
+                    url_jobs[i] = image_url
+                    continue
                 else:
                     # It's a local file path
                     try:
@@ -248,7 +216,9 @@ def preprocess_images(model_id, image_data_list, instance_prompt):
                         else:
                             abs_path = image_url
                         
-                        img = Image.open(abs_path)
+                        with open(abs_path, "rb") as f:
+                            img_data = f.read()
+                        img = Image.open(io.BytesIO(img_data))
                         
                         # Convert to base64 for storage
                         buffer = io.BytesIO()
@@ -262,32 +232,33 @@ def preprocess_images(model_id, image_data_list, instance_prompt):
                 print(f"Skipping image {i}: No base64Data field or imageUrl field")
                 continue
             
-            # Save the image
-            img_filename = f"{i:05d}.jpg"
-            img_path = os.path.join(dataset_dir, img_filename)
-            img.save(img_path, "JPEG")
-            
-            # Get the caption, defaulting to the instance prompt if not provided
-            caption = image_data.get("caption", instance_prompt).strip()
-            
-            # Add to metadata
-            metadata.append({
-                "file_name": img_filename,
-                "text": caption
-            })
-            
-            processed_count += 1
+            decoded.append(save_image(i, image_data, img_data))
             
         except Exception as e:
             print(f"Failed to process image {i}: {str(e)}")
     
+    if url_jobs:
+        # Fetch over one pooled session, decoding each image as soon as it arrives
+        download_start = time.time()
+        downloads = download_images(
+            url_jobs,
+            lambda i, img_data: save_image(i, image_data_list[i], img_data)
+        )
+        decoded.extend(record["result"] for record in downloads.values() if record["status"] == "downloaded")
+        print(f"Downloaded {sum(record['bytes'] for record in downloads.values())} bytes for {len(url_jobs)} images "
+              f"in {time.time() - download_start:.2f}s "
+              f"({sum(max(record['attempts'] - 1, 0) for record in downloads.values())} retries)")
+    
     # Save the metadata
     metadata_file = os.path.join(model_dir, "metadata.jsonl")
     with open(metadata_file, "w") as f:
-        for item in metadata:
-            f.write(json.dumps(item) + "\n")
+        for i in sorted(metadata):
+            f.write(json.dumps(metadata[i]) + "\n")
     
+    processed_count = len(metadata)
     print(f"Successfully processed {processed_count} images")
+    print(f"Decoding took {sum(stats['decode_seconds'] for stats in decoded):.2f}s in total, "
+          f"peak RSS {max((stats['peak_rss_mb'] for stats in decoded), default=0.0)} MB")
     return processed_count > 0, dataset_dir
 
 @app.function(gpu="T4", volumes={VOLUME_MOUNT_PATH: volume}, secrets=[secrets])
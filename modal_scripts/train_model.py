@@ -6,9 +6,16 @@ import json
 from pathlib import Path
 from typing import Dict, List, Optional, Any
 import argparse
+import uuid
 
 import modal
 # Import torch and other dependencies only inside the Modal functions where they're needed
+from dataset_shards import ShardReader, write_shards
+from image_output import ImageOutput, resolve_output, save_binary_outputs
+from image_preprocessing import available_cpus, evict_cache, process_images, screen_records
+from input_stream import load_input_params, stage_image_entries
+from job_datasets import job_dataset_dir
+from status_writer import STATUS_WRITE_INTERVAL, get_status_writer
 
 # Define the Modal image with all necessary dependencies
 image = modal.Image.debian_slim(python_version="3.10").pip_install(
@@ -24,6 +31,15 @@ image = modal.Image.debian_slim(python_version="3.10").pip_install(
     "huggingface_hub==0.15.1",
     "Pillow==9.5.0",
     "peft==0.4.0",
+).add_local_python_source(
+    # Sibling modules imported above; Modal no longer mounts local modules automatically
+    "image_preprocessing",
+    "input_stream",
+    "image_screening",
+    "job_datasets",
+    "dataset_shards",
+    "status_writer",
+    "image_output",
 )
 
 # Define the Modal app
@@ -33,40 +49,54 @@ app = modal.App("custom-image-model-trainer", image=image)
 volume = modal.Volume.from_name("model-training-data", create_if_missing=True)
 VOLUME_MOUNT_PATH = "/model-data"
 
-@app.function(volumes={VOLUME_MOUNT_PATH: volume})
-def preprocess_images(image_data_list: List[Dict[str, Any]]) -> List[str]:
+# Volume folder that uploads are staged in before preprocessing
+UPLOADS_DIRNAME = "uploads"
+
+# Content-addressed cache of processed images shared by all jobs
+PREPROCESS_CACHE_DIR = f"{VOLUME_MOUNT_PATH}/preprocess_cache"
+
+# CPUs reserved for the preprocessing container (one pool worker per CPU)
+PREPROCESS_CPUS = 4.0
+
+# Folder (next to the processed images) holding the cached VAE latents
+LATENT_CACHE_DIRNAME = "latents"
+
+# Folder (inside a job's dataset directory) holding the packed dataset shards
+SHARDS_DIRNAME = "shards"
+
+@app.function(volumes={VOLUME_MOUNT_PATH: volume}, cpu=PREPROCESS_CPUS)
+def preprocess_images(
+    image_data_list: List[Dict[str, Any]],
+    job_id: Optional[str] = None,
+    parallel: bool = True,
+    max_workers: Optional[int] = None,
+    use_cache: bool = True
+) -> Dict[str, Any]:
     """
     Preprocess uploaded images for training
     
     Args:
-        image_data_list: List of dictionaries with base64 encoded images and metadata
+        image_data_list: List of dictionaries with the images (base64Data, or imagePath
+            of an upload staged on the volume) and metadata
+        job_id: ID of the training job; its images are written to a dataset
+            directory of their own (a new ID is generated if omitted)
+        parallel: Process images in a process pool sized to the container's CPUs
+        max_workers: Override the pool size
+        use_cache: Reuse processed images from earlier jobs (keyed by image content)
         
     Returns:
-        List of paths to processed images
+        Dictionary with the job ID and dataset directory, the processed image paths, a per-image record
+        (status, failure or screening reason, screening metrics, cache outcome,
+        decode time and peak RSS, and processing time) in upload order,
+        cache hit/miss counts and the packed shards ("shards", with the index
+        path to pass to train_lora_model)
     """
-    # Import PIL inside the function where it's used
-    from PIL import Image, ImageOps
-    import numpy as np
-    
-    # Ensure directory exists and clear any previous images
-    training_dir = f"{VOLUME_MOUNT_PATH}/training_images"
+    # Each job writes to its own dataset directory, so concurrent jobs never
+    # see each other's images
+    job_id = job_id or uuid.uuid4().hex
+    training_dir = job_dataset_dir(VOLUME_MOUNT_PATH, job_id)
     os.makedirs(training_dir, exist_ok=True)
-    
-    # Check if there's a lock file indicating another process is running
-    lock_file = f"{VOLUME_MOUNT_PATH}/training.lock"
-    if os.path.exists(lock_file):
-        # Check if lock is stale (older than 2 hours)
-        lock_time = os.path.getmtime(lock_file)
-        current_time = time.time()
-        if current_time - lock_time < 7200:  # 2 hours in seconds
-            print(f"WARNING: Another training process may be running (lock file exists)")
-        else:
-            print(f"Removing stale lock file")
-            os.remove(lock_file)
-    
-    # Create a lock file
-    with open(lock_file, 'w') as f:
-        f.write(f"Locked at {time.ctime()}")
+    print(f"Dataset directory for job {job_id}: {training_dir}")
     
     try:
         # List existing files in directory for debugging
@@ -80,62 +110,68 @@ def preprocess_images(image_data_list: List[Dict[str, Any]]) -> List[str]:
             except Exception as e:
                 print(f"Error listing training directory: {str(e)}")
         
-        processed_paths = []
+        start_time = time.time()
+        workers = max_workers or available_cpus()
+        print(f"Processing {len(image_data_list)} images ({'process pool of ' + str(workers) if parallel else 'serial'})")
         
-        for idx, img_data in enumerate(image_data_list):
-            try:
-                # Decode base64 image
-                img_bytes = base64.b64decode(img_data['base64Data'])
-                img = Image.open(io.BytesIO(img_bytes))
-                
-                # Basic image validation
-                if img.mode not in ('RGB', 'RGBA'):
-                    print(f"Converting image {idx} from {img.mode} to RGB")
-                    img = img.convert("RGB")
-                
-                if img.width < 256 or img.height < 256:
-                    print(f"Warning: Image {idx} is too small ({img.width}x{img.height}), might give poor results")
-                
-                # Check for single-colored or low-variance images that might cause training issues
-                img_array = np.array(img)
-                if img_array.std() < 20:  # Very low standard deviation indicates near-uniform color
-                    print(f"Warning: Image {idx} has very low variance, might cause training issues - skipping")
-                    continue
-                    
-                # Center crop to square if needed
-                if img.width != img.height:
-                    size = min(img.width, img.height)
-                    img = ImageOps.fit(img, (size, size), centering=(0.5, 0.5))
-                
-                # Resize to 512x512 (standard for Stable Diffusion) with antialiasing
-                img = img.resize((512, 512), Image.LANCZOS)
-                
-                # Apply slight blur to reduce noise and improve stability
-                from PIL import ImageFilter
-                img = img.filter(ImageFilter.GaussianBlur(radius=0.5))
-                
-                # Normalize image contrast for better stability
-                img = ImageOps.autocontrast(img, cutoff=0.5)
-                
-                # Save processed image
-                img_path = f"{training_dir}/image_{idx}.png"
-                img.save(img_path)
-                
-                # Verify the file was saved
-                if os.path.exists(img_path):
-                    print(f"Successfully saved and verified image: {img_path}")
-                    processed_paths.append(img_path)
-                else:
-                    print(f"ERROR: Failed to save image to {img_path}")
-                
-            except Exception as e:
-                print(f"Error processing image {idx}: {str(e)}")
-                continue
+        cache_dir = PREPROCESS_CACHE_DIR if use_cache else None
+        records = process_images(
+            image_data_list,
+            training_dir,
+            parallel=parallel,
+            max_workers=workers,
+            cache_dir=cache_dir
+        )
+        
+        # Screen the whole upload at once on the workers' thumbnails, dropping
+        # near-duplicates and hopeless images before they reach the GPU
+        screen_records(records)
+        processed_paths = [record["path"] for record in records if record["status"] == "processed"]
+        skipped = [record for record in records if record["status"] == "skipped"]
+        screening_stats = {
+            "kept": len(processed_paths),
+            "duplicates": sum(1 for record in skipped if record.get("duplicate_of") is not None),
+            "low_quality": sum(1 for record in skipped if record.get("duplicate_of") is None),
+        }
+        print(f"Screening kept {screening_stats['kept']} images, dropped {screening_stats['duplicates']} near-duplicates and {screening_stats['low_quality']} low-quality images")
+        
+        cache_stats = {
+            "hits": sum(1 for record in records if record["cache"] == "hit"),
+            "misses": sum(1 for record in records if record["cache"] == "miss"),
+            "evicted": evict_cache(cache_dir) if cache_dir else 0,
+        }
+        print(f"Preprocessing cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evicted']} evicted")
+        
+        decoded = [record["decode"] for record in records if record.get("decode")]
+        decode_stats = {
+            "images": len(decoded),
+            "passthrough": sum(1 for stats in decoded if stats["passthrough"]),
+            "seconds": round(sum(stats["decode_seconds"] for stats in decoded), 3),
+            "max_peak_rss_mb": max((stats["peak_rss_mb"] for stats in decoded), default=None),
+        }
+        for record in records:
+            if record.get("decode"):
+                stats = record["decode"]
+                print(f"Image {record['index']}: decoded {stats['original_size'][0]}x{stats['original_size'][1]} "
+                      f"at {stats['decoded_size'][0]}x{stats['decoded_size'][1]} in {stats['decode_seconds']:.3f}s, "
+                      f"peak RSS {stats['peak_rss_mb']} MB")
+        
+        for record in records:
+            if record["status"] != "processed":
+                print(f"Image {record['index']} {record['status']}: {record['error']}")
+        
+        # Staged uploads are only needed until they have been processed
+        import shutil
+        uploads_root = f"{VOLUME_MOUNT_PATH}/{UPLOADS_DIRNAME}/"
+        staged_dirs = {os.path.dirname(d["imagePath"]) for d in image_data_list if d.get("imagePath")}
+        for staged_dir in staged_dirs:
+            if staged_dir.startswith(uploads_root):
+                shutil.rmtree(staged_dir, ignore_errors=True)
         
-        # Check if we have too few images - try to find existing images that can be used
+        # Check if we have too few images - try to find existing images of this job that can be used
         if len(processed_paths) < 3:
             print("Not enough images processed successfully. Checking for existing images...")
-            # Look for image files that might be in the training directory
+            # Look for image files left in the job's dataset directory (e.g. by an earlier attempt)
             existing_images = [os.path.join(training_dir, f) for f in os.listdir(training_dir) 
                               if f.endswith(('.png', '.jpg', '.jpeg'))]
             if existing_images:
@@ -145,6 +181,23 @@ def preprocess_images(image_data_list: List[Dict[str, Any]]) -> List[str]:
                     if img not in processed_paths:
                         processed_paths.append(img)
         
+        # Pack the images and captions into a few shards so training reads one
+        # file instead of opening every image on the volume
+        shard_stats = None
+        if processed_paths:
+            try:
+                shard_start = time.time()
+                shard_stats = write_shards(
+                    [(Path(path).stem, path, read_caption(path, "")) for path in processed_paths],
+                    os.path.join(training_dir, SHARDS_DIRNAME)
+                )
+                shard_stats["seconds"] = round(time.time() - shard_start, 3)
+                print(f"Packed {shard_stats['samples']} images into {shard_stats['shards']} shard(s) "
+                      f"({shard_stats['bytes']} bytes) in {shard_stats['seconds']:.2f}s")
+            except Exception as e:
+                print(f"Error packing dataset shards: {str(e)} - training will read the image files")
+                shard_stats = None
+        
         # List files in directory after processing to confirm they exist
         try:
             final_files = os.listdir(training_dir)
@@ -154,19 +207,228 @@ def preprocess_images(image_data_list: List[Dict[str, Any]]) -> List[str]:
         except Exception as e:
             print(f"Error listing training directory after processing: {str(e)}")
         
-        print(f"Successfully processed {len(processed_paths)} images out of {len(image_data_list)}")
-        return processed_paths
+        total_seconds = time.time() - start_time
+        print(f"Successfully processed {len(processed_paths)} images out of {len(image_data_list)} in {total_seconds:.2f}s")
+        return {
+            "job_id": job_id,
+            "dataset_dir": training_dir,
+            "processed_paths": processed_paths,
+            "images": records,
+            "parallel": parallel,
+            "workers": workers if parallel else 1,
+            "seconds": round(total_seconds, 3),
+            "cache": cache_stats,
+            "screening": screening_stats,
+            "decode": decode_stats,
+            "shards": shard_stats,
+        }
     
     except Exception as e:
         print(f"Error in preprocessing: {str(e)}")
-        return []
-    finally:
-        # Always try to remove the lock file when done
+        return {"job_id": job_id, "dataset_dir": training_dir, "processed_paths": [], "images": [], "error": str(e)}
+
+def cache_latents(vae, image_paths: List[str], image_transform, device: str = "cuda") -> Dict[str, str]:
+    """
+    Encode each training image through the VAE once and store its latent
+    distribution (mean/std) as safetensors in a "latents" folder next to the image.
+    
+    A cache file is reused as long as the source image has not changed since it
+    was encoded, so repeated runs over the same dataset skip the VAE entirely.
+    
+    Args:
+        vae: VAE used to encode the images
+        image_paths: Paths to processed training images
+        image_transform: Callable turning a PIL image into a (C, H, W) pixel tensor
+        device: Device to run the VAE on
+        
+    Returns:
+        Mapping of image path to latent cache file (images that fail to encode are left out)
+    """
+    import torch
+    from PIL import Image
+    from safetensors import safe_open
+    from safetensors.torch import save_file
+    
+    latent_paths = {}
+    with torch.no_grad():
+        for image_path in image_paths:
+            cache_dir = os.path.join(os.path.dirname(image_path), LATENT_CACHE_DIRNAME)
+            latent_path = os.path.join(cache_dir, f"{Path(image_path).stem}.safetensors")
+            try:
+                source_stat = os.stat(image_path)
+                source_key = f"{source_stat.st_size}:{source_stat.st_mtime_ns}"
+                
+                # Reuse the cached latents if they were encoded from this exact file
+                if os.path.exists(latent_path):
+                    with safe_open(latent_path, framework="pt") as f:
+                        if (f.metadata() or {}).get("source") == source_key:
+                            latent_paths[image_path] = latent_path
+                            continue
+                
+                with Image.open(image_path) as img:
+                    pixel_values = image_transform(img.convert("RGB"))
+                pixel_values = pixel_values.unsqueeze(0).to(device, dtype=vae.dtype)
+                latent_dist = vae.encode(pixel_values).latent_dist
+                
+                os.makedirs(cache_dir, exist_ok=True)
+                save_file(
+                    {
+                        "mean": latent_dist.mean[0].float().cpu().contiguous(),
+                        "std": latent_dist.std[0].float().cpu().contiguous(),
+                    },
+                    latent_path,
+                    metadata={"source": source_key, "image_path": image_path},
+                )
+                latent_paths[image_path] = latent_path
+            except Exception as e:
+                print(f"Error caching latents for {image_path}: {str(e)}")
+    
+    return latent_paths
+
+def cache_shard_latents(vae, reader: ShardReader, image_transform, device: str = "cuda") -> Dict[str, Dict[str, Any]]:
+    """
+    Encode the images of a packed dataset into VAE latent distributions once
+    
+    All latents are kept in a single safetensors file next to the shard index,
+    tagged with the index fingerprint so a changed dataset is re-encoded.
+    
+    Args:
+        vae: The pipeline's AutoencoderKL (already on device)
+        reader: Packed dataset to encode
+        image_transform: Callable turning a PIL image into a (C, H, W) pixel tensor
+        device: Device to run the VAE on
+        
+    Returns:
+        Mapping of sample key to its latent {"mean", "std"} tensors (images that fail to encode are left out)
+    """
+    import torch
+    from PIL import Image
+    from safetensors import safe_open
+    from safetensors.torch import load_file, save_file
+    
+    latent_path = os.path.join(reader.root, f"{LATENT_CACHE_DIRNAME}.safetensors")
+    
+    # Reuse the packed latents if they were encoded from this exact dataset
+    if os.path.exists(latent_path):
         try:
-            if os.path.exists(lock_file):
-                os.remove(lock_file)
-        except:
-            pass
+            with safe_open(latent_path, framework="pt") as f:
+                fresh = (f.metadata() or {}).get("source") == reader.fingerprint
+            if fresh:
+                tensors = load_file(latent_path)
+                keys = dict.fromkeys(name.rsplit(".", 1)[0] for name in tensors)
+                return {key: {"mean": tensors[f"{key}.mean"], "std": tensors[f"{key}.std"]} for key in keys}
+        except Exception as e:
+            print(f"Error reading packed latents {latent_path}: {str(e)} - re-encoding")
+    
+    latents = {}
+    with torch.no_grad():
+        for sample in reader:
+            try:
+                with Image.open(io.BytesIO(sample["image"])) as img:
+                    pixel_values = image_transform(img.convert("RGB"))
+                pixel_values = pixel_values.unsqueeze(0).to(device, dtype=vae.dtype)
+                latent_dist = vae.encode(pixel_values).latent_dist
+                latents[sample["key"]] = {
+                    "mean": latent_dist.mean[0].float().cpu().contiguous(),
+                    "std": latent_dist.std[0].float().cpu().contiguous(),
+                }
+            except Exception as e:
+                print(f"Error caching latents for {sample['key']}: {str(e)}")
+    
+    try:
+        tensors = {f"{key}.{name}": tensor for key, latent in latents.items() for name, tensor in latent.items()}
+        save_file(tensors, latent_path, metadata={"source": reader.fingerprint})
+    except Exception as e:
+        print(f"Error saving packed latents {latent_path}: {str(e)}")
+    
+    return latents
+
+def load_cached_latents(latent_paths: Dict[str, str]) -> Dict[str, Dict[str, Any]]:
+    """Load the per-image latent cache files written by cache_latents, skipping unreadable ones"""
+    from safetensors.torch import load_file
+    
+    latents = {}
+    for image_path, latent_path in latent_paths.items():
+        try:
+            latents[image_path] = load_file(latent_path)
+        except Exception as e:
+            print(f"Warning: Could not load cached latents {latent_path}: {str(e)} - skipping")
+    return latents
+
+def read_caption(image_path: str, default: str) -> str:
+    """Return the caption stored next to a processed image, or the default prompt"""
+    caption_path = f"{os.path.splitext(image_path)[0]}.txt"
+    try:
+        if os.path.exists(caption_path):
+            with open(caption_path, "r") as f:
+                caption = f.read().strip()
+            if caption:
+                return caption
+    except Exception as e:
+        print(f"Error reading caption {caption_path}: {str(e)}")
+    return default
+
+def find_training_images(processed_image_paths: List[str], training_dir: Optional[str]) -> List[str]:
+    """
+    Check that the processed images exist and open, looking for missing ones in the job's dataset directory
+    
+    Args:
+        processed_image_paths: Paths returned by preprocess_images
+        training_dir: Dataset directory of the job (None to only use the given paths)
+        
+    Returns:
+        Paths of the usable images (at least 2)
+    """
+    from PIL import Image
+    
+    # Validate images first - with enhanced error handling
+    valid_image_paths = []
+    for img_path in processed_image_paths:
+        try:
+            print(f"Checking image path: {img_path}")
+            if os.path.exists(img_path):
+                print(f"  - File exists")
+                try:
+                    with Image.open(img_path) as img:
+                        width, height = img.size
+                        print(f"  - Image loaded successfully: {width}x{height}")
+                        valid_image_paths.append(img_path)
+                except Exception as img_err:
+                    print(f"  - Failed to open image: {str(img_err)}")
+            else:
+                print(f"  - File does not exist")
+                
+                # Try to find the file in the job's dataset directory
+                if not training_dir:
+                    continue
+                alternate_path = os.path.basename(img_path)
+                alternate_full_path = os.path.join(training_dir, alternate_path)
+                
+                if os.path.exists(alternate_full_path):
+                    print(f"  - Found file at alternate path: {alternate_full_path}")
+                    valid_image_paths.append(alternate_full_path)
+        except Exception as e:
+            print(f"Error checking image {img_path}: {str(e)}")
+    
+    print(f"Validated {len(valid_image_paths)} images out of {len(processed_image_paths)}")
+    
+    # If we don't have enough valid images but the job's dataset directory has files,
+    # try to use those files directly
+    if len(valid_image_paths) < 2:
+        if training_dir and os.path.exists(training_dir):
+            try:
+                training_files = [os.path.join(training_dir, f) for f in os.listdir(training_dir) 
+                                 if f.endswith(('.png', '.jpg', '.jpeg'))]
+                if len(training_files) >= 2:
+                    print(f"Using {len(training_files)} files found directly in training directory")
+                    valid_image_paths = training_files
+            except Exception as e:
+                print(f"Error listing training directory: {str(e)}")
+    
+    if len(valid_image_paths) < 2:
+        raise ValueError(f"Only {len(valid_image_paths)} valid images found. At least 2 are required for training.")
+    
+    return valid_image_paths
 
 @app.function(gpu="T4", timeout=3600, volumes={VOLUME_MOUNT_PATH: volume})
 def train_lora_model(
@@ -176,7 +438,11 @@ def train_lora_model(
     training_steps: int = 1000,
     learning_rate: float = 5e-6,  # Reduced learning rate even further for stability
     progress_callback_url: Optional[str] = None,
-    model_id: Optional[str] = None
+    model_id: Optional[str] = None,
+    job_id: Optional[str] = None,
+    shard_index: Optional[str] = None,
+    progress_interval: float = STATUS_WRITE_INTERVAL,
+    output: Optional[Dict[str, Any]] = None
 ) -> Dict[str, Any]:
     """
     Fine-tune a Stable Diffusion model using LoRA adapters
@@ -189,10 +455,19 @@ def train_lora_model(
         learning_rate: Learning rate for training (reduced for stability)
         progress_callback_url: URL to report progress
         model_id: ID of the model for progress tracking
+        job_id: ID of the training job whose dataset directory is searched for
+            images that are missing from processed_image_paths
+        shard_index: Index of the packed dataset written by preprocess_images;
+            when it can be opened, images and captions are read from the shards
+            instead of processed_image_paths
+        progress_interval: Seconds between two batches of progress callbacks
+        output: Format, quality, destination and thumbnail of the sample image
+            (see image_output); a base64 PNG in sample_image_base64 by default
         
     Returns:
         Dictionary with model information
     """
+    status_writer = None
     try:
         print(f"Starting LoRA training for model: {model_name}")
         print(f"Using {len(processed_image_paths)} processed images")
@@ -205,8 +480,7 @@ def train_lora_model(
         from peft import LoraConfig, get_peft_model
         import torch
         import torch.nn.functional as F
-        from torch.utils.data import Dataset, DataLoader
-        import requests
+        from torch.utils.data import Dataset, DataLoader, Sampler
         from PIL import Image
         import numpy as np
         
@@ -217,164 +491,93 @@ def train_lora_model(
         # Set benchmark mode for improved performance
         torch.backends.cudnn.benchmark = True
         
+        # Only this job's dataset directory is ever searched for images
+        training_dir = job_dataset_dir(VOLUME_MOUNT_PATH, job_id) if job_id else None
+        
         # Check volume persistence by examining the directory structure
         print(f"Checking volume persistence...")
         try:
             volume_contents = os.listdir(VOLUME_MOUNT_PATH)
             print(f"Volume contents: {volume_contents}")
             
-            if "training_images" in volume_contents:
-                training_dir = f"{VOLUME_MOUNT_PATH}/training_images"
+            if training_dir and os.path.isdir(training_dir):
                 training_files = os.listdir(training_dir)
                 print(f"Training directory contains {len(training_files)} files")
                 
                 if len(training_files) == 0:
                     print("WARNING: Training directory is empty!")
-            else:
-                print("WARNING: Training directory not found in volume!")
+            elif training_dir:
+                print(f"WARNING: Dataset directory {training_dir} not found in volume!")
         except Exception as e:
             print(f"Error checking volume persistence: {str(e)}")
 
-        # Validate images first - with enhanced error handling
-        valid_image_paths = []
-        for img_path in processed_image_paths:
+        # Prefer the packed shards: one memory-mapped file instead of a volume
+        # round-trip per image
+        reader = None
+        if shard_index:
             try:
-                print(f"Checking image path: {img_path}")
-                if os.path.exists(img_path):
-                    print(f"  - File exists")
-                    try:
-                        with Image.open(img_path) as img:
-                            width, height = img.size
-                            print(f"  - Image loaded successfully: {width}x{height}")
-                            valid_image_paths.append(img_path)
-                    except Exception as img_err:
-                        print(f"  - Failed to open image: {str(img_err)}")
+                reader = ShardReader(shard_index)
+                if len(reader) < 2:
+                    print(f"Packed dataset has only {len(reader)} images, using the image files")
+                    reader = None
                 else:
-                    print(f"  - File does not exist")
-                    
-                    # Try to find the file in common locations
-                    alternate_path = os.path.basename(img_path)
-                    training_dir = f"{VOLUME_MOUNT_PATH}/training_images"
-                    alternate_full_path = os.path.join(training_dir, alternate_path)
-                    
-                    if os.path.exists(alternate_full_path):
-                        print(f"  - Found file at alternate path: {alternate_full_path}")
-                        valid_image_paths.append(alternate_full_path)
+                    print(f"Reading {len(reader)} images from packed dataset {shard_index}")
             except Exception as e:
-                print(f"Error checking image {img_path}: {str(e)}")
+                print(f"Error opening packed dataset {shard_index}: {str(e)} - using the image files")
+                reader = None
         
-        print(f"Validated {len(valid_image_paths)} images out of {len(processed_image_paths)}")
-        
-        # If we don't have enough valid images but the training directory has files,
-        # try to use those files directly
-        if len(valid_image_paths) < 2:
-            training_dir = f"{VOLUME_MOUNT_PATH}/training_images"
-            if os.path.exists(training_dir):
-                try:
-                    training_files = [os.path.join(training_dir, f) for f in os.listdir(training_dir) 
-                                     if f.endswith(('.png', '.jpg', '.jpeg'))]
-                    if len(training_files) >= 2:
-                        print(f"Using {len(training_files)} files found directly in training directory")
-                        valid_image_paths = training_files
-                except Exception as e:
-                    print(f"Error listing training directory: {str(e)}")
-        
-        if len(valid_image_paths) < 2:
-            raise ValueError(f"Only {len(valid_image_paths)} valid images found. At least 2 are required for training.")
-        
-        # Continue with the validated image paths
-        processed_image_paths = valid_image_paths
+        if reader is None:
+            processed_image_paths = find_training_images(processed_image_paths, training_dir)
         
         # Set up paths
         output_dir = f"{VOLUME_MOUNT_PATH}/{model_name}"
         os.makedirs(output_dir, exist_ok=True)
         
-        # Report progress
+        # Report progress through the shared status writer, which posts from a
+        # background thread so a callback never blocks a training step
+        if progress_callback_url:
+            # Skip localhost URLs when running in Modal cloud to avoid connection errors
+            if "localhost" in progress_callback_url or "127.0.0.1" in progress_callback_url:
+                print(f"Skipping localhost callback URL in cloud environment: {progress_callback_url}")
+            else:
+                status_writer = get_status_writer(
+                    callback_url=progress_callback_url,
+                    callback_id_field="modelId",
+                    interval=progress_interval
+                )
+        
         def report_progress(step, total_steps, loss=None):
+            import math
+            
             progress = int((step / total_steps) * 100)
             progress_fraction = step / total_steps  # This is in 0-1 range for Supabase
             message = f"Training progress: {progress}% complete"
-            if loss:
+            if loss is not None:
                 message += f", loss: {loss:.4f}"
-                
-            print(message)
             
-            if progress_callback_url:
-                # Skip localhost URLs when running in Modal cloud to avoid connection errors
-                if "localhost" in progress_callback_url or "127.0.0.1" in progress_callback_url:
-                    print(f"Skipping localhost callback URL in cloud environment: {progress_callback_url}")
-                    return
-                    
-                try:
-                    # Create payload compatible with trained_models schema
-                    # Only include fields that exist in the schema
-                    # And sanitize any values that might cause serialization issues
-                    import math
-                    
-                    payload = {
-                        "modelId": model_id,
-                        "status": "training",  # Use proper status value
-                        "progress": progress_fraction,  # Use 0-1 range instead of percentage
-                        "message": message
-                    }
-                    
-                    # Only include loss if it's a valid number
-                    if loss is not None and not (isinstance(loss, float) and math.isnan(loss)):
-                        try:
-                            # Convert loss to float and ensure it's serializable
-                            loss_value = float(loss)
-                            if not math.isnan(loss_value) and not math.isinf(loss_value):
-                                # Store loss as part of model_info
-                                payload["model_info"] = {
-                                    "current_loss": loss_value,
-                                    "current_step": step,
-                                    "total_steps": total_steps
-                                }
-                        except (ValueError, TypeError) as e:
-                            print(f"Error converting loss to float: {e}")
-                    
-                    # Log the payload being sent
-                    print(f"Sending progress payload to callback URL: {json.dumps(payload)}")
-                    
-                    # Add timeout to prevent long waits
-                    response = requests.post(
-                        progress_callback_url,
-                        json=payload,
-                        timeout=5  # 5 second timeout
-                    )
-                    
-                    # Log the response
-                    print(f"Progress callback response status: {response.status_code}")
-                    try:
-                        if response.text:
-                            print(f"Progress callback response body: {response.text}")
-                    except Exception as resp_err:
-                        print(f"Could not read response text: {str(resp_err)}")
-                    
-                    if response.status_code != 200:
-                        print(f"WARNING: Unexpected status code {response.status_code} from progress callback")
-                        
-                        # If we get a 400 error, try a simplified payload
-                        if response.status_code == 400:
-                            print("Attempting simplified payload with only essential fields...")
-                            minimal_payload = {
-                                "modelId": model_id,
-                                "status": "training",
-                                "progress": progress_fraction
-                            }
-                            print(f"Sending minimal payload: {json.dumps(minimal_payload)}")
-                            
-                            simple_response = requests.post(
-                                progress_callback_url,
-                                json=minimal_payload,
-                                timeout=5
-                            )
-                            
-                            print(f"Simplified payload response: {simple_response.status_code} - {simple_response.text}")
-                except Exception as e:
-                    print(f"Failed to report progress: {str(e)}")
-                    import traceback
-                    traceback.print_exc()
+            if status_writer is None:
+                return
+            
+            # Create payload compatible with trained_models schema
+            # Only include fields that exist in the schema
+            payload = {
+                "status": "training",  # Use proper status value
+                "progress": progress_fraction,  # Use 0-1 range instead of percentage
+                "message": message
+            }
+            
+            # Only include loss if it's a valid number
+            if loss is not None and not math.isnan(loss) and not math.isinf(loss):
+                # Store loss as part of model_info
+                payload["model_info"] = {
+                    "current_loss": float(loss),
+                    "current_step": step,
+                    "total_steps": total_steps
+                }
+            
+            # Updates are merged per model and written in batches; if the callback
+            # rejects the payload, only status and progress are resent
+            status_writer.update(model_id, payload)
         
         # Load base model
         base_model_id = "runwayml/stable-diffusion-v1-5"
@@ -434,94 +637,119 @@ def train_lora_model(
         unet = pipe.unet
         unet = get_peft_model(unet, lora_config)
         
-        # Define dataset class for our images
+        # Transform image for model input
+        def image_transform(image):
+            return pipe.feature_extractor(
+                images=[image],
+                return_tensors="pt",
+            ).pixel_values[0]
+        
+        # Encode every image through the VAE once up front. The training loop then
+        # samples straight from the cached latent distributions, so the VAE can
+        # leave the GPU for the rest of the run.
+        print("Caching VAE latents for training images...")
+        latent_cache_start = time.time()
+        pipe.vae.to("cuda", dtype=torch.float32)  # Use float32 for VAE to avoid NaN
+        if reader is not None:
+            latents = cache_shard_latents(pipe.vae, reader, image_transform, device="cuda")
+            captions = {
+                sample["key"]: sample["caption"] or instance_prompt
+                for sample in reader.samples if sample["key"] in latents
+            }
+            reader.close()
+        else:
+            latents = load_cached_latents(cache_latents(pipe.vae, processed_image_paths, image_transform, device="cuda"))
+            captions = {path: read_caption(path, instance_prompt) for path in latents}
+        pipe.vae.to("cpu")
+        torch.cuda.empty_cache()
+        latent_cache_stats = {
+            "images": len(latents),
+            "packed": reader is not None,
+            "seconds": round(time.time() - latent_cache_start, 3),
+        }
+        print(f"Cached latents for {len(latents)} images in {latent_cache_stats['seconds']:.2f}s")
+        
+        # The prompt never changes within a job (captions can only vary per image),
+        # so run the text encoder once per unique caption and reuse the embeddings
+        # for every step. The text encoder is offloaded from the GPU afterwards.
+        print("Precomputing text embeddings for training captions...")
+        text_cache_start = time.time()
+        pipe.text_encoder.to("cuda")
+        caption_embeddings = {}
+        with torch.no_grad():
+            for caption in dict.fromkeys(captions.values()):
+                text_inputs = pipe.tokenizer(
+                    caption,
+                    padding="max_length",
+                    max_length=pipe.tokenizer.model_max_length,
+                    truncation=True,
+                    return_tensors="pt",
+                )
+                caption_embeddings[caption] = pipe.text_encoder(text_inputs.input_ids.to("cuda"))[0].float()
+        text_encode_seconds = time.time() - text_cache_start
+        
+        device_memory_before = torch.cuda.memory_allocated()
+        pipe.text_encoder.to("cpu")
+        torch.cuda.empty_cache()
+        text_encoder_bytes = sum(p.numel() * p.element_size() for p in pipe.text_encoder.parameters())
+        text_embedding_stats = {
+            "captions": len(caption_embeddings),
+            "encode_seconds": round(text_encode_seconds, 3),
+            "text_encoder_mb": round(text_encoder_bytes / (1024 ** 2), 1),
+            "device_memory_freed_mb": round((device_memory_before - torch.cuda.memory_allocated()) / (1024 ** 2), 1),
+        }
+        print(f"Encoded {len(caption_embeddings)} unique captions in {text_encode_seconds:.2f}s")
+        
+        # Define dataset class for our cached latents
         class CustomImageDataset(Dataset):
-            def __init__(self, image_paths, tokenizer, instance_prompt):
-                self.image_paths = image_paths
-                self.tokenizer = tokenizer
-                self.instance_prompt = instance_prompt
-                # Verify image paths and filter out any that don't exist
-                self.valid_image_paths = []
-                for path in image_paths:
-                    if os.path.exists(path):
-                        self.valid_image_paths.append(path)
-                    else:
-                        print(f"Warning: Image file not found: {path} - skipping")
+            def __init__(self, latents, captions):
+                # Latents are tiny (4x64x64 per image), so keep them all in memory
+                self.latents = list(latents.values())
+                self.captions = [captions[key] for key in latents]
                 
-                if len(self.valid_image_paths) == 0:
+                if len(self.latents) == 0:
                     raise ValueError("No valid images found for training. Please check your image paths.")
                 
-                print(f"Found {len(self.valid_image_paths)} valid images out of {len(image_paths)} total")
+                print(f"Found {len(self.latents)} cached latents")
             
             def __len__(self):
-                return len(self.valid_image_paths)
+                return len(self.latents)
             
             def __getitem__(self, idx):
-                try:
-                    image_path = self.valid_image_paths[idx]
-                    image = Image.open(image_path).convert("RGB")
-                    # Transform image for model input
-                    pixel_values = pipe.feature_extractor(
-                        images=[image],
-                        return_tensors="pt",
-                    ).pixel_values
-                    
-                    # Encode text
-                    text_inputs = self.tokenizer(
-                        self.instance_prompt,
-                        padding="max_length",
-                        max_length=self.tokenizer.model_max_length,
-                        truncation=True,
-                        return_tensors="pt",
-                    )
-                    
-                    return {
-                        "pixel_values": pixel_values[0],
-                        "input_ids": text_inputs.input_ids[0],
-                    }
-                except Exception as e:
-                    print(f"Error loading image {self.valid_image_paths[idx]}: {str(e)}")
-                    # If we encounter an error, use a fallback to the first valid image
-                    if len(self.valid_image_paths) > 0 and idx != 0:
-                        print(f"Using fallback image instead")
-                        return self.__getitem__(0)  # Use the first image as fallback
-                    else:
-                        # Return dummy data to avoid crashing
-                        print(f"Cannot load any valid images - using dummy data")
-                        # Try to use blank image as fallback
-                        try:
-                            dummy_image = Image.new('RGB', (512, 512), color='white')
-                            dummy_values = pipe.feature_extractor(
-                                images=[dummy_image],
-                                return_tensors="pt",
-                            ).pixel_values
-                            
-                            text_inputs = self.tokenizer(
-                                self.instance_prompt,
-                                padding="max_length",
-                                max_length=self.tokenizer.model_max_length,
-                                truncation=True,
-                                return_tensors="pt",
-                            )
-                            
-                            return {
-                                "pixel_values": dummy_values[0],
-                                "input_ids": text_inputs.input_ids[0],
-                            }
-                        except:
-                            # If all else fails, raise the error
-                            raise
+                return {
+                    "latent_mean": self.latents[idx]["mean"],
+                    "latent_std": self.latents[idx]["std"],
+                    "caption": self.captions[idx],
+                }
+        
+        # Sampler driven by the step budget rather than the dataset size: it keeps
+        # cycling (reshuffled) epochs until training_steps batches have been drawn
+        class StepBudgetSampler(Sampler):
+            def __init__(self, dataset_size, num_steps, batch_size):
+                self.dataset_size = dataset_size
+                self.num_samples = num_steps * batch_size
+            
+            def __len__(self):
+                return self.num_samples
+            
+            def __iter__(self):
+                remaining = self.num_samples
+                while remaining > 0:
+                    epoch_indices = torch.randperm(self.dataset_size).tolist()[:remaining]
+                    remaining -= len(epoch_indices)
+                    yield from epoch_indices
         
         # Create dataset and dataloader
-        dataset = CustomImageDataset(
-            processed_image_paths,
-            pipe.tokenizer,
-            instance_prompt
-        )
+        dataset = CustomImageDataset(latents, captions)
         
         # Use a smaller batch size for more stable training
         batch_size = 1
-        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+        dataloader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            sampler=StepBudgetSampler(len(dataset), training_steps, batch_size),
+        )
+        steps_per_epoch = max(len(dataset) // batch_size, 1)
         
         # Prepare optimizer with weight decay
         # Use AdamW with weight decay to prevent large weights
@@ -548,8 +776,6 @@ def train_lora_model(
         
         # Training loop
         unet.train()
-        pipe.vae.to("cuda", dtype=torch.float32)  # Use float32 for VAE to avoid NaN
-        pipe.text_encoder.to("cuda")
         unet.to("cuda", dtype=torch.float32)  # Use float32 for more stability
         
         # Add gradient clipping to avoid exploding gradients - reduced further
@@ -558,6 +784,9 @@ def train_lora_model(
         # Use learning rate warmup to stabilize training
         warmup_steps = int(training_steps * 0.1)  # 10% of total steps for warmup
         
+        # Number of steps that used a cached embedding instead of the text encoder
+        cached_embedding_lookups = 0
+        
         # For EMA tracking of loss
         ema_loss = None
         ema_alpha = 0.95
@@ -565,14 +794,25 @@ def train_lora_model(
         # Stability enhancement: Use autocast to avoid numerical instability
         from torch.cuda.amp import autocast
         
+        # Throughput accounting
+        completed_steps = 0
+        samples_seen = 0
+        epoch_seconds = []
+        
         print(f"Starting training for {training_steps} steps (with {warmup_steps} warmup steps)")
+        print(f"{len(dataset)} images, {steps_per_epoch} steps per epoch, ~{training_steps / steps_per_epoch:.1f} epochs")
         start_time = time.time()
+        epoch_start_time = start_time
         
         # Training loop
         for step, batch in enumerate(dataloader):
-            # Skip this batch completely if we've exhausted our steps
-            if step >= training_steps:
-                break
+            # Record the duration of each finished pass over the dataset
+            if step > 0 and step % steps_per_epoch == 0:
+                torch.cuda.synchronize()
+                now = time.time()
+                epoch_seconds.append(round(now - epoch_start_time, 3))
+                print(f"Epoch {len(epoch_seconds)} finished in {epoch_seconds[-1]:.2f}s")
+                epoch_start_time = now
             
             # Compute and apply warmup factor if within warmup period
             if step < warmup_steps:
@@ -582,12 +822,12 @@ def train_lora_model(
             # Get inputs
             try:
                 # Move batch to GPU and handle potential errors with input batches
-                pixel_values = batch["pixel_values"].to("cuda", dtype=torch.float32)
-                input_ids = batch["input_ids"].to("cuda")
+                latent_mean = batch["latent_mean"].to("cuda", dtype=torch.float32)
+                latent_std = batch["latent_std"].to("cuda", dtype=torch.float32)
                 
                 # Make sure values are valid (no NaNs or infinities)
-                if torch.isnan(pixel_values).any() or torch.isinf(pixel_values).any():
-                    print(f"WARNING: NaN or Inf detected in pixel values, skipping this batch")
+                if not (torch.isfinite(latent_mean).all() and torch.isfinite(latent_std).all()):
+                    print(f"WARNING: NaN or Inf detected in cached latents, skipping this batch")
                     continue
             except Exception as e:
                 print(f"Error processing batch: {e}")
@@ -599,17 +839,19 @@ def train_lora_model(
             # Use autocast for better numerical stability
             with autocast():
                 try:
+                    # Sample latents from the cached distribution (same as latent_dist.sample())
+                    latents = latent_mean + latent_std * torch.randn_like(latent_std)
+                    
                     # Get noise and noisy latents
-                    noise = torch.randn_like(pipe.vae.encode(pixel_values).latent_dist.sample())
+                    noise = torch.randn_like(latents)
                     timesteps = torch.randint(
-                        0, pipe.scheduler.config.num_train_timesteps, (batch["pixel_values"].shape[0],)
+                        0, pipe.scheduler.config.num_train_timesteps, (latents.shape[0],)
                     ).long().to("cuda")
-                    noisy_latents = pipe.scheduler.add_noise(
-                        pipe.vae.encode(pixel_values).latent_dist.sample(), noise, timesteps
-                    )
+                    noisy_latents = pipe.scheduler.add_noise(latents, noise, timesteps)
                 
-                    # Get text embeddings
-                    encoder_hidden_states = pipe.text_encoder(input_ids)[0]
+                    # Look up the precomputed text embeddings
+                    encoder_hidden_states = torch.cat([caption_embeddings[c] for c in batch["caption"]])
+                    cached_embedding_lookups += 1
                 
                     # Get model prediction for the noise
                     noise_pred = unet(noisy_latents, timesteps, encoder_hidden_states).sample
@@ -631,7 +873,7 @@ def train_lora_model(
                     continue
             
             # Update EMA loss for tracking
-            if step == 0:
+            if ema_loss is None:
                 ema_loss = loss.item()
             else:
                 ema_loss = ema_loss * ema_alpha + loss.item() * (1 - ema_alpha)
@@ -649,11 +891,43 @@ def train_lora_model(
                 print(f"Error during backward pass: {str(e)}")
                 continue
             
+            completed_steps += 1
+            samples_seen += latents.shape[0]
+            
+            # Queued for the background reporter, so this is cheap enough for every step
+            report_progress(step + 1, training_steps, ema_loss)
+            
             # Log progress at intervals
             if step % 10 == 0:
                 elapsed = time.time() - start_time
                 print(f"Step {step}/{training_steps} | Loss: {loss.item():.4f} | EMA Loss: {ema_loss:.4f} | Time: {elapsed:.2f}s")
         
+        torch.cuda.synchronize()
+        training_seconds = time.time() - start_time
+        
+        # Make sure the final training progress reaches the callback
+        report_progress(training_steps, training_steps, ema_loss)
+        if status_writer is not None:
+            status_writer.flush(timeout=30)
+        if training_steps > len(epoch_seconds) * steps_per_epoch:
+            # Last (possibly partial) epoch
+            epoch_seconds.append(round(time.time() - epoch_start_time, 3))
+        
+        training_stats = {
+            "requested_steps": training_steps,
+            "completed_steps": completed_steps,
+            "skipped_steps": training_steps - completed_steps,
+            "batch_size": batch_size,
+            "dataset_size": len(dataset),
+            "epochs": round(training_steps / steps_per_epoch, 2),
+            "training_seconds": round(training_seconds, 3),
+            "samples_per_second": round(samples_seen / training_seconds, 3) if training_seconds > 0 else None,
+            "steps_per_second": round(completed_steps / training_seconds, 3) if training_seconds > 0 else None,
+            "epoch_seconds": epoch_seconds,
+            "gpu": torch.cuda.get_device_name(0),
+        }
+        print(f"Training stats: {json.dumps(training_stats)}")
+        
         # Save the trained model
         print("Training complete, saving model")
         unet.save_pretrained(f"{output_dir}/unet")
@@ -665,13 +939,23 @@ def train_lora_model(
             "instance_prompt": instance_prompt,
             "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
             "training_steps": training_steps,
+            "training_stats": training_stats,
         }
         
         with open(f"{output_dir}/model_info.json", "w") as f:
             json.dump(model_info, f)
         
-        # Generate sample image
+        # Each cached lookup replaced one text encoder forward (and backward) pass
+        seconds_per_encode = text_encode_seconds / max(len(caption_embeddings), 1)
+        text_embedding_stats["text_encoder_calls_saved"] = max(cached_embedding_lookups - len(caption_embeddings), 0)
+        text_embedding_stats["estimated_seconds_saved"] = round(
+            seconds_per_encode * text_embedding_stats["text_encoder_calls_saved"], 3
+        )
+        
+        # Generate sample image (the VAE and text encoder were offloaded after caching)
         pipe.unet = unet
+        pipe.vae.to("cuda")
+        pipe.text_encoder.to("cuda")
         
         sample_image = pipe(
             prompt=instance_prompt,
@@ -686,16 +970,20 @@ def train_lora_model(
         zip_path = f"{output_dir}.zip"
         shutil.make_archive(output_dir, 'zip', output_dir)
         
-        # Encode sample image to base64 for preview
-        buffered = io.BytesIO()
-        sample_image.save(buffered, format="PNG")
-        sample_base64 = base64.b64encode(buffered.getvalue()).decode()
+        # Encode the sample image for preview; "volume" outputs are written next to sample.png
+        output = resolve_output(output)
+        image_output = ImageOutput(output_dir)
+        sample_data, sample_info = image_output.encode(sample_image, output)
+        sample_fields = image_output.deliver(sample_data, sample_info, output, field="sample_image", name="sample")
         
         return {
             "status": "success",
             "model_info": model_info,
-            "sample_image_base64": sample_base64,
-            "model_path": zip_path
+            **sample_fields,
+            "model_path": zip_path,
+            "latent_cache": latent_cache_stats,
+            "text_embedding_cache": text_embedding_stats,
+            "status_writes": status_writer.metrics() if status_writer is not None else None
         }
         
     except Exception as e:
@@ -705,6 +993,11 @@ def train_lora_model(
             "status": "error",
             "error": error_message
         }
+    finally:
+        # Deliver whatever progress is still pending, whether training finished or failed
+        if status_writer is not None:
+            status_writer.flush(timeout=30)
+            print(f"Status writes: {json.dumps(status_writer.metrics())}")
 
 @app.function(volumes={VOLUME_MOUNT_PATH: volume})
 def get_model_data(model_path: str) -> Dict[str, Any]:
@@ -738,20 +1031,19 @@ def get_model_data(model_path: str) -> Dict[str, Any]:
         }
 
 @app.function(volumes={VOLUME_MOUNT_PATH: volume})
-def cleanup_training_data(model_name: str) -> Dict[str, str]:
+def cleanup_training_data(job_id: str) -> Dict[str, str]:
     """
-    Clean up temporary training data
+    Clean up the temporary training data of one job
     
     Args:
-        model_name: Name of the model
+        job_id: ID of the training job (as returned by preprocess_images)
         
     Returns:
         Status message
     """
     try:
         import shutil
-        temp_path = f"{VOLUME_MOUNT_PATH}/training_images"
-        model_path = f"{VOLUME_MOUNT_PATH}/{model_name}"
+        temp_path = job_dataset_dir(VOLUME_MOUNT_PATH, job_id)
         
         if os.path.exists(temp_path):
             shutil.rmtree(temp_path)
@@ -782,22 +1074,20 @@ def main(input: str = None, dry_run: bool = False):
     
     print(f"Processing input file: {input_file}")
     
-    # Read the input file
+    # Read the input file (the images are streamed separately below)
     try:
-        with open(input_file, 'r') as f:
-            training_data = json.load(f)
+        training_data = load_input_params(input_file)
             
         # Extract parameters
-        image_data_list = training_data.get('imageDataList', [])
         instance_prompt = training_data.get('instancePrompt', '')
         model_name = training_data.get('modelName', f'custom-model-{int(time.time())}')
         training_steps = training_data.get('trainingSteps', 1000)
         callback_url = training_data.get('callbackUrl')
         model_id = training_data.get('modelId')  # Get model ID for progress tracking
+        output = training_data.get('output')  # Sample image format / destination, see image_output
         
         print(f"Starting training process for model: {model_name}")
         print(f"Instance prompt: {instance_prompt}")
-        print(f"Number of images: {len(image_data_list)}")
         
         # For dry runs, return success immediately without actual training
         if dry_run:
@@ -815,19 +1105,32 @@ def main(input: str = None, dry_run: bool = False):
                 "model_path": f"/tmp/simulated-model-{model_name}.zip"
             }
         
+        # Everything this job writes to the volume is namespaced by its ID
+        job_id = uuid.uuid4().hex
+        print(f"Job ID: {job_id}")
+        
+        # Stream the images onto the volume one at a time instead of loading the
+        # whole input file and pickling every base64 string into the remote call
+        upload_dir = f"/{UPLOADS_DIRNAME}/{job_id}"
+        image_data_list = stage_image_entries(input_file, volume, upload_dir, VOLUME_MOUNT_PATH)
+        print(f"Number of images: {len(image_data_list)}")
+        
         # Preprocess images - use remote() instead of call()
-        processed_paths = preprocess_images.remote(image_data_list)
-        print(f"Processed {len(processed_paths)} images")
+        preprocess_result = preprocess_images.remote(image_data_list, job_id)
+        processed_paths = preprocess_result.get("processed_paths", [])
+        print(f"Processed {len(processed_paths)} images in {preprocess_result.get('seconds')}s")
         
         # Check for minimum required images (at least 2 for training to be meaningful)
         if not processed_paths:
             error_msg = "Failed to process any images"
             print(error_msg)
+            cleanup_training_data.remote(job_id)
             return {"status": "error", "error": error_msg}
         
         if len(processed_paths) < 2:
             error_msg = f"Only {len(processed_paths)} images were successfully processed. At least 2 images are required for training."
             print(error_msg)
+            cleanup_training_data.remote(job_id)
             return {"status": "error", "error": error_msg}
             
         # Verify all image paths exist before starting training - but don't fail if they don't
@@ -855,11 +1158,24 @@ def main(input: str = None, dry_run: bool = False):
             model_name,
             training_steps=training_steps,
             progress_callback_url=callback_url,
-            model_id=model_id  # Pass model ID to the training function
+            model_id=model_id,  # Pass model ID to the training function
+            job_id=job_id,
+            shard_index=(preprocess_result.get("shards") or {}).get("index"),
+            output=output
         )
         
         print(f"Training completed with status: {result.get('status', 'unknown')}")
         
+        # The dataset is only needed for this job
+        cleanup_result = cleanup_training_data.remote(job_id)
+        if cleanup_result.get("status") != "success":
+            print(f"Warning: failed to clean up dataset of job {job_id}: {cleanup_result.get('error')}")
+        
+        # Raw sample image bytes go to a file next to the result, which references it by path
+        result = save_binary_outputs(
+            result, os.path.splitext(training_data.get('outputPath') or input_file)[0]
+        )
+        
         # Print the result as JSON so the API endpoint can parse it
         print("TRAINING_RESULT_JSON:", json.dumps(result))
         return result
@@ -11,11 +11,19 @@ import time
 import glob
 import base64
 import io
+import uuid
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 
+from input_stream import load_input_params, read_image_bytes, stage_image_entries
+from job_datasets import job_dataset_dir
+
 # Define the Modal image with required dependencies
-image = modal.Image.debian_slim().pip_install("pillow", "numpy")
+image = modal.Image.debian_slim().pip_install("pillow", "numpy").add_local_python_source(
+    # Sibling modules imported above; Modal no longer mounts local modules automatically
+    "input_stream",
+    "job_datasets",
+)
 
 # Define the Modal app
 app = modal.App("custom-image-model-trainer-simple", image=image)
@@ -23,15 +31,16 @@ app = modal.App("custom-image-model-trainer-simple", image=image)
 # Define persistent volume
 volume = modal.Volume.from_name("model-training-data", create_if_missing=True)
 VOLUME_MOUNT_PATH = "/model-data"
+UPLOADS_DIRNAME = "uploads"  # Uploads are staged here before preprocessing
 
 @app.function(volumes={VOLUME_MOUNT_PATH: volume})
-def preprocess_images(image_data_list):
-    """Process and validate training images"""
+def preprocess_images(image_data_list, job_id):
+    """Process and validate training images into the job's own dataset directory"""
     from PIL import Image, ImageOps
     import numpy as np
     
-    # Ensure training directory exists
-    training_dir = f"{VOLUME_MOUNT_PATH}/training_images"
+    # Ensure the job's dataset directory exists (concurrent jobs never share one)
+    training_dir = job_dataset_dir(VOLUME_MOUNT_PATH, job_id)
     os.makedirs(training_dir, exist_ok=True)
     
     # Log volume contents for debugging
@@ -39,32 +48,16 @@ def preprocess_images(image_data_list):
     
     processed_paths = []
     
-    # Check if there's a lock file indicating another process is running
-    lock_file = f"{VOLUME_MOUNT_PATH}/training.lock"
-    if os.path.exists(lock_file):
-        # Check if lock is stale (older than 2 hours)
-        lock_time = os.path.getmtime(lock_file)
-        current_time = time.time()
-        if current_time - lock_time < 7200:  # 2 hours in seconds
-            print(f"WARNING: Another training process may be running (lock file exists)")
-        else:
-            print(f"Removing stale lock file")
-            os.remove(lock_file)
-    
-    # Create a lock file
-    with open(lock_file, 'w') as f:
-        f.write(f"Locked at {time.ctime()}")
-    
     try:
         # Process each image
         for idx, img_data in enumerate(image_data_list):
             try:
-                if 'base64Data' not in img_data:
-                    print(f"Skipping image {idx}: No base64Data field")
+                if 'base64Data' not in img_data and 'imagePath' not in img_data:
+                    print(f"Skipping image {idx}: No base64Data or imagePath field")
                     continue
                 
-                # Decode base64 image
-                img_bytes = base64.b64decode(img_data['base64Data'])
+                # Decode the image (inline base64 or staged on the volume)
+                img_bytes = read_image_bytes(img_data)
                 img = Image.open(io.BytesIO(img_bytes))
                 
                 # Ensure RGB mode
@@ -86,7 +79,7 @@ def preprocess_images(image_data_list):
                 print(f"Error processing image {idx}: {str(e)}")
                 continue
         
-        # Check for previously processed images if the current batch had issues
+        # Check for previously processed images of this job if the current batch had issues
         if len(processed_paths) < 3 and image_data_list:
             print("Not enough images processed. Checking for existing images...")
             existing_images = glob.glob(f"{training_dir}/*.png")
@@ -94,25 +87,22 @@ def preprocess_images(image_data_list):
                 print(f"Found {len(existing_images)} existing images in training directory")
                 processed_paths.extend([p for p in existing_images if p not in processed_paths])
         
+        # Staged uploads are only needed until they have been processed
+        import shutil
+        uploads_root = f"{VOLUME_MOUNT_PATH}/{UPLOADS_DIRNAME}/"
+        for staged_dir in {os.path.dirname(d["imagePath"]) for d in image_data_list if d.get("imagePath")}:
+            if staged_dir.startswith(uploads_root):
+                shutil.rmtree(staged_dir, ignore_errors=True)
+        
         print(f"Successfully processed {len(processed_paths)} images")
         return processed_paths
     
     except Exception as e:
         print(f"Error in image preprocessing: {str(e)}")
-        # Remove the lock file
-        if os.path.exists(lock_file):
-            os.remove(lock_file)
         return []
-    finally:
-        # Always try to remove the lock file when done
-        try:
-            if os.path.exists(lock_file):
-                os.remove(lock_file)
-        except:
-            pass
 
 @app.function(gpu="T4", volumes={VOLUME_MOUNT_PATH: volume})
-def train_model(image_paths, instance_prompt, model_name, model_id=None):
+def train_model(image_paths, instance_prompt, model_name, model_id=None, job_id=None):
     """Simple training function"""
     print(f"Training model {model_name} with prompt: {instance_prompt}")
     print(f"Using {len(image_paths)} images")
@@ -128,9 +118,9 @@ def train_model(image_paths, instance_prompt, model_name, model_id=None):
     
     print(f"Found {len(valid_paths)} valid images out of {len(image_paths)}")
     
-    if len(valid_paths) < 2:
-        # As a fallback, check if there are any images in the training directory
-        training_dir = f"{VOLUME_MOUNT_PATH}/training_images"
+    if len(valid_paths) < 2 and job_id:
+        # As a fallback, check if there are any images in the job's dataset directory
+        training_dir = job_dataset_dir(VOLUME_MOUNT_PATH, job_id)
         if os.path.exists(training_dir):
             existing_images = glob.glob(f"{training_dir}/*.png")
             if existing_images:
@@ -196,11 +186,9 @@ def main(input=None, dry_run=False):
     print(f"Processing input file: {input_file}")
     
     try:
-        # Read the input file
-        with open(input_file, 'r') as f:
-            data = json.load(f)
+        # Read the input file (the images are streamed separately below)
+        data = load_input_params(input_file)
         
-        image_data_list = data.get('imageDataList', [])
         instance_prompt = data.get('instancePrompt', '')
         model_name = data.get('modelName', 'test-model')
         model_id = data.get('modelId', f'model-{int(time.time())}')
@@ -215,8 +203,15 @@ def main(input=None, dry_run=False):
                 "message": "Dry run successful"
             }
         
+        # Stream the images onto the volume one at a time rather than loading
+        # every base64 string into memory and into the remote call
+        # (everything this job writes to the volume is namespaced by its ID)
+        job_id = uuid.uuid4().hex
+        upload_dir = f"/{UPLOADS_DIRNAME}/{job_id}"
+        image_data_list = stage_image_entries(input_file, volume, upload_dir, VOLUME_MOUNT_PATH)
+        
         # Process images
-        processed_paths = preprocess_images.remote(image_data_list)
+        processed_paths = preprocess_images.remote(image_data_list, job_id)
         
         if not processed_paths:
             print("WARNING: No valid images processed. Cannot proceed with training.")
@@ -226,7 +221,7 @@ def main(input=None, dry_run=False):
             }
         
         # Train model with model_id
-        result = train_model.remote(processed_paths, instance_prompt, model_name, model_id)
+        result = train_model.remote(processed_paths, instance_prompt, model_name, model_id, job_id)
         
         print(f"Training completed with status: {result.get('status', 'unknown')}")
         return result
@@ -0,0 +1,187 @@
+"""
+Step-level UNet feature caching (DeepCache).
+
+The high-level features of the UNet change little between consecutive
+denoising steps; most of the change is in the shallow, high-resolution
+blocks. UNetFeatureCache runs the full UNet once every `interval` steps and
+keeps the output of the second-to-last up block. The steps in between run
+only the shallow path:
+
+    conv_in -> down_blocks[0] -> up_blocks[-1] (on the cached features) -> conv_out
+
+with fresh skip connections from the first down block, so the middle and
+deep blocks are skipped on most steps. No weights change; interval 1 is the
+plain UNet.
+
+Only the Stable Diffusion 1.x/2.x UNet layout is supported (no class,
+addition or encoder projection embeddings, no ControlNet residuals).
+"""
+
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import numpy as np
+import torch
+from torch import nn
+from PIL import Image
+try:
+    from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput
+except ImportError:
+    # diffusers < 0.26 (the local requirements.txt still pins 0.19.3 for deploys)
+    from diffusers.models.unet_2d_condition import UNet2DConditionOutput
+
+
+def image_psnr(reference: Image.Image, image: Image.Image) -> float:
+    """Peak signal-to-noise ratio of an image against a reference, in dB"""
+    a = np.asarray(reference, dtype=np.float64)
+    b = np.asarray(image, dtype=np.float64)
+    mse = np.mean((a - b) ** 2)
+    return float("inf") if mse == 0 else float(10 * np.log10(255.0 ** 2 / mse))
+
+
+class UNetFeatureCache:
+    """
+    Reuses a UNet's deep features across denoising steps
+
+    Args:
+        unet: A UNet2DConditionModel with at least two up blocks
+    """
+
+    def __init__(self, unet: nn.Module):
+        if len(unet.up_blocks) < 2:
+            raise ValueError("Feature caching needs a UNet with at least two up blocks")
+        for name in ("class_embedding", "add_embedding", "encoder_hid_proj"):
+            if getattr(unet, name, None) is not None:
+                raise ValueError(f"Feature caching does not support UNets with a {name}")
+
+        self.unet = unet
+        self.interval = 1
+        self._step = 0
+        self._features: Optional[torch.Tensor] = None
+        self._capture = False
+        self._stats = {"full_steps": 0, "cached_steps": 0}
+
+    @contextmanager
+    def enabled(self, interval: int) -> Iterator[None]:
+        """
+        Cache features during one generation (the step count restarts on entry)
+
+        Args:
+            interval: Full UNet passes every interval steps; 1 disables caching
+        """
+        if interval <= 1:
+            yield
+            return
+
+        self.interval = interval
+        self._step = 0
+        self._features = None
+        hook = self.unet.up_blocks[-2].register_forward_hook(self._store_features)
+        # Instance attribute shadows UNet2DConditionModel.forward for nn.Module.__call__
+        self.unet.forward = self._forward
+        try:
+            yield
+        finally:
+            del self.unet.forward
+            hook.remove()
+            self._features = None
+
+    def _store_features(self, module: nn.Module, inputs: Any, output: torch.Tensor):
+        if self._capture:
+            self._features = output
+
+    def _forward(self, sample: torch.Tensor, timestep, encoder_hidden_states: torch.Tensor, *args, **kwargs):
+        step = self._step
+        self._step += 1
+
+        features = self._features
+        refresh = (
+            step % self.interval == 0
+            or features is None
+            # Batch size changes when guidance is turned off mid-schedule (see GENERATION_TIERS)
+            or features.shape[0] != sample.shape[0]
+        )
+        if refresh:
+            self._capture = True
+            try:
+                output = type(self.unet).forward(self.unet, sample, timestep, encoder_hidden_states, *args, **kwargs)
+            finally:
+                self._capture = False
+            self._stats["full_steps"] += 1
+            return output
+
+        sample = self._shallow_forward(
+            sample,
+            timestep,
+            encoder_hidden_states,
+            features,
+            timestep_cond=kwargs.get("timestep_cond"),
+            cross_attention_kwargs=kwargs.get("cross_attention_kwargs")
+        )
+        self._stats["cached_steps"] += 1
+        if not kwargs.get("return_dict", True):
+            return (sample,)
+        return UNet2DConditionOutput(sample=sample)
+
+    def _shallow_forward(
+        self,
+        sample: torch.Tensor,
+        timestep,
+        encoder_hidden_states: torch.Tensor,
+        features: torch.Tensor,
+        timestep_cond: Optional[torch.Tensor] = None,
+        cross_attention_kwargs: Optional[Dict[str, Any]] = None
+    ) -> torch.Tensor:
+        """The UNet's first down block and last up block, on cached deep features"""
+        unet = self.unet
+
+        # Time embedding, as in UNet2DConditionModel.forward
+        timesteps = timestep
+        if not torch.is_tensor(timesteps):
+            timesteps = torch.tensor([timesteps], device=sample.device)
+        elif timesteps.ndim == 0:
+            timesteps = timesteps[None].to(sample.device)
+        t_emb = unet.time_proj(timesteps.expand(sample.shape[0])).to(dtype=sample.dtype)
+        emb = unet.time_embedding(t_emb, timestep_cond)
+        if getattr(unet, "time_embed_act", None) is not None:
+            emb = unet.time_embed_act(emb)
+
+        if unet.config.center_input_sample:
+            sample = 2 * sample - 1.0
+        sample = unet.conv_in(sample)
+
+        down_block = unet.down_blocks[0]
+        if getattr(down_block, "has_cross_attention", False):
+            hidden_states, res_samples = down_block(
+                hidden_states=sample,
+                temb=emb,
+                encoder_hidden_states=encoder_hidden_states,
+                cross_attention_kwargs=cross_attention_kwargs
+            )
+        else:
+            hidden_states, res_samples = down_block(hidden_states=sample, temb=emb)
+
+        # The last up block takes the skip connections of conv_in and the first down block's layers
+        up_block = unet.up_blocks[-1]
+        res_samples = ((sample,) + res_samples)[:len(up_block.resnets)]
+        if getattr(up_block, "has_cross_attention", False):
+            sample = up_block(
+                hidden_states=features,
+                temb=emb,
+                res_hidden_states_tuple=res_samples,
+                encoder_hidden_states=encoder_hidden_states,
+                cross_attention_kwargs=cross_attention_kwargs
+            )
+        else:
+            sample = up_block(hidden_states=features, temb=emb, res_hidden_states_tuple=res_samples)
+
+        if unet.conv_norm_out is not None:
+            sample = unet.conv_norm_out(sample)
+            sample = unet.conv_act(sample)
+        return unet.conv_out(sample)
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = dict(self._stats)
+        steps = metrics["full_steps"] + metrics["cached_steps"]
+        metrics["cached_share"] = round(metrics["cached_steps"] / steps, 3) if steps else None
+        return metrics
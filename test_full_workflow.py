@@ -58,7 +58,9 @@ def main(steps=10):
         with app.run():
             # Step 1: Preprocess images
             print("Step 1: Preprocessing images...")
-            processed_paths = preprocess_images.remote(image_data_list)
+            preprocess_result = preprocess_images.remote(image_data_list)
+            job_id = preprocess_result["job_id"]
+            processed_paths = preprocess_result["processed_paths"]
             print(f"Processed paths: {processed_paths}")
             
             # Step 2: Train model
@@ -67,14 +69,15 @@ def main(steps=10):
                 processed_paths,
                 instance_prompt,
                 model_name,
-                training_steps
+                training_steps,
+                job_id=job_id
             )
             print("Training complete!")
             print(f"Result: {json.dumps(result, indent=2)}")
             
             # Step 3: Clean up
             print("Step 3: Cleaning up...")
-            cleanup_result = cleanup_training_data.remote(model_name)
+            cleanup_result = cleanup_training_data.remote(job_id)
             print(f"Cleanup result: {cleanup_result}")
         
         print("Test completed successfully!")
@@ -39,7 +39,8 @@ if __name__ == "__main__":
     
     print("Testing preprocess_images function...")
     with app.run():
-        processed_paths = preprocess_images.remote(image_data_list)
-        print(f"Processed paths: {processed_paths}")
+        result = preprocess_images.remote(image_data_list)
+        print(f"Processed paths: {result['processed_paths']}")
+        print(f"Per-image results: {result['images']}")
     
     print("Test completed successfully!") 
\ No newline at end of file